@@ -1,5 +1,31 @@
-from .src.metaplus import MetaAnalysisPlus
-from .src.datasetplus import DatasetPlus
-from .src.ranking import rank_terms
-from .src.singleterm import analyze_expression, analyze_all_terms
-from .gui.main import main_gui
+from importlib import import_module
+from sys import version_info
+
+# public names and the modules that define them; the modules (and their heavy
+# dependencies: neurosynth, pandas, scipy...) are only imported when first used
+_LAZY_ATTRS = {
+    'MetaAnalysisPlus': '.src.metaplus',
+    'DatasetPlus': '.src.datasetplus',
+    'rank_terms': '.src.ranking',
+    'analyze_expression': '.src.singleterm',
+    'analyze_all_terms': '.src.singleterm',
+    'main_gui': '.gui.main',
+}
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(import_module(_LAZY_ATTRS[name], __name__), name)
+    globals()[name] = value  # later lookups don't call __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
+
+
+if version_info < (3, 7):  # no module __getattr__ (PEP 562)
+    for _name in __all__:
+        __getattr__(_name)
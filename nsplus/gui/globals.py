@@ -1,9 +1,9 @@
 from __future__ import absolute_import
-from ..src.datasetplus import DatasetPlus
 import os
 import re
 from threading import Lock, Thread
 from sys import version_info
+from ..src.userdirs import user_data_dir, user_cache_dir
 if version_info.major == 2:
     import Tkinter as tk
     import tkMessageBox as messagebox
@@ -43,6 +43,8 @@ class Global(Singleton):
         self.has_error = False
         # self.history = []
         self.dataset = None
+        self.result_cache = None
+        self._result_cache_hits = 0
         self.status_mutex = Lock()
 
         # default settings
@@ -58,6 +60,14 @@ class Global(Singleton):
         self.prior = 0.5
         # number of iterations (for comparison)
         self.num_iterations = 500
+        # max size (in bytes) of the cache of ROI image tables
+        self.image_cache_size = 2 * 2 ** 30
+        # max size (in bytes) of the cache of analysis results
+        self.result_cache_size = 2 * 2 ** 30
+        # seed of random sampling (for comparison); None draws a new sample every
+        # time, so comparisons that sample the larger set are not loaded from the
+        # result cache
+        self.seed = None
         # lower and upper thresholds (for comparison)
         self.lower_thr = 0.6
         self.upper_thr = 0.5
@@ -227,17 +237,43 @@ class Global(Singleton):
         """
         try:
             self.update_status(status='Loading database...', is_ready=False)
+            loading_status = 'Ready (loading brain images in the background...)'
+            restored = []  # message about the custom terms restored from last time
 
             def load_database():
+                # the analysis modules are imported here, after the window is shown
+                from ..src.datasetplus import DatasetPlus
+                from ..src.diskcache import DiskCache, ResultCache
                 self.dataset = DatasetPlus.load_default_database()
+                # images of analyses that have been done before
+                self.result_cache = ResultCache(user_cache_dir('results'),
+                                                max_size=self.result_cache_size)
+                self.dataset.result_cache = self.result_cache
+                # image tables of ROIs that can't be taken from the whole-brain table
+                self.dataset.image_cache = DiskCache(user_cache_dir('image_tables'),
+                                                     max_size=self.image_cache_size)
+                restored.append(self.restore_custom_terms())
                 self.root.event_generate('<<Database_loaded>>')  # trigger event
+                # features and study queries can be used from here on, and the rest
+                # (e.g. the image table) is loaded in the background; analyses that
+                # start before it is done wait for what they need
+                self.dataset.finish_loading()
+                self.root.event_generate('<<Database_fully_loaded>>')
 
             def on_database_load(event):
                 self.update_ac_lists()
-                self.update_status(is_ready=True)
+                self.update_status(status=loading_status + restored[0], is_ready=True)
                 self.root.unbind('<<Database_loaded>>')
 
+            def on_database_fully_loaded(event):
+                with self.status_mutex:
+                    # not replaced by another task
+                    if self.status == loading_status + restored[0]:
+                        self._update_status('Ready' + restored[0], is_ready=True)
+                self.root.unbind('<<Database_fully_loaded>>')
+
             self.root.bind('<<Database_loaded>>', on_database_load)
+            self.root.bind('<<Database_fully_loaded>>', on_database_fully_loaded)
             Thread(target=load_database).start()
         except Exception as e:
             messagebox.showerror('Error: failed to load database', str(e))
@@ -245,6 +281,63 @@ class Global(Singleton):
                                is_ready=True, is_error=True)
             raise e
 
+    def get_done_status(self, saved_to=None):
+        """
+        :param saved_to: (string) where the output files are saved (default: outpath)
+        :return: the status to show when an analysis is done, which tells if results
+                 were loaded from the result cache since the last call
+        """
+        status = 'Done. '
+        if self.result_cache is not None:
+            info = self.result_cache.info()
+            if info['hits'] > self._result_cache_hits:
+                status = 'Done (loaded from cache, %.0f MB cached). ' \
+                         % (info['currsize'] / 2 ** 20)
+            self._result_cache_hits = info['hits']
+        if saved_to is None:
+            return status + 'Files are saved to ' + self.outpath
+        return status + 'A file is saved to ' + saved_to
+
+    def get_custom_terms_filename(self):
+        # in the user's data directory, so that changing the output directory in
+        # Settings doesn't lose the terms
+        return os.path.join(user_data_dir(), 'custom_terms.json')
+
+    def save_custom_terms(self):
+        """
+        Save the custom terms, so that they are added again the next time the
+        database is loaded
+        :return: (boolean) whether the terms have been saved; if not, the status bar
+                 shows the error
+        """
+        try:
+            self.dataset.save_custom_terms(self.get_custom_terms_filename())
+        except (IOError, OSError) as e:
+            self.update_status(status='Error: custom terms could not be saved, so they '
+                                      'will be lost when NS+ is closed. ' + str(e),
+                               is_ready=True, is_error=True)
+            return False
+        return True
+
+    def restore_custom_terms(self):
+        """
+        Add the custom terms saved last time to the database
+        :return: a message about the restored terms, to be added to the status
+        """
+        filename = self.get_custom_terms_filename()
+        if not os.path.isfile(filename):
+            return ''
+        try:
+            added, errors = self.dataset.load_custom_terms(filename)
+        except (IOError, OSError, ValueError) as e:
+            return '. Custom terms from last time could not be restored: ' + str(e)
+        message = ''
+        if len(added) > 0:
+            message = '. Restored custom terms from last time: ' + ', '.join(added)
+        if len(errors) > 0:
+            message += '. Could not restore: ' + ', '.join(str(t) for t in errors)
+        return message
+
     def load_roi(self, roi_label):
         if not self.update_status(status='Loading ROI...', is_ready=False, user_op=True):
             return
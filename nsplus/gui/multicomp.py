@@ -2,7 +2,6 @@ from __future__ import absolute_import, print_function
 from .globals import Global
 from .pagebuilder import PageBuilder
 from .autocompletepage import AutocompletePage
-from ..src.comparison import compare_multiple
 from ..src.analysisinfo import AnalysisInfo
 from threading import Thread
 from sys import version_info
@@ -161,11 +160,12 @@ class MultiCompPage(PageBuilder, AutocompletePage):
 
         def _compare():
             try:
+                from ..src.comparison import compare_multiple
                 # run
                 compare_multiple(Global().dataset, expressions, image, lower_thr,
                                  upper_thr, extra_info=[mask], outpath=Global().outpath,
                                  exclude_overlap=no_overlap, reduce_larger_set=reduce,
-                                 num_iterations=num_iter)
+                                 num_iterations=num_iter, seed=Global().seed)
                 Global().root.event_generate('<<Done_group_comp>>')  # trigger event
 
             except Exception as e:
@@ -174,5 +174,5 @@ class MultiCompPage(PageBuilder, AutocompletePage):
         Thread(target=_compare).start()
         Global().root.bind('<<Done_group_comp>>',
                            lambda e: Global().update_status(
-                               status='Done. Files are saved to ' + Global().outpath,
+                               status=Global().get_done_status(),
                                is_ready=True))
@@ -2,7 +2,6 @@ from __future__ import absolute_import, print_function
 from .globals import Global
 from .pagebuilder import PageBuilder
 from .autocompletepage import AutocompletePage
-from ..src.comparison import compare_expressions
 from threading import Thread
 
 
@@ -55,12 +54,14 @@ class PairCompPage(PageBuilder, AutocompletePage):
 
         def _compare():
             try:
+                from ..src.comparison import compare_expressions
                 # run
                 compare_expressions(Global().dataset, expr, contrary_expr, exclude_overlap,
                                     reduce, num_iterations, two_way,
                                     fdr=Global().fdr,
                                     extra_info=[mask],
-                                    outpath=Global().outpath)
+                                    outpath=Global().outpath,
+                                    seed=Global().seed)
 
                 Global().root.event_generate('<<Done_pair_comp>>')  # trigger event
 
@@ -70,5 +71,5 @@ class PairCompPage(PageBuilder, AutocompletePage):
         Thread(target=_compare).start()
         Global().root.bind('<<Done_pair_comp>>',
                            lambda e: Global().update_status(
-                               status='Done. Files are saved to ' + Global().outpath,
+                               status=Global().get_done_status(),
                                is_ready=True))
@@ -1,5 +1,4 @@
 from __future__ import absolute_import, print_function
-from ..src.ranking import rank_terms
 from ..src.analysisinfo import AnalysisInfo
 from .pagebuilder import PageBuilder
 from .globals import Global
@@ -87,6 +86,7 @@ class RankingPage(tk.Frame, PageBuilder):
 
         def _rank():
             try:
+                from ..src.ranking import rank_terms  # not imported until an analysis runs
                 rank_terms(Global().dataset, rank_by=meta_img,
                            extra_expr=Global().dataset.custom_terms,
                            rank_first=procedure, csv_name=outfile,
@@ -98,6 +98,6 @@ class RankingPage(tk.Frame, PageBuilder):
         Thread(target=_rank).start()
         Global().root.bind('<<Done_ranking>>',
                            lambda e: Global().update_status(
-                               'Done. A file is saved to ' + outfile,
+                               Global().get_done_status(saved_to=outfile),
                                is_ready=True
                            ))
@@ -164,14 +164,15 @@ class SettingsPage(PageBuilder, AutocompletePage):
                     return
                 # add to dataset
                 ids = [int(i) for i in ids.split(',')]
-                added_ids = Global().dataset.add_custom_term_by_ids(term, ids)
+                added_ids = Global().dataset.add_custom_term_by_ids(new_term, ids)
         except ValueError as e:
             Global().show_error(e)
             return
 
         Global().update_ac_lists()  # update autocomplete lists
-        Global().update_status('Associated "%s" with %d studies.' % (new_term, len(added_ids)),
-                               is_ready=True)
+        if Global().save_custom_terms():  # otherwise the error is shown
+            Global().update_status('Associated "%s" with %d studies.'
+                                   % (new_term, len(added_ids)), is_ready=True)
         self.entry_term.delete(0, tk.END)
         self.ac_entry_custom.delete(0, tk.END)
 
@@ -1,5 +1,4 @@
 from __future__ import absolute_import, print_function
-from ..src.singleterm import analyze_expression
 from .autocompletepage import AutocompletePage
 from .globals import Global
 from threading import Thread
@@ -60,6 +59,7 @@ class AnalysisPage(AutocompletePage):
 
         def _analyze():
             try:
+                from ..src.singleterm import analyze_expression
                 # run
                 analyze_expression(Global().dataset, expression,
                                    fdr=Global().fdr,
@@ -73,6 +73,6 @@ class AnalysisPage(AutocompletePage):
         Thread(target=_analyze).start()
         Global().root.bind('<<Done_analysis>>',
                            lambda e: Global().update_status(
-                               status='Done. Files are saved to ' + Global().outpath,
+                               status=Global().get_done_status(),
                                is_ready=True
                            ))
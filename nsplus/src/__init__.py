@@ -1,8 +1,29 @@
-from __future__ import absolute_import
-from .singleterm import analyze_expression
-from .datasetplus import DatasetPlus
-from .metaplus import MetaAnalysisPlus
-from .analysisinfo import AnalysisInfo
-from .ranking import rank_terms
-
-__all__ = ['single_term.py', 'datasetplus', 'metaplus', 'rank_terms']
+from importlib import import_module
+from sys import version_info
+
+# see nsplus/__init__.py
+_LAZY_ATTRS = {
+    'analyze_expression': '.singleterm',
+    'DatasetPlus': '.datasetplus',
+    'MetaAnalysisPlus': '.metaplus',
+    'AnalysisInfo': '.analysisinfo',
+    'rank_terms': '.ranking',
+}
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRS:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(import_module(_LAZY_ATTRS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
+
+
+if version_info < (3, 7):
+    for _name in __all__:
+        __getattr__(_name)
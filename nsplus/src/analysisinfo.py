@@ -1,6 +1,5 @@
 from collections import OrderedDict
 from string import punctuation
-import pandas as pd
 
 
 class BiOrderedDict(OrderedDict):
@@ -115,4 +114,5 @@ class AnalysisInfo(OrderedDict):
         """
         Return the information as a pandas data frame
         """
+        import pandas as pd  # not needed by the GUI pages that only use the names
         return pd.DataFrame(list(self.values()), index=list(self.keys()))
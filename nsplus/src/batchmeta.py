@@ -0,0 +1,469 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from .analysisinfo import AnalysisInfo
+from scipy import sparse, special
+from scipy.stats import norm
+import numpy as np
+
+
+def get_study_indices(image_table, study_ids):
+    """
+    Find the columns of the given studies in an image table. Studies that are not
+    in the image table are dropped, same as in a Neurosynth MetaAnalysis.
+    :param image_table: a Neurosynth ImageTable instance
+    :param study_ids: a list of study IDs
+    :return: a sorted numpy array of column indices
+    """
+    return np.where(np.isin(image_table.ids, list(study_ids)))[0]
+
+
+def selection_matrix(index_lists, n_studies):
+    """
+    Build a sparse (studies x selections) matrix, where column i indicates the
+    studies in index_lists[i].
+    :param index_lists: a list of arrays of study (column) indices
+    :param n_studies: the total number of studies in the image table
+    :return: a scipy.sparse.csc_matrix of 0s and 1s
+    """
+    rows = np.concatenate([np.asarray(indices, dtype=np.int64)
+                           for indices in index_lists]) \
+        if len(index_lists) > 0 else np.array([], dtype=np.int64)
+    cols = np.repeat(np.arange(len(index_lists)),
+                     [len(indices) for indices in index_lists])
+    return sparse.csc_matrix((np.ones(len(rows)), (rows, cols)),
+                             shape=(n_studies, len(index_lists)))
+
+
+def count_active_voxels(image_data, selection):
+    """
+    Count the number of selected studies that activate each voxel, for every
+    column of the selection matrix at once.
+    :param image_data: a (voxels x studies) sparse matrix, e.g. image_table.data
+    :param selection: a (studies x selections) sparse selection matrix
+    :return: a (selections x voxels) numpy array of activation counts, in the dtype
+             of image_data (counts are exact in float32 up to 2^24 studies)
+    """
+    counts = image_data.dot(selection.toarray().astype(image_data.dtype, copy=False))
+    return np.ascontiguousarray(np.asarray(counts, dtype=image_data.dtype).T)
+
+
+def image_names(prior=0.5, q=0.01):
+    """
+    :return: the names of all images computed by meta_images, in the same order as
+             the images of a Neurosynth MetaAnalysis
+    """
+    return ['pA', 'pAgF', 'pFgA'] + prior_image_names(prior) + \
+           ['uniformity-test_z', 'association-test_z'] + fdr_image_names(q)
+
+
+def prior_image_names(prior):
+    """
+    :return: the names of the images that depend on the prior
+    """
+    return [AnalysisInfo.add_num_to_name(name, prior=prior)
+            for name in ('pA_given_pF=', 'pFgA_given_pF=')]
+
+
+def fdr_image_names(q):
+    """
+    :return: the names of the images that depend on the FDR threshold
+    """
+    return [AnalysisInfo.add_num_to_name(name, fdr=q)
+            for name in ('uniformity-test_z_FDR_', 'association-test_z_FDR_')]
+
+
+def _row_means(values):
+    """
+    :return: the mean of each row, summed in float64 (float32 sums of many voxels
+             lose precision) and then converted to the dtype of values
+    """
+    return np.mean(values, axis=1, keepdims=True, dtype=np.float64).astype(values.dtype)
+
+
+def _chi_square_p(chi_sq):
+    """
+    :return: the p-values of chi-square values with 1 degree of freedom, always in
+             float64, since float32 can't represent p-values below ~1e-38
+    """
+    return special.chdtrc(1, np.asarray(chi_sq, dtype=np.float64))
+
+
+def _one_way(n_sel_active, n_sel):
+    """
+    Row-wise version of neurosynth.analysis.stats.one_way
+    """
+    t_exp = _row_means(n_sel_active)
+    nt_exp = n_sel - t_exp
+    t_mss = (n_sel_active - t_exp) ** 2 / t_exp
+    nt_mss = ((n_sel - n_sel_active) - nt_exp) ** 2 / nt_exp
+    return _chi_square_p(t_mss + nt_mss)
+
+
+def _two_way(n_sel_active, n_unsel_active, n_sel, n_unsel):
+    """
+    Row-wise version of neurosynth.analysis.stats.two_way
+    """
+    cells = ((n_sel_active, n_sel - n_sel_active),
+             (n_unsel_active, n_unsel - n_unsel_active))
+    row_sums = (n_sel, n_unsel)
+    col_sums = (n_sel_active + n_unsel_active,
+                (n_sel - n_sel_active) + (n_unsel - n_unsel_active))
+    total = col_sums[0] + col_sums[1]
+    chi_sq = [[None, None], [None, None]]
+    for i in range(2):
+        for j in range(2):
+            exp = row_sums[i] * col_sums[j] / total
+            chi_sq[i][j] = (cells[i][j] - exp) ** 2 / exp
+            chi_sq[i][j][exp == 0] = 1.0  # set p-value for invalid voxels to 1
+    chi_sq = (chi_sq[0][0] + chi_sq[1][0]) + (chi_sq[0][1] + chi_sq[1][1])
+    return _chi_square_p(chi_sq)
+
+
+def _p_to_z(p, sign):
+    p = p / 2  # convert to two-tailed
+    p[p < 1e-240] = 1e-240  # prevent underflow
+    z = np.abs(norm.ppf(p)) * sign
+    z[np.isinf(z)] = norm.ppf(1e-240) * -1  # set very large z's to max precision
+    return z
+
+
+def fdr_thresholds(p, qs):
+    """
+    Benjamini-Hochberg FDR thresholds of many maps at once, same as
+    neurosynth.analysis.stats.fdr for each map. The p-values of all maps are sorted
+    in one call, and all q values are applied to the same sorted p-values.
+    :param p: a (maps x voxels) array of p-values
+    :param qs: a list of FDR thresholds
+    :return: a (FDR thresholds x maps) array of p-value thresholds (-1 where no
+             voxel passes)
+    """
+    p = np.atleast_2d(p)
+    n_maps, n = p.shape
+    thresholds = np.full((len(qs), n_maps), -1.0)
+    if n == 0:
+        return thresholds
+    s = np.sort(p, axis=1)
+    ranks = np.arange(1, n + 1, dtype=np.float64)
+    for i, q in enumerate(qs):
+        below = s <= ranks * q / n
+        last = n - 1 - np.argmax(below[:, ::-1], axis=1)  # last value below the null
+        passed = np.any(below, axis=1)
+        thresholds[i, passed] = s[passed, last[passed]]
+    return thresholds
+
+
+def fdr_threshold(z, p, qs, max_memory=2 ** 28):
+    """
+    Batched FDR correction: set the z-scores of voxels that don't pass the
+    Benjamini-Hochberg threshold of their map to 0, for many maps and FDR thresholds
+    at once. Maps are corrected in chunks to limit memory use.
+    :param z: a (maps x voxels) array of z-scores
+    :param p: a (maps x voxels) array of the p-values of the z-scores
+    :param qs: a list of FDR thresholds
+    :param max_memory: (int) approximate number of bytes to use at once, besides
+                       the results
+    :return: a (FDR thresholds x maps x voxels) array of thresholded z-scores, in
+             the dtype of z
+    """
+    n_maps, n_voxels = z.shape
+    chunk_size = max(1, max_memory // max(n_voxels * 24, 1))  # about 3 arrays of 8 bytes
+    thresholded = np.empty((len(qs), n_maps, n_voxels), dtype=z.dtype)
+    for start in range(0, n_maps, chunk_size):
+        chunk = slice(start, min(start + chunk_size, n_maps))
+        thresholds = fdr_thresholds(p[chunk], qs)[:, :, np.newaxis]
+        for i in range(len(qs)):
+            np.multiply(z[chunk], ~(p[chunk] > thresholds[i]), out=thresholded[i, chunk])
+    return thresholded
+
+
+def max_deviation(images, reference):
+    """
+    Compare images computed with reduced precision (e.g. float32) to the same images
+    computed in float64.
+    :param images: a dictionary {image name: image}
+    :param reference: a dictionary that has the same images
+    :return: an OrderedDict {image name: max absolute difference}, where NaNs in
+             both images count as equal, and a NaN in only one as an infinite
+             difference
+    """
+    deviations = OrderedDict()
+    for name, img in images.items():
+        img = np.asarray(img, dtype=np.float64)
+        ref = np.asarray(reference[name], dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            diff = np.where((img == ref) | (np.isnan(img) & np.isnan(ref)), 0,
+                            np.abs(img - ref))
+        diff[np.isnan(diff)] = np.inf
+        deviations[name] = float(np.max(diff)) if diff.size > 0 else 0.0
+    return deviations
+
+
+class LazyImages(MutableMapping):
+    """
+    The Neurosynth meta-analysis images of one or more meta-analyses, as a mapping
+    {image name: image} that only keeps the activation counts, and computes each
+    image when it's first used. The images and the intermediate values that they
+    share (e.g. the p-values of a test and its FDR image) are memoized, so every
+    value is computed at most once; the intermediate values are freed once all
+    images have been computed. Like a dictionary, images can be replaced, added
+    and removed.
+    The counts are either 1D arrays of a single meta-analysis, whose images are 1D
+    arrays of voxels, or (selections x voxels) arrays with one meta-analysis per
+    row (see meta_images).
+    The counts and images are kept in one dtype, e.g. float32 to halve their memory.
+    Means over voxels are summed in float64, and the p-values of the tests are
+    always float64, so that z-scores keep their range; max_deviation reports how
+    far the images are from float64 results.
+    """
+    # the value of each image (see image_names)
+    _image_values = ('pA', 'pAgF', 'pFgA', 'pA_prior', 'pFgA_prior', 'pAgF_z', 'pFgA_z',
+                     'pAgF_z_FDR', 'pFgA_z_FDR')
+    fdr_max_memory = 2 ** 28  # approximate number of bytes used at once by FDR correction
+
+    def __init__(self, n_sel_active, n_unsel_active, n_sel, n_unsel, n_active=None,
+                 prior=0.5, q=0.01, min_studies=1, dtype=None):
+        """
+        See meta_images for the parameters.
+        :param min_studies: (int) voxels activated by fewer studies, or (float) by a
+                            smaller proportion of studies, are 0 in all images, same
+                            as in a Neurosynth MetaAnalysis
+        :param dtype: the dtype of the counts and images (default: the dtype of
+                      n_sel_active if it's a float array, or float64)
+        """
+        if dtype is None:
+            dtype = np.asarray(n_sel_active).dtype
+            if dtype.kind != 'f':
+                dtype = np.float64
+        self.dtype = np.dtype(dtype)
+        self._single = np.ndim(n_sel_active) == 1
+        self.n_sel_active = np.atleast_2d(n_sel_active).astype(dtype, copy=False)
+        self.n_unsel_active = np.atleast_2d(n_unsel_active).astype(dtype, copy=False)
+        self.n_sel = np.asarray(n_sel, dtype=dtype).reshape(-1, 1)
+        self.n_unsel = np.asarray(n_unsel, dtype=dtype).reshape(-1, 1)
+        self.n_active = self.n_sel_active + self.n_unsel_active if n_active is None \
+            else np.atleast_2d(n_active).astype(dtype, copy=False)
+        self.prior = prior
+        self.q = q
+        self.min_studies = min_studies
+        self._names = image_names(prior, q)
+        self._uncomputed = OrderedDict(zip(self._names, self._image_values))
+        self._values = {}  # intermediate values
+        self._images = {}
+
+    def __getitem__(self, name):
+        if name not in self._images:
+            if name not in self._uncomputed:
+                raise KeyError(name)
+            self._images[name] = self._mask(self._value(self._uncomputed[name]))
+            del self._uncomputed[name]
+            if len(self._uncomputed) == 0:
+                self._values = {}
+        return self._images[name]
+
+    def _mask(self, img):
+        """
+        :return: a copy of an image in the dtype of the counts, where voxels activated
+                 by too few studies are 0
+        """
+        img = np.broadcast_to(img, self.n_sel_active.shape).astype(self.dtype)
+        if self.min_studies > 0:
+            img[self._value('excluded')] = 0
+        return img[0] if self._single else img
+
+    def __setitem__(self, name, img):
+        if name not in self._names:
+            self._names.append(name)
+        self._uncomputed.pop(name, None)
+        self._images[name] = img
+
+    def __delitem__(self, name):
+        if name not in self._names:
+            raise KeyError(name)
+        self._names.remove(name)
+        self._uncomputed.pop(name, None)
+        self._images.pop(name, None)
+        if len(self._uncomputed) == 0:
+            self._values = {}
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def sweep(self, priors=(), qs=()):
+        """
+        Compute the prior-adjusted images for many priors, and the FDR-corrected
+        images for many FDR thresholds, from the activation counts. The priors are
+        applied in one vectorized operation, and the p-values of each test are only
+        sorted once for all thresholds.
+        :param priors: a list of priors
+        :param qs: a list of FDR thresholds
+        :return: an OrderedDict {image name: image}, named by AnalysisInfo.add_num_to_name
+                 (e.g. 'pFgA_given_pF=0.30' and 'association-test_z_FDR_0.05')
+        """
+        images = OrderedDict()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if len(priors) > 0:
+                prior = np.reshape(np.asarray(priors, dtype=self.dtype), (-1, 1, 1))
+                pAgF = self._value('pAgF')
+                pA_prior = prior * pAgF + (1 - prior) * self._value('pAgU')
+                pFgA_prior = pAgF * prior / pA_prior
+                for i in range(len(priors)):
+                    images.update(zip(prior_image_names(priors[i]),
+                                      (self._mask(pA_prior[i]), self._mask(pFgA_prior[i]))))
+            if len(qs) > 0:
+                fdr_images = [fdr_threshold(self._value(test + '_z'), self._value(test + '_p'),
+                                            qs, self.fdr_max_memory)
+                              for test in ('pAgF', 'pFgA')]
+                for i in range(len(qs)):
+                    images.update(zip(fdr_image_names(qs[i]),
+                                      (self._mask(fdr_images[0][i]),
+                                       self._mask(fdr_images[1][i]))))
+        if len(self._uncomputed) == 0:
+            self._values = {}
+        return images
+
+    def counts(self):
+        """
+        :return: a dictionary {name: array} of the activation counts and the numbers
+                 of studies, from which from_counts computes the same images
+        """
+        counts = {'n_sel_active': self.n_sel_active, 'n_unsel_active': self.n_unsel_active,
+                  'n_sel': self.n_sel.ravel(), 'n_unsel': self.n_unsel.ravel(),
+                  'n_active': self.n_active}
+        if self._single:
+            counts = {name: values[0] for name, values in counts.items()}
+        return counts
+
+    @classmethod
+    def from_counts(cls, counts, prior=0.5, q=0.01, min_studies=1):
+        """
+        :param counts: a dictionary of the counts returned by counts()
+        :return: a LazyImages mapping of the images computed from the counts
+        """
+        return cls(counts['n_sel_active'], counts['n_unsel_active'], counts['n_sel'],
+                   counts['n_unsel'], counts['n_active'], prior, q, min_studies)
+
+    def row(self, i):
+        """
+        :return: a LazyImages mapping of the images of the i-th meta-analysis
+        """
+        return LazyImages(self.n_sel_active[i], self.n_unsel_active[i], self.n_sel[i],
+                          self.n_unsel[i], self.n_active[i if len(self.n_active) > 1 else 0],
+                          self.prior, self.q, self.min_studies, self.dtype)
+
+    def max_deviation(self, image_names=None):
+        """
+        Validate the precision of the images: compute them again from the same counts
+        in float64, and compare them to the images of this mapping (see the
+        max_deviation function).
+        :param image_names: the names of the images to compare (default: all images
+                            that are computed from the counts)
+        :return: an OrderedDict {image name: max absolute deviation from float64}
+        """
+        reference = LazyImages(self.n_sel_active, self.n_unsel_active, self.n_sel,
+                               self.n_unsel, self.n_active, self.prior, self.q,
+                               self.min_studies, np.float64)
+        if self._single:
+            reference = reference.row(0)
+        if image_names is None:
+            image_names = [name for name in self if name in reference]
+        return max_deviation(OrderedDict((name, self[name]) for name in image_names),
+                             reference)
+
+    def _value(self, name):
+        if name not in self._values:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self._values[name] = getattr(self, '_' + name)()
+        return self._values[name]
+
+    # Probabilities #
+
+    def _n_mappables(self):
+        return self.n_sel + self.n_unsel
+
+    def _pF(self):
+        return self.n_sel / self._value('n_mappables')
+
+    def _pA(self):
+        return self.n_active / self._value('n_mappables')
+
+    def _pAgF(self):
+        return self.n_sel_active / self.n_sel
+
+    def _pAgU(self):
+        return self.n_unsel_active / self.n_unsel
+
+    def _pFgA(self):
+        return self._value('pAgF') * self._value('pF') / self._value('pA')
+
+    def _pA_prior(self):
+        return self.prior * self._value('pAgF') + (1 - self.prior) * self._value('pAgU')
+
+    def _pFgA_prior(self):
+        return self._value('pAgF') * self.prior / self._value('pA_prior')
+
+    def _excluded(self):
+        min_studies = self.min_studies / self._value('n_mappables') \
+            if isinstance(self.min_studies, (int, np.integer)) else self.min_studies
+        return self._value('pA') < min_studies
+
+    # One-way chi-square test for consistency of activation #
+
+    def _pAgF_p(self):
+        p_vals = _one_way(self.n_sel_active, self.n_sel)
+        p_vals[p_vals < 1e-240] = 1e-240
+        return p_vals
+
+    def _pAgF_z(self):
+        z_sign = np.sign(self.n_sel_active - _row_means(self.n_sel_active))
+        return _p_to_z(self._value('pAgF_p'), z_sign).astype(self.dtype, copy=False)
+
+    def _pAgF_z_FDR(self):
+        return fdr_threshold(self._value('pAgF_z'), self._value('pAgF_p'), [self.q],
+                             self.fdr_max_memory)[0]
+
+    # Two-way chi-square test for specificity of activation #
+
+    def _pFgA_p(self):
+        p_vals = _two_way(self.n_sel_active, self.n_unsel_active, self.n_sel, self.n_unsel)
+        p_vals[p_vals < 1e-240] = 1e-240
+        return p_vals
+
+    def _pFgA_z(self):
+        z_sign = np.sign(self._value('pAgF') - self._value('pAgU'))
+        return _p_to_z(self._value('pFgA_p'), z_sign).astype(self.dtype, copy=False)
+
+    def _pFgA_z_FDR(self):
+        return fdr_threshold(self._value('pFgA_z'), self._value('pFgA_p'), [self.q],
+                             self.fdr_max_memory)[0]
+
+
+def meta_images(n_sel_active, n_unsel_active, n_sel, n_unsel, n_active=None,
+                prior=0.5, q=0.01, dtype=None):
+    """
+    Compute the Neurosynth meta-analysis images from activation counts, for many
+    meta-analyses at once. Each row of the inputs is one meta-analysis that
+    contrasts a set of selected studies to a set of unselected studies, and the
+    results match those of neurosynth.meta.MetaAnalysis (with min_studies=1).
+
+    :param n_sel_active: (selections x voxels) number of selected studies that
+                         activate each voxel
+    :param n_unsel_active: (selections x voxels) number of unselected studies that
+                           activate each voxel
+    :param n_sel: (1D array) number of selected studies in each row
+    :param n_unsel: (1D array) number of unselected studies in each row
+    :param n_active: (selections x voxels) number of studies in the union of the
+                     two sets that activate each voxel. Only needed when the two
+                     sets overlap; defaults to n_sel_active + n_unsel_active
+    :param prior: (float) the prior probability of a term being used in a study
+    :param q: (float) the FDR threshold to use when correcting for multiple
+              comparisons
+    :param dtype: the dtype of the images, e.g. np.float32 (default: the dtype of
+                  the counts if they are floats, or float64)
+    :return: a LazyImages mapping {image name: (selections x voxels) array}, in which
+             each image is computed when it's first used
+    """
+    return LazyImages(n_sel_active, n_unsel_active, n_sel, n_unsel, n_active, prior, q,
+                      dtype=dtype)
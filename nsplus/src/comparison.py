@@ -1,16 +1,23 @@
-from .metaplus import MetaAnalysisPlus
+from .metaplus import MetaAnalysisPlus, RunningMean, WinningCounter
+from .parallel import MatrixPool, map_with_matrix
 from .analysisinfo import AnalysisInfo
+from .resultstore import ResultStore, make_result_file
+from .batchmeta import get_study_indices, selection_matrix, count_active_voxels, \
+    meta_images
 import random
 import numpy as np
 import pandas as pd
 import os
 
+OUTPUT_FORMATS = ('nifti', 'hdf5')
 
-def even_study_set_size(study_sets):
+
+def even_study_set_size(study_sets, rng=random):
     """
     Reduce the sizes of all study sets to the smallest set in the list by random
     sampling
     :param study_sets: a list of study sets; each set is a list of string study IDs
+    :param rng: a random.Random instance to sample with (default: the global one)
     :return: a new list of reduced study sets, and a list of size information (strings,
              e.g. '123' if not reduced, or '123/456' if reduced)
     """
@@ -20,14 +27,130 @@ def even_study_set_size(study_sets):
         if min_size == len(study_set):
             reduced_sets.append(study_set)
         else:
-            reduced_sets.append(random.sample(study_set, min_size))
+            reduced_sets.append(rng.sample(study_set, min_size))
     return reduced_sets
 
 
+def iteration_seeds(seed, num_iterations):
+    """
+    Derive an independent seed for each iteration from one seed, so that the
+    subsamples of an iteration don't depend on how the iterations are split up.
+    :param seed: (int) the seed of a comparison, or None to use fresh entropy
+    :return: a list of integer seeds
+    """
+    return [int(s) for s in
+            np.random.SeedSequence(seed).generate_state(num_iterations, dtype=np.uint64)]
+
+
+def _batch_running_means(image_data, index_lists, overlap, two_way, prior, fdr,
+                         result_images=None, extra_priors=(), extra_fdrs=()):
+    """
+    Do the meta-analyses of a batch of iterations. The study sets of all iterations
+    are put in a (studies x iterations) selection matrix, so the activation counts
+    of every iteration come from one matrix product, and the images are then
+    computed from the counts all at once.
+    :param image_data: a (voxels x studies) image data matrix
+    :param index_lists: two lists (one for each study set) of study (column) indices
+                        in image_data, one item for each iteration
+    :param result_images: the names of the images to compute (default: all)
+    :param extra_priors: other priors to compute the prior-adjusted images with
+    :param extra_fdrs: other FDR thresholds to compute the FDR-corrected images with
+    :return: a list of RunningMean objects, one for each direction of the comparison
+    """
+    selections = [selection_matrix(index_list, image_data.shape[1])
+                  for index_list in index_lists]
+    counts = [count_active_voxels(image_data, selection) for selection in selections]
+    num_studies = [np.asarray(selection.sum(axis=0)).ravel() for selection in selections]
+    n_active = None
+    if overlap:
+        union = selection_matrix([np.union1d(*indices) for indices in zip(*index_lists)],
+                                 image_data.shape[1])
+        n_active = count_active_voxels(image_data, union)
+
+    batch_imgs = [meta_images(counts[0], counts[1], num_studies[0], num_studies[1],
+                              n_active, prior=prior, q=fdr)]
+    if two_way:
+        batch_imgs.append(meta_images(counts[1], counts[0], num_studies[1],
+                                      num_studies[0], n_active, prior=prior, q=fdr))
+    running_means = []
+    for lazy_imgs in batch_imgs:
+        imgs = lazy_imgs
+        if result_images is not None:  # the other images are never computed
+            imgs = {name: lazy_imgs[name] for name in result_images}
+        imgs.update(lazy_imgs.sweep(extra_priors, extra_fdrs))
+        running_mean = RunningMean()
+        running_mean.add_batch(imgs)
+        running_means.append(running_mean)
+    return running_means
+
+
+def _study_image_data(dataset, study_ids):
+    """
+    :param study_ids: the IDs of the studies to be compared
+    :return: the (voxels x studies) image data of those studies, and a dictionary of
+             the column of each study in it
+    """
+    image_table = dataset.image_table
+    columns = get_study_indices(image_table, study_ids)
+    col_index = {image_table.ids[col]: i for i, col in enumerate(columns)}
+    return image_table.data[:, columns], col_index
+
+
+def _resample_meta_images(dataset, study_sets, num_iterations, reduce_larger_set,
+                          two_way, prior, fdr, batch_size, seed=None, n_jobs=1,
+                          result_images=None, extra_priors=(), extra_fdrs=(),
+                          pool=None, col_index=None):
+    """
+    Run all iterations of a comparison, in batches of batch_size iterations that
+    can be spread across worker processes.
+    :param pool: a MatrixPool of image data from _study_image_data, to reuse its
+                 worker processes for several comparisons (n_jobs is then ignored)
+    :param col_index: the column index of the image data in pool
+    :return: a list of RunningMean objects with the images of all iterations, one
+             for each direction of the comparison (only one if two_way is False)
+    """
+    # only the columns of studies in either set are needed
+    if pool is None:
+        image_data, col_index = _study_image_data(dataset,
+                                                  set(study_sets[0]) | set(study_sets[1]))
+    overlap = len(set(study_sets[0]) & set(study_sets[1])) > 0
+
+    # nothing is random if no set is reduced, so one iteration is enough
+    if len(set(map(len, study_sets))) == 1:
+        reduce_larger_set = False
+    num_runs = num_iterations if reduce_larger_set else 1
+
+    # draw subsamples
+    batches = []
+    seeds = iteration_seeds(seed, num_runs)
+    for batch_start in range(0, num_runs, batch_size):
+        index_lists = ([], [])
+        for i in range(batch_start, min(batch_start + batch_size, num_runs)):
+            new_study_sets = even_study_set_size(study_sets, random.Random(seeds[i])) \
+                if reduce_larger_set else study_sets
+            for j in range(2):
+                index_lists[j].append(np.array([col_index[study]
+                                                for study in new_study_sets[j]
+                                                if study in col_index], dtype=np.int64))
+        batches.append((index_lists, overlap, two_way, prior, fdr, result_images,
+                        extra_priors, extra_fdrs))
+
+    # meta-analyses (batches are merged in order, so the results are identical
+    # regardless of the number of processes)
+    running_means = [RunningMean() for _ in range(2 if two_way else 1)]
+    all_batch_means = pool.map(_batch_running_means, batches) if pool is not None \
+        else map_with_matrix(_batch_running_means, image_data, batches, n_jobs)
+    for batch_means in all_batch_means:
+        for running_mean, batch_mean in zip(running_means, batch_means):
+            running_mean.merge(batch_mean)
+    return running_means
+
+
 def compare_expressions(dataset, expr, contrary_expr, exclude_overlap=True,
                         reduce_larger_set=True, num_iterations=500, two_way=True,
                         prior=0.5, fdr=0.01, extra_info=(), image_names=None,
-                        save_files=True, outpath='.'):
+                        save_files=True, outpath='.', batch_size=20, seed=None,
+                        n_jobs=1, output_format='nifti', extra_priors=(), extra_fdrs=()):
     """
     Compare two expressions and return a MetaAnalysisPlus object.
     The number of studies found through the two expressions are likely to be
@@ -35,6 +158,8 @@ def compare_expressions(dataset, expr, contrary_expr, exclude_overlap=True,
     set to reduce its size to the smaller one, then do it multiple times and
     average the results in the end. To do this, set reduce_larger_set=True
     and a large num_iterations.
+    If the dataset has a result_cache, reproducible results (e.g. with a seed) are
+    loaded from it when the same comparison has been done before.
 
     :param dataset: a neurosynth Dataset instance to get studies from
     :param expr: a string expression to be analyzed
@@ -60,9 +185,57 @@ def compare_expressions(dataset, expr, contrary_expr, exclude_overlap=True,
                         If None, all images will be included.
     :param save_files: (boolean) whether to save the results as csv and nifti files
     :param outdir: (string) directory to save the images/csv
-    :return: a list of MetaExtension objects
+    :param batch_size: (int) number of iterations to be computed together. Larger
+                       batches are faster but use more memory
+    :param seed: (int) seed for randomly sampling the larger study set. Results are
+                 reproducible with the same seed, regardless of n_jobs
+    :param n_jobs: (int) number of processes to run the iterations in; -1 means one
+                   process per CPU
+    :param output_format: 'nifti' to save a csv file and NIfTI images of each result
+                          in a new directory, or 'hdf5' to save all results in one
+                          new HDF5 file (requires h5py; see ResultStore)
+    :param extra_priors: (list of floats) other priors to compute the prior-adjusted
+                         images with, in the same iterations
+    :param extra_fdrs: (list of floats) other FDR thresholds to compute the
+                       FDR-corrected images with, in the same iterations
+    :return: a list of MetaExtension objects. When the larger set is reduced, the
+             standard errors of the mean images across iterations are in their
+             std_errors attribute (and saved as "*_std_error" images)
+    """
+    study_sets = [_get_studies(dataset, expression) for expression in (expr, contrary_expr)]
+    return _compare_study_sets(dataset, expr, contrary_expr, study_sets, exclude_overlap,
+                               reduce_larger_set, num_iterations, two_way, prior, fdr,
+                               extra_info, image_names, save_files, outpath, batch_size,
+                               seed, n_jobs, output_format,
+                               extra_priors=extra_priors, extra_fdrs=extra_fdrs)
+
+
+def _get_studies(dataset, expression):
+    try:
+        return dataset.get_studies(expression=expression)
+    except AttributeError:  # in case expression somehow doesn't work
+        return dataset.get_studies(features=expression)
+
+
+def _compare_study_sets(dataset, expr, contrary_expr, study_sets, exclude_overlap=True,
+                        reduce_larger_set=True, num_iterations=500, two_way=True,
+                        prior=0.5, fdr=0.01, extra_info=(), image_names=None,
+                        save_files=True, outpath='.', batch_size=20, seed=None,
+                        n_jobs=1, output_format='nifti', result_file=None,
+                        result_group='', result_images=None, extra_priors=(),
+                        extra_fdrs=(), pool=None, col_index=None):
+    """
+    Compare two expressions whose studies have already been found.
+    See compare_expressions for the other parameters.
+    :param study_sets: the lists of studies found with expr and contrary_expr
+    :param result_file: (string) an existing HDF5 file to add the results to, if the
+                        output format is 'hdf5' (default: a new file in outpath)
+    :param result_group: (string) the group of the results in the HDF5 file
+    :param result_images: the names of the images to compute (default: all)
+    :param pool: a MatrixPool of image data to reuse (see _resample_meta_images)
+    :param col_index: the column index of the image data in pool
     """
-    # 0) error checking
+    # error checking
     if num_iterations < 1:
         raise ValueError('Number of iterations must be greater than 0')
     if prior is not None and (prior <= 0 or prior >= 1):
@@ -70,23 +243,25 @@ def compare_expressions(dataset, expr, contrary_expr, exclude_overlap=True,
     if reduce_larger_set and num_iterations < 2:
         raise ValueError('The larger study set is reduced, but the number of '
                          'iteration is too small')
+    if batch_size < 1:
+        raise ValueError('Batch size must be greater than 0')
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format "%s". Options are: %s'
+                         % (output_format, ', '.join(OUTPUT_FORMATS)))
     if not reduce_larger_set:
         num_iterations = 1
 
-    # get studies
-    study_sets = []
+    # exclude overlapping studies (same as the expression "(expr) &~ (contrary_expr)")
     if exclude_overlap:
         expr, contrary_expr = '(%s) &~ (%s)' % (expr, contrary_expr), \
                               '(%s) &~ (%s)' % (contrary_expr, expr)
-    for expression in (expr, contrary_expr):
-        try:
-            studies = dataset.get_studies(expression=expression)
-        except AttributeError:  # in case expression somehow doesn't work
-            studies = dataset.get_studies(features=expression)
+        overlap = set(study_sets[0]) & set(study_sets[1])
+        study_sets = [[study for study in study_set if study not in overlap]
+                      for study_set in study_sets]
+    for expression, studies in zip((expr, contrary_expr), study_sets):
         if len(studies) == 0:
             raise ValueError('No study in the database is associated with "'
                              + expression + '"')
-        study_sets.append(studies)
 
     # get study set sizes
     if reduce_larger_set:
@@ -99,30 +274,32 @@ def compare_expressions(dataset, expr, contrary_expr, exclude_overlap=True,
     else:
         sizes = [str(len(study_set)) for study_set in study_sets]
 
-    meta_lists = [[], []] if two_way else [[]]
-    for i in range(num_iterations):
-        # reduce size
-        if reduce_larger_set:
-            new_study_sets = even_study_set_size(study_sets)
-        else:
-            new_study_sets = study_sets
-
-        # meta analysis
-        expr_meta = MetaAnalysisPlus(info=[], dataset=dataset,
-                                     ids=new_study_sets[0],
-                                     ids2=new_study_sets[1],
-                                     prior=prior, q=fdr)
-        meta_lists[0].append(expr_meta)
-
-        if two_way:
-            contrary_expr_meta = MetaAnalysisPlus(info=[], dataset=dataset,
-                                                  ids=new_study_sets[1],
-                                                  ids2=new_study_sets[0],
-                                                  prior=prior, q=fdr)
-            meta_lists[1].append(contrary_expr_meta)
-
-    # get mean images
-    mean_metas = [MetaAnalysisPlus.mean(meta_list) for meta_list in meta_lists]
+    # meta analyses, or their results from the result cache if they are reproducible
+    cache = getattr(dataset, 'result_cache', None)
+    key = None
+    if cache is not None and (seed is not None or not reduce_larger_set or
+                              len(set(map(len, study_sets))) == 1):
+        # the sets are not sorted, since the samples depend on the order of studies
+        key = cache.make_result_key(dataset, 'comparison', study_sets, reduce_larger_set,
+                                    num_iterations, two_way, prior, fdr, batch_size, seed,
+                                    result_images, extra_priors, extra_fdrs)
+    results = cache.get_results(key) if key is not None else None
+    if results is None:
+        running_means = _resample_meta_images(dataset, study_sets, num_iterations,
+                                              reduce_larger_set, two_way, prior, fdr,
+                                              batch_size, seed, n_jobs, result_images,
+                                              extra_priors, extra_fdrs, pool, col_index)
+        results = [(running_mean.mean(),
+                    running_mean.std_error() if running_mean.count > 1 else None)
+                   for running_mean in running_means]
+        if key is not None:
+            cache.put_results(key, results)
+    mean_metas = []
+    for images, std_errors in results:
+        mean_meta = MetaAnalysisPlus(info=[], dataset=dataset, images=images)
+        if std_errors is not None:
+            mean_meta.std_errors = std_errors
+        mean_metas.append(mean_meta)
 
     # add info
     mean_metas[0].info = MetaAnalysisPlus.Info(
@@ -140,69 +317,119 @@ def compare_expressions(dataset, expr, contrary_expr, exclude_overlap=True,
              ('number of iterations', num_iterations)] + list(extra_info))
 
     # save results
-    if save_files:
+    if save_files and output_format == 'hdf5':
+        if result_file is None:
+            result_file = make_result_file(outpath, mean_metas[0].info.name)
+        with ResultStore(result_file, 'a') as store:
+            for mean_meta in mean_metas:
+                store.save(mean_meta, result_group, image_names)
+    elif save_files:
         outdir = MetaAnalysisPlus.make_result_dir(outpath, mean_metas[0].info.name)
         for mean_meta in mean_metas:
             filename = mean_meta.info.name + '.csv'
             mean_meta.save_csv(os.path.join(outdir, filename),
                                image_names=image_names)
             mean_meta.save_images(outpath=outdir)
+            if mean_meta.std_errors is not None:
+                MetaAnalysisPlus(mean_meta.info, dataset, images=mean_meta.std_errors) \
+                    .save_images(postfix='std_error', outpath=outdir)
 
     return mean_metas if two_way else mean_metas[0]
 
 
 def compare_multiple(dataset, expr_list, image_name, lower_thr=None, upper_thr=None,
-                     extra_info=(), save_files=True, outpath='.', **kwargs):
+                     extra_info=(), save_files=True, outpath='.', output_format='nifti',
+                     **kwargs):
     """
     (Battle Royale) Do all possible pairwise comparison within the given term group,
     and then create a winning map.
     See compare_expressions and MetaAnalysisPlus.winnings for more info.
+    The winning map of each expression is counted as each pairwise comparison is
+    done, and the pairwise results are released once they have been saved, so
+    memory use grows with the number of expressions rather than of pairs.
     If there's any conflict between the prior and fdr in image_name and kwargs, info
     in image_name will be used.
 
+    :param output_format: 'nifti' to save csv files and NIfTI images in a new
+                          directory, or 'hdf5' to save all results (including the
+                          pairwise comparisons) in one new HDF5 file
     :param kwargs: anything else passed to the pairwise compare_expressions function
+                   (except two_way, since each pair is compared in both directions).
+                   If a seed is given, each pair gets its own seed derived from it.
+                   The worker processes (n_jobs) are started once for all pairs
     :return: a dictionary {expression: MetaAnalysisPlus winning map}
     """
+    if len(expr_list) < 2:
+        raise ValueError('At least two expressions are needed for a comparison')
+
     # result name & path
     name = '_'.join([AnalysisInfo.shorten_expr(expr) for expr in expr_list])
-    outpath = MetaAnalysisPlus.make_result_dir(outpath, name)
-    pair_outpath = os.path.join(outpath, 'pairwise_comparisons')
-    os.mkdir(pair_outpath)
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format "%s". Options are: %s'
+                         % (output_format, ', '.join(OUTPUT_FORMATS)))
+    result_file = pair_outpath = None
+    if output_format == 'hdf5':
+        result_file = make_result_file(outpath, name)
+    else:
+        outpath = MetaAnalysisPlus.make_result_dir(outpath, name)
+        pair_outpath = os.path.join(outpath, 'pairwise_comparisons')
+        os.mkdir(pair_outpath)
 
-    # pairwise comparisons
+    # studies of each expression
     img_info = AnalysisInfo.get_num_from_name(image_name)
     kwargs.update(img_info)
-    pair_metas = {}
-    for expr in expr_list:
-        pair_metas[expr] = []
-        for contra_expr in expr_list:
-            if expr == contra_expr:
-                continue
-            meta = compare_expressions(dataset, expr, contra_expr, two_way=False,
-                                       extra_info=extra_info, save_files=save_files,
-                                       outpath=pair_outpath, **kwargs)
-            pair_metas[expr].append(meta)
+    study_sets = {expr: _get_studies(dataset, expr) for expr in expr_list}
+
+    # pairwise comparisons: each pair is compared once in both directions
+    pairs = [(expr_list[i], expr_list[j]) for i in range(len(expr_list))
+             for j in range(i + 1, len(expr_list))]
+    seed = kwargs.pop('seed', None)
+    pair_seeds = iteration_seeds(seed, len(pairs)) if seed is not None \
+        else [None] * len(pairs)
+    counters = {expr: WinningCounter(lower_thr, upper_thr, len(expr_list) - 1)
+                for expr in expr_list}
+    contrary_exprs = {expr: {} for expr in expr_list}  # in the info of pairwise results
+    # all pairs share the same worker processes and image data
+    image_data, col_index = _study_image_data(dataset, set().union(*study_sets.values()))
+    with MatrixPool(image_data, kwargs.pop('n_jobs', 1)) as pool:
+        for (expr, contra_expr), pair_seed in zip(pairs, pair_seeds):
+            metas = _compare_study_sets(dataset, expr, contra_expr,
+                                        [study_sets[expr], study_sets[contra_expr]],
+                                        two_way=True, extra_info=extra_info,
+                                        save_files=save_files, outpath=pair_outpath,
+                                        seed=pair_seed, output_format=output_format,
+                                        result_file=result_file,
+                                        result_group='pairwise_comparisons',
+                                        # only the winnings image is needed if nothing
+                                        # is saved
+                                        result_images=None if save_files else [image_name],
+                                        pool=pool, col_index=col_index, **kwargs)
+            for meta, (e1, e2) in zip(metas, ((expr, contra_expr), (contra_expr, expr))):
+                counters[e1].add(meta.images[image_name])
+                contrary_exprs[e1][e2] = meta.info['contrary expression']
+            del metas, meta  # already saved
 
     # winning maps
     win_metas = {}
-    for expr in pair_metas:
+    for expr in expr_list:
         # info
         info = [('expression', expr)]
-        info += [('contrary expression %d' % (i + 1),
-                  pair_metas[expr][i].info['contrary expression'])
-                 for i in range(len(expr_list) - 1)]
+        info += [('contrary expression %d' % (i + 1), contrary_exprs[expr][contra_expr])
+                 for i, contra_expr in enumerate(e for e in expr_list if e != expr)]
         info += extra_info
         # winnings
-        meta = MetaAnalysisPlus.winnings(pair_metas[expr], image_name, lower_thr,
-                                         upper_thr, expression=expr, extra_info=info)
+        meta = MetaAnalysisPlus.winnings_from_counter(counters.pop(expr), dataset,
+                                                      image_name, expression=expr,
+                                                      extra_info=info)
         win_metas[expr] = meta
 
-    # counts of winnings
-    win_meta_imgs = np.array([meta.images['winnings'] for meta in win_metas.values()])
-    win_counts = np.apply_along_axis(lambda x: np.bincount(x, minlength=len(expr_list)),
-                                     axis=0, arr=win_meta_imgs).astype(np.int32)
+    # counts of winnings: how many winning maps have each value at each voxel
+    n_voxels = len(next(iter(win_metas.values())).images['winnings'])
+    win_counts = np.zeros((len(expr_list), n_voxels), dtype=np.int32)
+    for meta in win_metas.values():
+        win_counts[meta.images['winnings'], np.arange(n_voxels)] += 1
     win_counts_meta_imgs = {str(col): win_counts[col] for col in range(len(expr_list))}
-    win_counts_info = [('expressions', ', '.join(expr_list))] + extra_info
+    win_counts_info = [('expressions', ', '.join(expr_list))] + list(extra_info)
     win_counts_info.append(('description',
                             'This file and corresponding NIFTI images show how many '
                             'winning maps have each possible value at each voxel. '
@@ -216,7 +443,13 @@ def compare_multiple(dataset, expr_list, image_name, lower_thr=None, upper_thr=N
     win_counts_meta = MetaAnalysisPlus(win_counts_info, dataset, images=win_counts_meta_imgs)
 
     # save images & csv
-    if save_files:
+    if save_files and output_format == 'hdf5':
+        with ResultStore(result_file, 'a') as store:
+            for win_meta in win_metas.values():
+                store.save(win_meta)
+            win_counts_meta.info.set_name(name + '_winning_counts')
+            store.save(win_counts_meta)
+    elif save_files:
         # winnings
         for win_meta in win_metas.values():
             filename = win_meta.info.name + '.csv'
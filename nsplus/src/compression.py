@@ -0,0 +1,232 @@
+from .parallel import get_num_workers
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
+import lzma
+import struct
+import zlib
+
+BLOCK_MAGIC = b'NSPLUS-BLOCKS\x01'
+GZIP_MAGIC = b'\x1f\x8b'
+_BLOCK_HEADER = struct.Struct('<II')  # compressed size, uncompressed size
+
+# codec name: (id in block files, compress(data, level), decompress(data), default level)
+_BLOCK_CODECS = {
+    'zlib': (1, zlib.compress, zlib.decompress, 6),
+    'lzma': (2, lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 6),
+}
+CODECS = ('gzip',) + tuple(sorted(_BLOCK_CODECS))
+
+
+class BlockWriter(io.RawIOBase):
+    """
+    Write a stream compressed in independent blocks, which are compressed by a pool
+    of threads (zlib and lzma release the GIL) and written in order.
+    """
+    def __init__(self, fileobj, codec='zlib', level=None, threads=None,
+                 block_size=2 ** 22):
+        super(BlockWriter, self).__init__()
+        codec_id, compress, _, default_level = _BLOCK_CODECS[codec]
+        self._file = fileobj
+        self._compress = compress
+        self._level = default_level if level is None else level
+        self._threads = get_num_workers(threads)
+        self._executor = ThreadPoolExecutor(max_workers=self._threads)
+        self._pending = deque()  # (uncompressed size, future of compressed block)
+        self._buffer = bytearray()
+        self.block_size = block_size
+        self._file.write(BLOCK_MAGIC + bytes([codec_id]))
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        size = len(view)
+        if len(self._buffer) + size < self.block_size:
+            self._buffer += view
+            return size
+        # complete the buffered block, then submit whole blocks without copying them
+        pos = self.block_size - len(self._buffer)
+        self._buffer += view[:pos]
+        self._submit(bytes(self._buffer))
+        while size - pos >= self.block_size:
+            self._submit(view[pos:pos + self.block_size].tobytes())
+            pos += self.block_size
+        self._buffer = bytearray(view[pos:])
+        return size
+
+    def _submit(self, block):
+        self._pending.append((len(block),
+                              self._executor.submit(self._compress, block, self._level)))
+        while len(self._pending) > 2 * self._threads:  # limit memory use
+            self._write_next()
+
+    def _write_next(self):
+        size, future = self._pending.popleft()
+        block = future.result()
+        self._file.write(_BLOCK_HEADER.pack(len(block), size))
+        self._file.write(block)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if len(self._buffer) > 0:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._write_next()
+            self._file.write(_BLOCK_HEADER.pack(0, 0))  # end of stream
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+            super(BlockWriter, self).close()
+
+
+class BlockReader(io.RawIOBase):
+    """
+    Read a stream written by BlockWriter, decompressing the blocks ahead of time in
+    a pool of threads.
+    """
+    def __init__(self, fileobj, threads=None, close_file=True):
+        """
+        :param close_file: (boolean) whether to close fileobj when this is closed
+        """
+        super(BlockReader, self).__init__()
+        self._file = fileobj
+        self._close_file = close_file
+        header = fileobj.read(len(BLOCK_MAGIC) + 1)
+        if header[:len(BLOCK_MAGIC)] != BLOCK_MAGIC:
+            raise IOError('Not a block-compressed file')
+        codec_ids = {codec_id: decompress
+                     for codec_id, _, decompress, _ in _BLOCK_CODECS.values()}
+        if header[-1] not in codec_ids:
+            raise IOError('Unknown compression codec %d' % header[-1])
+        self._decompress = codec_ids[header[-1]]
+        self._threads = get_num_workers(threads)
+        self._executor = ThreadPoolExecutor(max_workers=self._threads)
+        self._pending = deque()  # futures of decompressed blocks
+        self._current = memoryview(b'')
+        self._end = False
+
+    def readable(self):
+        return True
+
+    def _decompress_block(self, data, size):
+        block = self._decompress(data)
+        if len(block) != size:
+            raise IOError('Corrupted block-compressed file')
+        return block
+
+    def _read_ahead(self):
+        while not self._end and len(self._pending) < 2 * self._threads:
+            header = self._file.read(_BLOCK_HEADER.size)
+            if len(header) < _BLOCK_HEADER.size:
+                raise EOFError('Block-compressed file ended unexpectedly')
+            compressed_size, size = _BLOCK_HEADER.unpack(header)
+            if size == 0:
+                self._end = True
+                break
+            data = self._file.read(compressed_size)
+            self._pending.append(self._executor.submit(self._decompress_block, data, size))
+
+    def readinto(self, buffer):
+        while len(self._current) == 0:
+            self._read_ahead()
+            if not self._pending:
+                return 0
+            self._current = memoryview(self._pending.popleft().result())
+        buffer = memoryview(buffer).cast('B')
+        size = min(len(buffer), len(self._current))
+        buffer[:size] = self._current[:size]
+        self._current = self._current[size:]
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown()
+        if self._close_file:
+            self._file.close()
+        super(BlockReader, self).close()
+
+
+class _StreamReader(io.RawIOBase):
+    """
+    Read another binary file object, without closing it when this is closed.
+    """
+    def __init__(self, fileobj):
+        super(_StreamReader, self).__init__()
+        self._file = fileobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self._file.readinto(buffer)
+
+
+def detect_codec(filename):
+    """
+    :param filename: a file name, or a seekable binary file object, which is read
+                     from its current position and then moved back there
+    :return: 'gzip', 'zlib' or 'lzma' if the file is compressed with one of them,
+             or None otherwise
+    """
+    if isinstance(filename, str):
+        with open(filename, 'rb') as infile:
+            header = infile.read(len(BLOCK_MAGIC) + 1)
+    else:
+        start = filename.tell()
+        header = filename.read(len(BLOCK_MAGIC) + 1)
+        filename.seek(start)
+    if header.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if header[:len(BLOCK_MAGIC)] == BLOCK_MAGIC:
+        for codec, (codec_id, _, _, _) in _BLOCK_CODECS.items():
+            if header[-1] == codec_id:
+                return codec
+    return None
+
+
+def open_file(filename, mode='rb', codec=None, level=None, threads=None,
+              block_size=2 ** 22):
+    """
+    Open a file for streaming through a compression codec.
+    :param filename: a file name, or, when reading, a seekable binary file object
+                     (e.g. from pkg_resources.resource_stream), which is read from
+                     its current position and is not closed with the returned file
+    :param mode: 'rb' or 'wb'. When reading, the codec is detected from the file
+    :param codec: None (no compression), 'gzip', or 'zlib' or 'lzma' to compress the
+                  file in independent blocks with multiple threads
+    :param level: compression level (defaults: 9 for gzip, 6 for zlib and lzma)
+    :param threads: number of threads for block compression (default: one per CPU)
+    :param block_size: (int) uncompressed size of each block in bytes
+    :return: a binary file object
+    """
+    if mode not in ('rb', 'wb'):
+        raise ValueError('mode must be "rb" or "wb"')
+    if mode == 'rb':
+        codec = detect_codec(filename)
+    elif codec is not None and codec not in CODECS:
+        raise ValueError('Unknown codec "%s". Options are: %s' % (codec, ', '.join(CODECS)))
+
+    if mode == 'rb' and not isinstance(filename, str):  # a file object
+        if codec == 'gzip':
+            return gzip.GzipFile(fileobj=filename, mode='rb')
+        return io.BufferedReader(BlockReader(filename, threads, close_file=False)
+                                 if codec is not None else _StreamReader(filename),
+                                 buffer_size=block_size)
+    if codec is None:
+        return open(filename, mode)
+    if codec == 'gzip':
+        return gzip.open(filename, mode, compresslevel=9 if level is None else level)
+    if mode == 'rb':
+        return io.BufferedReader(BlockReader(open(filename, 'rb'), threads),
+                                 buffer_size=block_size)
+    return io.BufferedWriter(BlockWriter(open(filename, 'wb'), codec, level, threads,
+                                         block_size), buffer_size=block_size)
@@ -0,0 +1,327 @@
+from .diskcache import load_array
+from .studyindex import StudyIndex, GrowableCSC
+from .compression import open_file
+from collections import OrderedDict
+from functools import partial
+from scipy import sparse
+import neurosynth as ns
+import pandas as pd
+import numpy as np
+import pickle
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import warnings
+
+FORMAT_NAME = 'nsplus-database'
+FORMAT_VERSION = 1
+CUSTOM_TERMS_FORMAT_NAME = 'nsplus-custom-terms'
+CUSTOM_TERMS_FORMAT_VERSION = 1
+
+
+class ColumnarFeatureTable(ns.base.dataset.FeatureTable):
+    """
+    A Neurosynth FeatureTable loaded from a columnar database. The feature weights
+    are kept as a (studies x features) CSC matrix, and the pandas sparse frame that
+    Neurosynth works with is only built when data is first used. Features can be
+    appended without copying the existing ones (see append_features).
+    """
+    _growable = None  # buffers for appending features, if any
+
+    def __init__(self, dataset, ids, names, weights):
+        self.dataset = dataset
+        self.ids = ids
+        self.names = names
+        self.weights = weights
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:  # same as FeatureTable._csr_to_sdf
+            self._data = pd.DataFrame(self.weights.todense(), index=self.ids,
+                                      columns=self.names).to_sparse()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.ids = self.names = self.weights = self._growable = None  # may be outdated
+
+    def append_features(self, names, weights):
+        """
+        Append features as sparse columns, without copying the existing ones.
+        :param names: names of the new features
+        :param weights: a (studies x new features) sparse matrix
+        :return: the weights of all features
+        """
+        if self._growable is None:
+            self._growable = GrowableCSC(self.weights)
+        self.weights = self._growable.append(weights)
+        self.names.extend(names)
+        self._data = None  # rebuilt from the weights when needed
+        return self.weights
+
+    def _sdf_to_csr(self):
+        if self.weights is None:
+            super(ColumnarFeatureTable, self)._sdf_to_csr()
+        # otherwise the columnar arrays are pickled (see __getstate__)
+
+    def _csr_to_sdf(self):
+        if self.weights is None:
+            super(ColumnarFeatureTable, self)._csr_to_sdf()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.weights is not None:
+            state['_data'] = None  # can be rebuilt from the weights
+        state.pop('_growable', None)
+        return state
+
+    @property
+    def feature_names(self):
+        if self.names is not None:
+            return list(self.names)
+        return list(self.data.columns)
+
+
+def is_database_dir(path):
+    return os.path.isfile(os.path.join(path, 'format.json'))
+
+
+def _save_arrays(path, arrays):
+    os.mkdir(path)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), np.asarray(array))
+
+
+def _load_arrays(path, names):
+    return [load_array(os.path.join(path, name + '.npy')) for name in names]
+
+
+def _feature_weights(feature_table):
+    """
+    :return: study IDs, feature names and a (studies x features) CSC matrix of a
+             FeatureTable, whether its data is a pandas frame or the dictionary made
+             by FeatureTable._sdf_to_csr
+    """
+    if getattr(feature_table, 'weights', None) is not None:
+        return feature_table.ids, feature_table.names, feature_table.weights
+    data = feature_table.data
+    if isinstance(data, dict):
+        return data['index'], data['columns'], sparse.csc_matrix(data['values'])
+    index = StudyIndex.from_feature_table(feature_table)
+    return list(index.study_ids), list(data.columns), index.weights
+
+
+def save_database(dataset, path, database_version=None):
+    """
+    Save a Neurosynth Dataset (or DatasetPlus) instance in the columnar format: a
+    directory with the image table and the feature table as raw sparse matrix
+    arrays, the activations as one array per column, and a small metadata pickle
+    (the masker and the transformer). The whole-brain image table is saved.
+    :param path: (string) the directory to create
+    """
+    if os.path.exists(path):
+        raise IOError('%s already exists' % path)
+    image_table = getattr(dataset, 'full_image_table', None) or dataset.image_table
+    activations = dataset.activations
+
+    os.mkdir(path)
+    try:
+        image_data = sparse.csr_matrix(image_table.data)
+        _save_arrays(os.path.join(path, 'image_table'),
+                     {'data': image_data.data, 'indices': image_data.indices,
+                      'indptr': image_data.indptr, 'ids': image_table.ids})
+        ids, names, weights = _feature_weights(dataset.feature_table)
+        _save_arrays(os.path.join(path, 'feature_table'),
+                     {'data': weights.data, 'indices': weights.indices,
+                      'indptr': weights.indptr, 'ids': np.asarray(ids),
+                      'names': np.array(names, dtype=str)})
+        columns = OrderedDict(('column_%d' % i, activations[col].values)
+                              for i, col in enumerate(activations.columns))
+        columns['index'] = activations.index.values
+        _save_arrays(os.path.join(path, 'activations'), columns)
+        with open(os.path.join(path, 'metadata.pkl'), 'wb') as outfile:
+            pickle.dump({'masker': image_table.masker,
+                         'transformer': getattr(dataset, 'transformer', None)},
+                        outfile, -1)
+        # written last, so that a directory without it is never loaded
+        with open(os.path.join(path, 'format.json'), 'w') as outfile:
+            json.dump({'format': FORMAT_NAME, 'format_version': FORMAT_VERSION,
+                       'database_version': database_version,
+                       'r': image_table.r,
+                       'image_table_shape': list(image_data.shape),
+                       'feature_table_shape': list(weights.shape),
+                       'activation_columns': [str(c) for c in activations.columns]},
+                      outfile, indent=2)
+    except Exception:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+
+
+def load_activations(path):
+    """
+    :return: the activations of a columnar database as a pandas data frame
+    """
+    with open(os.path.join(path, 'format.json')) as infile:
+        columns = json.load(infile)['activation_columns']
+    arrays = _load_arrays(os.path.join(path, 'activations'),
+                          ['column_%d' % i for i in range(len(columns))] + ['index'])
+    return pd.DataFrame(OrderedDict(zip(columns, arrays[:-1])), index=arrays[-1],
+                        columns=columns)
+
+
+def load_image_table(path, masker):
+    """
+    :return: the (memory-mapped) image table of a columnar database as a Neurosynth
+             ImageTable
+    """
+    with open(os.path.join(path, 'format.json')) as infile:
+        info = json.load(infile)
+    image_table = ns.base.dataset.ImageTable.__new__(ns.base.dataset.ImageTable)
+    data, indices, indptr, ids = _load_arrays(os.path.join(path, 'image_table'),
+                                              ('data', 'indices', 'indptr', 'ids'))
+    image_table.data = sparse.csr_matrix((data, indices, indptr),
+                                         shape=tuple(info['image_table_shape']),
+                                         copy=False)
+    image_table.ids = ids
+    image_table.masker = masker
+    image_table.r = info['r']
+    return image_table
+
+
+def load_database(path):
+    """
+    Load a database saved by save_database. The image table and the feature table
+    are memory-mapped, so loading is nearly instant and the data is shared with
+    other processes that load the same database. Only the feature table is loaded
+    here; the image table and the activations are loaded when first used.
+    :return: a Neurosynth Dataset instance, with the loaders of its image table and
+             activations in _load_image_table and _load_activations, and the
+             database version in database_version
+    """
+    with open(os.path.join(path, 'format.json')) as infile:
+        info = json.load(infile)
+    if info.get('format') != FORMAT_NAME or info.get('format_version') != FORMAT_VERSION:
+        raise ValueError('%s is not a supported database (format %s, version %s)'
+                         % (path, info.get('format'), info.get('format_version')))
+    with open(os.path.join(path, 'metadata.pkl'), 'rb') as infile:
+        metadata = pickle.load(infile)
+
+    dataset = ns.Dataset.__new__(ns.Dataset)
+    dataset.r = info['r']
+    dataset.transformer = metadata['transformer']
+    dataset.masker = metadata['masker']
+    dataset.database_version = info['database_version']
+
+    data, indices, indptr, ids, names = _load_arrays(
+        os.path.join(path, 'feature_table'), ('data', 'indices', 'indptr', 'ids', 'names'))
+    weights = sparse.csc_matrix((data, indices, indptr),
+                                shape=tuple(info['feature_table_shape']), copy=False)
+    dataset.feature_table = ColumnarFeatureTable(dataset, ids.tolist(), names.tolist(),
+                                                 weights)
+    dataset._load_image_table = partial(load_image_table, path, dataset.masker)
+    dataset._load_activations = partial(load_activations, path)
+    return dataset
+
+
+def save_custom_terms(filename, terms, database_version=None):
+    """
+    Save custom terms to a JSON file, with one term per line so that changes are
+    easy to diff.
+    :param terms: a list of (term, study IDs, frequency)
+    """
+    lines = [json.dumps({'term': term, 'frequency': frequency,
+                         'study_ids': sorted(np.asarray(list(ids)).tolist())})  # no numpy types
+             for term, ids, frequency in terms]
+    header = json.dumps({'format': CUSTOM_TERMS_FORMAT_NAME,
+                         'format_version': CUSTOM_TERMS_FORMAT_VERSION,
+                         'database_version': database_version})
+    temp_filename = filename + '.temp'
+    with open(temp_filename, 'w') as outfile:  # replaced at once to never leave a partial file
+        outfile.write(header[:-1] + ', "terms": [\n')
+        outfile.write(',\n'.join(lines))
+        outfile.write('\n]}\n')
+    os.replace(temp_filename, filename)
+
+
+def load_custom_terms(filename, database_version=None):
+    """
+    :param database_version: the version of the database that the terms will be
+                             added to. A ValueError is raised if the terms were saved
+                             with another database, and a warning is given if only
+                             one of the versions is known
+    :return: a list of (term, study IDs, frequency) saved by save_custom_terms
+    """
+    with open(filename) as infile:
+        info = json.load(infile)
+    if info.get('format') != CUSTOM_TERMS_FORMAT_NAME or \
+            info.get('format_version') != CUSTOM_TERMS_FORMAT_VERSION:
+        raise ValueError('%s is not a supported custom term file (format %s, version %s)'
+                         % (filename, info.get('format'), info.get('format_version')))
+    saved_version = info.get('database_version')
+    if saved_version != database_version:
+        message = 'The custom terms in %s were saved with database version %s, but ' \
+                  'the database version is %s' % (filename, saved_version, database_version)
+        if saved_version is not None and database_version is not None:
+            raise ValueError(message)
+        warnings.warn(message)
+    return [(t['term'], t['study_ids'], t['frequency']) for t in info['terms']]
+
+
+def convert_database(pickle_file, path, database_version=None):
+    """
+    Convert a pickled Neurosynth Dataset (e.g. database_v0.7.pkl.gz), uncompressed
+    or compressed with any codec of DatasetPlus.save, to the columnar format. The
+    feature table is converted without building the pandas sparse frame.
+    """
+    try:
+        with open_file(pickle_file, 'rb') as infile:
+            dataset = pickle.load(infile)
+    except UnicodeDecodeError:
+        with open_file(pickle_file, 'rb') as infile:
+            dataset = pickle.load(infile, encoding='latin')
+    save_database(dataset, path, database_version)
+
+
+_convert_lock = threading.Lock()
+
+
+def columnar_copy(pickle_file, path, database_version=None):
+    """
+    Get the columnar copy of a pickled database, converting it with
+    convert_database the first time. The copy is written to a temporary directory
+    and then renamed to path, so it is made once and never seen half-written, even
+    if several threads or processes ask for it at the same time.
+    :param path: (string) the directory of the columnar copy
+    :return: path
+    """
+    with _convert_lock:
+        if is_database_dir(path):
+            return path
+        temp_dir = tempfile.mkdtemp(prefix='.converting_',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            converted = os.path.join(temp_dir, 'database')
+            convert_database(pickle_file, converted, database_version)
+            try:
+                os.rename(converted, path)
+            except OSError:
+                if not is_database_dir(path):  # not converted by another process
+                    raise
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return path
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        print('Usage: python -m nsplus.src.database <database.pkl.gz> <output directory> '
+              '[database version (default: the version of the default database)]')
+        sys.exit(1)
+    from .datasetplus import DATABASE_VERSION
+    convert_database(sys.argv[1], sys.argv[2],
+                     sys.argv[3] if len(sys.argv) == 4 else DATABASE_VERSION)
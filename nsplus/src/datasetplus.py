@@ -1,36 +1,313 @@
 import os
 import pickle
-import gzip
-import shutil
 import pkg_resources as pkgr
 import neurosynth as ns
-import pandas as pd
 import numpy as np
 import copy
+import re
+import hashlib
+import threading
+import warnings
+from collections import OrderedDict
+from scipy import sparse
+from .studyindex import StudyIndex, ExpressionError
+from .diskcache import DiskCache
+from . import database, compression
+from .userdirs import user_data_dir
+
+
+DATABASE_VERSION = '0.7'
 
 
 class DatasetPlus(ns.Dataset):
     """
     An extension of the Neurosynth Dataset class.
     """
+    query_cache_size = 256  # max number of get_studies results to be memoized
+    image_cache = None  # a DiskCache of masked image tables, if set
+    result_cache = None  # a ResultCache of meta-analysis results, if set
+    database_version = None  # version of the default database, if loaded from it
+    mask_digest = None  # hash of the current mask, if set by mask()
+    # dtype of the image tables, and so of the activation counts and meta-analysis
+    # images, e.g. np.float32 to halve their memory (see image_table)
+    image_dtype = np.float64
+    _load_activations = None  # loads activations on first use, if set
+    _load_image_table = None  # loads the whole-brain image table on first use, if set
+
     def __init__(self, ns_dataset=None, *args, **kwargs):
         """
         :param dataset: initialize from a Neurosynth Dataset instance
         """
+        loading_lock = threading.RLock()  # for data that is loaded on first use
         if ns_dataset:
             self.__dict__ = copy.copy(ns_dataset.__dict__)
+            self._loading_lock = loading_lock
+            if getattr(self, 'feature_table', None) is not None:
+                self.feature_table.dataset = self  # e.g. for its image table
         else:
+            self._loading_lock = loading_lock
             super(DatasetPlus, self).__init__(*args, **kwargs)
         self.custom_terms = {}  # term - study IDs
+        self._custom_term_frequencies = {}  # term - frequency in the feature table
         self.feature_names = set(super(DatasetPlus, self).get_feature_names())
+        self.clear_query_cache()
+        self._study_index = None
+        if self.__dict__.get('full_image_table') is None:  # before applying any ROI
+            self.__dict__['full_image_table'] = self.__dict__.get('image_table')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_study_index'] = None  # rebuilt when needed
+        state['activations'] = self.activations
+        state['full_image_table'] = self.full_image_table
+        state['image_table'] = self.image_table
+        state.pop('_load_activations', None)
+        state.pop('_load_image_table', None)
+        state.pop('_loading_lock', None)
+        # the caches belong to the user rather than the dataset
+        state.pop('image_cache', None)
+        state.pop('result_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._loading_lock = threading.RLock()
+
+    @property
+    def activations(self):
+        """
+        The activation peaks. In a dataset loaded from a columnar database, they are
+        read when first used.
+        """
+        with self._loading_lock:
+            if self.__dict__.get('activations') is None and self._load_activations:
+                self.__dict__['activations'] = self._load_activations()
+        return self.__dict__.get('activations')
+
+    @activations.setter
+    def activations(self, activations):
+        self.__dict__['activations'] = activations
+
+    @property
+    def full_image_table(self):
+        """
+        The whole-brain image table. In a dataset loaded from a columnar database, it
+        is loaded when first used; meanwhile, features and study queries can already
+        be used, and other threads that need the image table wait until it's loaded.
+        """
+        with self._loading_lock:
+            if self.__dict__.get('full_image_table') is None and self._load_image_table:
+                self.__dict__['full_image_table'] = self._load_image_table()
+        return self._as_image_dtype(self.__dict__.get('full_image_table'))
+
+    @full_image_table.setter
+    def full_image_table(self, image_table):
+        self.__dict__['full_image_table'] = image_table
+
+    @property
+    def image_table(self):
+        """
+        The image table of the current mask (the whole-brain image table if no ROI
+        has been applied). Its data is converted to image_dtype when it's first used
+        with another dtype; the activations are 0s and 1s, so the conversion is
+        exact, and counts of studies are exact in float32 up to 2^24 studies.
+        """
+        image_table = self.__dict__.get('image_table')
+        return self.full_image_table if image_table is None \
+            else self._as_image_dtype(image_table)
+
+    @image_table.setter
+    def image_table(self, image_table):
+        self.__dict__['image_table'] = image_table
+
+    def _as_image_dtype(self, image_table):
+        if image_table is not None and image_table.data.dtype != self.image_dtype:
+            with self._loading_lock:
+                if image_table.data.dtype != self.image_dtype:
+                    image_table.data = image_table.data.astype(self.image_dtype)
+        return image_table
+
+    def finish_loading(self):
+        """
+        Load the data that would otherwise be loaded on first use, and build the
+        study index. This is meant to run in a background thread after loading a
+        columnar database, so that analyses don't wait for the data later.
+        """
+        for name in ('study_index', 'full_image_table', 'activations'):
+            getattr(self, name)  # each is loaded or built on first use
+
+    # Study queries #
+
+    def get_studies(self, features=None, expression=None, mask=None, peaks=None,
+                    frequency_threshold=0.001, activation_threshold=0.0, func=np.sum,
+                    return_type='ids', r=6):
+        """
+        Same as the Neurosynth Dataset.get_studies, except that feature- or
+        expression-only queries are evaluated on a packed bitset index of the
+        feature table (see StudyIndex), and their results are memoized in an LRU
+        cache. Both are reset whenever the feature table changes.
+        Unlike in Neurosynth, feature names in expressions may contain digits.
+        Expressions that the index can't evaluate (e.g. frequency comparisons with
+        '<' or '>') are passed on to Neurosynth.
+        """
+        key = None
+        if mask is None and peaks is None and func is np.sum and return_type == 'ids' \
+                and (features is None) != (expression is None):
+            if expression is not None:
+                key = ('expression', self.normalize_expression(expression),
+                       frequency_threshold)
+            elif isinstance(features, str):
+                key = ('features', (features,), frequency_threshold)
+            else:
+                key = ('features', tuple(sorted(features)), frequency_threshold)
+        if key is not None and key in self._query_cache:
+            self._query_cache_hits += 1
+            self._query_cache.move_to_end(key)
+            return list(self._query_cache[key])
+
+        studies = None
+        if key is not None:
+            try:
+                studies = self.study_index.get_studies(features, expression,
+                                                       frequency_threshold)
+            except ExpressionError:
+                pass
+        if studies is None:
+            studies = super(DatasetPlus, self).get_studies(
+                features=features, expression=expression, mask=mask, peaks=peaks,
+                frequency_threshold=frequency_threshold,
+                activation_threshold=activation_threshold, func=func,
+                return_type=return_type, r=r)
+
+        if key is not None:
+            self._query_cache_misses += 1
+            self._query_cache[key] = tuple(studies)
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)  # least recently used
+        return studies
+
+    @property
+    def study_index(self):
+        """
+        The StudyIndex of the current feature table, built on first use
+        """
+        if self._study_index is None:
+            self._study_index = StudyIndex.from_feature_table(self.feature_table)
+        return self._study_index
+
+    @staticmethod
+    def normalize_expression(expression):
+        """
+        Remove whitespace that doesn't change the meaning of an expression
+        """
+        expression = re.sub(r'\s+', ' ', expression.strip())
+        # around operators, but not inside '&~' ('& ~' is not an operator)
+        return re.sub(r' ?(&~|[()|]|&(?! ?~)) ?', r'\1', expression)
+
+    def clear_query_cache(self):
+        self._query_cache = OrderedDict()  # (type, query, threshold) - study IDs
+        self._query_cache_hits = 0
+        self._query_cache_misses = 0
+
+    def query_cache_info(self):
+        """
+        :return: a dictionary of the number of hits and misses of the get_studies
+                 cache, its max size and its current size
+        """
+        return {'hits': self._query_cache_hits, 'misses': self._query_cache_misses,
+                'maxsize': self.query_cache_size, 'currsize': len(self._query_cache)}
+
+    def add_features(self, *args, **kwargs):
+        self.clear_query_cache()  # cached results may be outdated
+        self._study_index = None
+        super(DatasetPlus, self).add_features(*args, **kwargs)
+
+    # Masks #
 
     def mask(self, mask_file=None):
+        """
+        Restrict the image table to the voxels in a mask (e.g. an ROI).
+        The whole-brain image table is kept in full_image_table. If the mask is on
+        the same grid and within the whole-brain mask, the new image table only
+        takes the rows of its voxels from the whole-brain table; otherwise, it is
+        rebuilt from the activation peaks.
+        :param mask_file: a NIfTI file name or NiBabel image, or None to use the
+                          Neurosynth default (whole-brain) mask
+        """
         if mask_file is None:  # use neurosynth default mask
             mask_file = os.path.join(os.path.dirname(os.path.abspath(ns.__file__)),
                                      'resources',
                                      'MNI152_T1_2mm_brain.nii.gz')
-        self.masker = ns.mask.Masker(mask_file)
-        self.create_image_table()
+        masker = ns.mask.Masker(mask_file)
+        rows = self.get_mask_rows(masker)
+        self.masker = masker
+        self.mask_digest = self.get_mask_digest(mask_file)
+        if rows is None:
+            self._load_masked_image_table()
+        elif len(rows) == self.full_image_table.data.shape[0]:
+            self.image_table = self.full_image_table
+            self.masker = self.full_image_table.masker
+        else:
+            self.image_table = copy.copy(self.full_image_table)
+            self.image_table.masker = masker
+            self.image_table.data = self.full_image_table.data[rows]
+
+    def get_mask_rows(self, masker):
+        """
+        :param masker: a Neurosynth Masker instance
+        :return: the rows in the whole-brain image table of the voxels in the mask, or
+                 None if some of the voxels are not in the whole-brain image table
+        """
+        full_masker = self.full_image_table.masker
+        if masker.dims != full_masker.dims or \
+                not np.allclose(masker.volume.affine, full_masker.volume.affine):
+            return None
+        voxels = np.flatnonzero(masker.current_mask)
+        full_voxels = np.flatnonzero(full_masker.current_mask)
+        rows = np.searchsorted(full_voxels, voxels)
+        if np.any(rows == len(full_voxels)) or \
+                not np.array_equal(full_voxels[rows], voxels):
+            return None
+        return rows
+
+    @staticmethod
+    def get_mask_digest(mask_file):
+        """
+        :param mask_file: a NIfTI file name or NiBabel image
+        :return: a hex digest of the contents of the mask
+        """
+        if isinstance(mask_file, str):
+            with open(mask_file, 'rb') as infile:
+                return hashlib.sha1(infile.read()).hexdigest()
+        data = np.ascontiguousarray(np.asanyarray(mask_file.dataobj))
+        return DiskCache.make_key(data.tobytes(), mask_file.shape, mask_file.affine.tobytes())
+
+    def _load_masked_image_table(self):
+        """
+        Rebuild the image table with the current masker, or load it from image_cache.
+        Cache entries are keyed by the mask contents, the database version, the
+        kernel radius and the study IDs.
+        """
+        if self.image_cache is None:
+            self.create_image_table()
+            return
+        key = DiskCache.make_key(self.mask_digest, self.database_version, self.r,
+                                 '\n'.join(str(i) for i in self.full_image_table.ids))
+        arrays = self.image_cache.get(key)
+        if arrays is None:
+            self.create_image_table()
+            data = self.image_table.data
+            self.image_cache.put(key, {'data': data.data, 'indices': data.indices,
+                                       'indptr': data.indptr,
+                                       'shape': np.array(data.shape)})
+        else:
+            self.image_table = copy.copy(self.full_image_table)
+            self.image_table.masker = self.masker
+            self.image_table.data = sparse.csr_matrix(
+                (arrays['data'], arrays['indices'], arrays['indptr']),
+                shape=tuple(arrays['shape']), copy=False)
+
+    # Custom terms #
 
     def add_custom_term_by_ids(self, new_term, study_ids, frequency=0.1):
         """
@@ -51,22 +328,15 @@ class DatasetPlus(ns.Dataset):
                           frequency threshold (0.001).
         :return a subset of the given study_ids that are valid
         """
+        # the term is appended as a sparse column, without copying the feature table
         if new_term in self.feature_names:
             raise ValueError('Term "%s" already exists.' % new_term)
         # get IDs that are in database
-        all_study_ids = self.feature_table.data.index.values
-        valid_ids = set(all_study_ids) & set(study_ids)
-        if len(valid_ids) == 0:
+        rows = self.study_index.get_rows(study_ids)
+        if len(rows) == 0:
             raise ValueError('Must provide a list of valid study IDs')
-        # add to custom term list
-        self.custom_terms[new_term] = valid_ids
-        self.feature_names.add(new_term)
-        # add to database
-        feature_df = pd.DataFrame(np.zeros((len(all_study_ids), 1)),
-                                  index=all_study_ids, columns=[new_term])
-        feature_df[new_term][valid_ids] = frequency
-        self.add_features(feature_df)
-        return valid_ids
+        self._append_custom_terms([new_term], [rows], frequency)
+        return self.custom_terms[new_term]
 
     def add_custom_term_by_expression(self, new_term, expression,
                                       frequency=0.1, **kwargs):
@@ -86,43 +356,218 @@ class DatasetPlus(ns.Dataset):
         study_ids = self.add_custom_term_by_ids(new_term, study_ids, frequency)
         return study_ids
 
+    def add_custom_terms(self, terms, frequency=0.1):
+        """
+        Add many custom terms at once. Each term is associated either with a list of
+        study IDs, or with the studies found with an expression, which may use the
+        terms added before it. Terms that fail validation are skipped.
+
+        :param terms: a list of (term, study IDs or expression string) pairs, or an
+                      OrderedDict. A pair may have a third item, the frequency of
+                      that term
+        :param frequency: see add_custom_term_by_ids
+        :return: an OrderedDict of the added terms and their study IDs, and an
+                 OrderedDict of the skipped terms and the reason why
+        """
+        if isinstance(terms, dict):
+            terms = terms.items()
+        errors = OrderedDict()
+        added = []
+        names, rows, frequencies = [], [], []  # terms to be appended together
+
+        for item in terms:
+            term, studies = item[:2]
+            term = term.strip() if isinstance(term, str) else term
+            if not term:
+                errors[term] = 'Term cannot be empty.'
+                continue
+            if term in self.feature_names or term in names:
+                errors[term] = 'Term "%s" already exists.' % term
+                continue
+            try:
+                if isinstance(studies, str):
+                    if names:  # the expression may use them
+                        self._append_custom_terms(names, rows, frequencies)
+                        names, rows, frequencies = [], [], []
+                    studies = self.get_studies(expression=studies)
+                term_rows = self.study_index.get_rows(studies)
+            except Exception as e:  # e.g. invalid expression
+                errors[term] = str(e)
+                continue
+            if len(term_rows) == 0:
+                errors[term] = 'No valid study IDs.'
+                continue
+            names.append(term)
+            rows.append(term_rows)
+            frequencies.append(item[2] if len(item) > 2 else frequency)
+            added.append(term)
+        if names:
+            self._append_custom_terms(names, rows, frequencies)
+        return OrderedDict((term, self.custom_terms[term]) for term in added), errors
+
+    def import_custom_terms(self, filename, frequency=0.1):
+        """
+        Add custom terms from a text file with one term per line, in the format
+            <term><tab><study IDs separated by commas, or an expression>
+        Empty lines and lines starting with # are ignored. See add_custom_terms.
+        Example:
+            emotional experience\temotion* &~ (emotional faces | emotional stimuli)
+            my studies\t10022492, 10037481
+
+        :return: see add_custom_terms; lines that can't be parsed are reported as
+                 skipped terms named "line <line number>"
+        """
+        terms = []
+        errors = OrderedDict()
+        with open(filename) as infile:
+            for line_i, line in enumerate(infile, 1):
+                line = line.strip()
+                if len(line) == 0 or line.startswith('#'):
+                    continue
+                if '\t' not in line:
+                    errors['line %d' % line_i] = 'Expected a term and a tab.'
+                    continue
+                term, studies = (s.strip() for s in line.split('\t', 1))
+                if re.match(r'^[0-9, ]+$', studies):  # list of IDs
+                    studies = [int(i) for i in studies.split(',') if i.strip()]
+                terms.append((term, studies))
+        added, term_errors = self.add_custom_terms(terms, frequency)
+        errors.update(term_errors)
+        return added, errors
+
+    def _append_custom_terms(self, names, rows, frequency):
+        """
+        Append custom terms to the feature table as sparse columns, and to the study
+        index, without copying or rebuilding either of them.
+        :param names: the new terms
+        :param rows: for each term, an array of the rows of its studies in the index
+        :param frequency: the frequency of all terms, or a list of one per term
+        """
+        index = self.study_index
+        if getattr(self.feature_table, 'weights', None) is None:
+            # keep the feature table as sparse columns from now on
+            self.feature_table = database.ColumnarFeatureTable(
+                self, index.study_ids.tolist(), index.feature_names, index.weights)
+        frequency = np.broadcast_to(frequency, len(names))
+        columns = sparse.csc_matrix(
+            (np.repeat(frequency, [len(r) for r in rows]).astype(np.float64),
+             np.concatenate(rows), np.cumsum([0] + [len(r) for r in rows])),
+            shape=(len(index.study_ids), len(names)))
+        weights = self.feature_table.append_features(names, columns)
+        index.add_features(names, weights)
+        self.clear_query_cache()  # cached results may be outdated
+        for name, term_rows, term_frequency in zip(names, rows, frequency):
+            self.custom_terms[name] = set(index.study_ids[term_rows].tolist())
+            self._custom_term_frequencies[name] = float(term_frequency)
+            self.feature_names.add(name)
+
+    def save_custom_terms(self, filename):
+        """
+        Save the custom terms (their study IDs and frequencies) to a small JSON file,
+        which can be applied to the same database later with load_custom_terms, so
+        that the whole dataset doesn't have to be saved.
+        """
+        database.save_custom_terms(
+            filename, [(term, ids, self._custom_term_frequencies.get(term, 0.1))
+                       for term, ids in self.custom_terms.items()],
+            self.database_version)
+
+    def load_custom_terms(self, filename):
+        """
+        Add the custom terms saved by save_custom_terms. They are appended to the
+        feature table (see add_custom_terms), so the time it takes only depends on
+        the number of custom terms.
+        Terms saved with another version of the database raise a ValueError.
+        :return: see add_custom_terms
+        """
+        return self.add_custom_terms(database.load_custom_terms(filename,
+                                                                self.database_version))
+
+    # Loading & saving #
+
     @classmethod
     def load_default_database(cls):
-        data_file = pkgr.resource_stream('nsplus',
-                                         os.path.join('data',
-                                                      'database_v0.7.pkl.gz'))
-        return cls.load(data_file, compressed=True)
+        """
+        Load the default database from its columnar copy (see save_database), which
+        is made from the packaged pickle the first time, in the user's data
+        directory. If the copy can't be made (e.g. no disk space), the pickle is
+        loaded instead.
+        """
+        pickle_file = os.path.join(pkgr.resource_filename('nsplus', 'data'),
+                                   'database_v%s.pkl.gz' % DATABASE_VERSION)
+        columnar_dir = os.path.join(user_data_dir(), 'database_v%s' % DATABASE_VERSION)
+        try:
+            dataset = cls.load(database.columnar_copy(pickle_file, columnar_dir,
+                                                      DATABASE_VERSION))
+        except (IOError, OSError) as e:
+            warnings.warn('The columnar copy of the database could not be made, so the '
+                          'pickle is loaded instead: %s' % e)
+            dataset = cls.load(pickle_file, compressed=True)
+        dataset.database_version = DATABASE_VERSION
+        return dataset
 
     @classmethod
-    def load(cls, filename, compressed=False):
+    def load(cls, filename, compressed=False, threads=None):
         """
-        Load a pickled Dataset instance from pickle file or compressed pickle file.
+        Load a Dataset instance from a columnar database directory (see
+        save_database), which is memory-mapped, or from a pickle file that is
+        uncompressed or compressed by save().
+        :param filename: a directory or file name, or a seekable binary file object
+                         of a pickle (e.g. from pkg_resources.resource_stream)
+        :param compressed: kept for compatibility; the compression is detected from
+                           the file
+        :param threads: number of threads for decompressing block-compressed files
+                        (default: one per CPU)
         """
-        if compressed:
-            with gzip.open(filename, 'rb') as infile:
-                # this is just copy-pasting from neurosynth code
-                try:
+        if isinstance(filename, str) and os.path.isdir(filename):
+            dataset = database.load_database(filename)
+        else:
+            start = None if isinstance(filename, str) else filename.tell()
+            # this is just copy-pasting from neurosynth code
+            try:
+                with compression.open_file(filename, 'rb', threads=threads) as infile:
                     dataset = pickle.load(infile)
-                except UnicodeDecodeError:
+            except UnicodeDecodeError:
+                if start is not None:  # read the file object again
+                    filename.seek(start)
+                with compression.open_file(filename, 'rb', threads=threads) as infile:
                     dataset = pickle.load(infile, encoding='latin')
 
             if hasattr(dataset, 'feature_table'):
                 dataset.feature_table._csr_to_sdf()
-        else:
-            dataset = super(DatasetPlus, cls).load(filename)
 
         return cls(ns_dataset=dataset)
 
-    def save(self, filename, compress=False):
+    def save_database(self, path):
+        """
+        Save the dataset as a columnar database directory, which loads much faster
+        than a pickle. The whole-brain image table is saved, and custom terms are
+        saved as features.
+        A pickled database can also be converted from the command line:
+            python -m nsplus.src.database database_v0.7.pkl.gz database_v0.7
+        """
+        database.save_database(self, path, self.database_version)
+
+    def save(self, filename, compress=False, codec='gzip', level=None, threads=None):
         """
-        Save the current Dataset instance to a pickle file.
-        Note all custom terms will be lost.
+        Save the current Dataset instance to a pickle file. The pickle is written
+        straight through the compression codec, without a temporary file.
+        Note custom terms are saved as features, and are no longer custom terms when
+        loaded; they can be saved separately with save_custom_terms.
+        :param compress: (boolean) whether to compress the file
+        :param codec: 'gzip', or 'zlib' or 'lzma' to compress the file in independent
+                      blocks with multiple threads (which load() also decompresses with
+                      multiple threads)
+        :param level: compression level (defaults: 9 for gzip, 6 for zlib and lzma)
+        :param threads: number of threads for block compression (default: one per CPU)
         """
-        super(DatasetPlus, self).save(filename)
-        if compress:
-            temp_filename = filename + '.temporarynspfile'
-            os.rename(filename, temp_filename)
-            with open(temp_filename, 'rb') as infile:
-                with gzip.open(filename, 'wb') as outfile:
-                    shutil.copyfileobj(infile, outfile)
-            os.remove(temp_filename)
+        # same as neurosynth's Dataset.save
+        if hasattr(self, 'feature_table'):
+            self.feature_table._sdf_to_csr()
+        try:
+            with compression.open_file(filename, 'wb', codec if compress else None,
+                                       level, threads) as outfile:
+                pickle.dump(self, outfile, -1)
+        finally:
+            if hasattr(self, 'feature_table'):
+                self.feature_table._csr_to_sdf()
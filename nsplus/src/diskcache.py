@@ -0,0 +1,201 @@
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import os
+import shutil
+import uuid
+
+
+def load_array(filename):
+    """
+    Load a .npy file as a copy-on-write memory map, unless it has python objects.
+    The file is shared with other processes until an array is changed, and changes
+    are never written to the file.
+    """
+    try:
+        return np.load(filename, mmap_mode='c')
+    except ValueError:  # python objects can't be memory-mapped
+        return np.load(filename, allow_pickle=True)
+
+
+class DiskCache(object):
+    """
+    A persistent cache of numpy arrays in a directory. Each entry is a subdirectory
+    of .npy files, which are memory-mapped when loaded. When the total size of the
+    entries exceeds max_size, the least recently used entries are removed.
+    """
+    def __init__(self, path, max_size=2 * 2 ** 30):
+        """
+        :param path: (string) the cache directory, which is created if needed
+        :param max_size: (int) max total size of the cache in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        :return: a hex digest that identifies the given parts (strings or bytes)
+        """
+        digest = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = str(part).encode('utf-8')
+            digest.update(hashlib.sha1(part).digest())
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def __contains__(self, key):
+        return os.path.isdir(self._entry_path(key))
+
+    def get(self, key):
+        """
+        :return: a dictionary {name: array} of the entry, or None if it's not cached.
+                 Arrays of numbers are copy-on-write memory maps (see load_array)
+        """
+        entry = self._entry_path(key)
+        try:
+            names = [f[:-4] for f in os.listdir(entry) if f.endswith('.npy')]
+            arrays = {}
+            for name in names:
+                arrays[name] = load_array(os.path.join(entry, name + '.npy'))
+            os.utime(entry, None)  # mark as recently used
+        except (IOError, OSError):  # not cached, or removed by another process
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, key, arrays):
+        """
+        Add an entry to the cache (replacing any entry with the same key), and remove
+        the least recently used entries if the cache is too large.
+        :param arrays: a dictionary {name: array}
+        """
+        # write to a temporary directory first, so that readers never see partial entries
+        temp_entry = self._entry_path('.%s.%s' % (key, uuid.uuid4().hex))
+        os.mkdir(temp_entry)
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_entry, name + '.npy'), np.asarray(array))
+        entry = self._entry_path(key)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(temp_entry, entry)
+            os.utime(entry, None)  # same clock as in get()
+        except OSError:  # added by another process in the meantime
+            shutil.rmtree(temp_entry, ignore_errors=True)
+        self.evict(keep=key)
+
+    def entries(self):
+        """
+        :return: a list of (key, size in bytes, last used time) of all entries, from
+                 the least to the most recently used
+        """
+        result = []
+        for key in os.listdir(self.path):
+            entry = self._entry_path(key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                result.append((key, size, os.path.getmtime(entry)))
+            except OSError:
+                continue
+        return sorted(result, key=lambda e: e[2])
+
+    def size(self):
+        return sum(size for key, size, time in self.entries())
+
+    def info(self):
+        """
+        :return: a dictionary of the number of hits and misses of get(), the max size
+                 of the cache and its current size in bytes, and the number of entries
+        """
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses, 'maxsize': self.max_size,
+                'currsize': sum(size for key, size, time in entries),
+                'entries': len(entries)}
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits in max_size.
+        :param keep: the key of an entry that is never removed
+        """
+        entries = self.entries()
+        total = sum(size for key, size, time in entries)
+        for key, size, time in entries:
+            if total <= self.max_size:
+                break
+            if key != keep:
+                shutil.rmtree(self._entry_path(key), ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        for key, size, time in self.entries():
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+
+
+class ResultCache(DiskCache):
+    """
+    A DiskCache of meta-analysis results, i.e. the images (and standard errors, if
+    any) of one or more MetaAnalysisPlus objects. Entries are keyed by all of the
+    inputs that the results depend on (see make_result_key), and the cached images
+    are copy-on-write memory maps, which can be changed like other arrays.
+    """
+    @staticmethod
+    def make_result_key(dataset, analysis, study_sets, *params):
+        """
+        :param dataset: the dataset analyzed. Its mask, database version, kernel radius
+                        and image table size and dtype are part of the key
+        :param analysis: (string) the name of the analysis
+        :param study_sets: lists of study IDs, in the order that they are used by the
+                           analysis (e.g. sorted, if the order doesn't matter)
+        :param params: other parameters of the analysis (e.g. prior, FDR, iterations)
+        :return: a hex digest that identifies the results
+        """
+        parts = [analysis, getattr(dataset, 'mask_digest', None),
+                 getattr(dataset, 'database_version', None), getattr(dataset, 'r', None),
+                 dataset.image_table.data.shape, dataset.image_table.data.dtype]
+        parts += ['\n'.join(str(study) for study in study_set) for study_set in study_sets]
+        parts += [repr(param) for param in params]
+        return DiskCache.make_key(*parts)
+
+    def get_results(self, key):
+        """
+        :return: a list of (images, standard errors or None) of each result, where
+                 both are dictionaries {image name: array}, or None if not cached
+        """
+        arrays = self.get(key)
+        if arrays is None:
+            return None
+        results = []
+        for i in range(int(arrays['num_results'])):
+            names = arrays['names_%d' % i].tolist()
+            images = OrderedDict((name, arrays['image_%d_%d' % (i, j)])
+                                 for j, name in enumerate(names))
+            std_errors = None
+            if 'std_error_%d_0' % i in arrays:
+                std_errors = OrderedDict((name, arrays['std_error_%d_%d' % (i, j)])
+                                         for j, name in enumerate(names))
+            results.append((images, std_errors))
+        return results
+
+    def put_results(self, key, results):
+        """
+        :param results: a list of (images, standard errors or None), see get_results
+        """
+        arrays = {'num_results': np.array(len(results))}
+        for i, (images, std_errors) in enumerate(results):
+            arrays['names_%d' % i] = np.array(list(images.keys()), dtype=str)
+            for j, name in enumerate(images):
+                arrays['image_%d_%d' % (i, j)] = images[name]
+                if std_errors is not None:
+                    arrays['std_error_%d_%d' % (i, j)] = std_errors[name]
+        self.put(key, arrays)
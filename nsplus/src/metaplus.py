@@ -1,15 +1,217 @@
 from .analysisinfo import AnalysisInfo
+from .batchmeta import LazyImages
+from .parallel import get_num_workers
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import neurosynth as ns
+import nibabel as nb
 import numpy as np
+import csv
+import gzip
 import os
+import threading
 from datetime import datetime
 
 
+def _format_values(values, float_format=None, as_float=False):
+    """
+    :param as_float: (boolean) format integers as floats, as pandas does when they
+                     are in the same data frame column as floats
+    :return: an array of voxel values as strings, formatted like pandas formats python
+             numbers in csv files (NaNs are empty)
+    """
+    if values.dtype.kind != 'f' and not (as_float and values.dtype.kind in 'iu'):
+        return values.astype(str)
+    values = values.astype(np.float64)  # repr of float32 values as python floats
+    strings = values.astype(str) if float_format is None \
+        else np.char.mod(float_format, values)
+    strings[np.isnan(values)] = ''
+    return strings
+
+
+_volume_buffers = threading.local()  # volumes reused by each image writer thread
+
+
+def save_nifti(data, filename, mask_indices, shape, header, compress_level=1):
+    """
+    Same as neurosynth.imageutils.save_img, except that the image is unmasked into a
+    volume that is reused by the current thread, and compressed at a given level.
+    :param data: a 1D array of voxel values
+    :param mask_indices: the flat indices of the voxels in the volume
+    :param shape: shape of the volume
+    :param header: a NIfTI header, which is modified (so don't share it with
+                   other threads)
+    :param compress_level: gzip compression level (1-9), or 0 to write an
+                           uncompressed file
+    """
+    data = np.asarray(data)
+    key = (data.dtype.str, tuple(shape))
+    buffers = getattr(_volume_buffers, 'buffers', None)
+    if buffers is None:
+        buffers = _volume_buffers.buffers = {}
+    if key not in buffers:
+        buffers[key] = (np.zeros(int(np.prod(shape)), dtype=data.dtype), None)
+    volume, last_indices = buffers[key]
+    if last_indices is not mask_indices:  # voxels outside the mask may be set
+        volume.fill(0)
+    volume[mask_indices] = data
+    buffers[key] = (volume, mask_indices)
+
+    header.set_data_dtype(data.dtype)  # Avoids loss of precision
+    header['cal_max'] = data.max()
+    header['cal_min'] = data.min()
+    img = nb.Nifti1Image(volume.reshape(shape), None, header)
+    with (gzip.open(filename, 'wb', compresslevel=compress_level) if compress_level
+          else open(filename, 'wb')) as outfile:
+        img.to_file_map({'image': nb.FileHolder(fileobj=outfile)})
+
+
+class RunningMean(object):
+    """
+    Online mean and variance of images (Welford's algorithm, with Chan et al.'s
+    update for batches), so that results of many iterations can be averaged
+    without keeping all of them in memory. The running sums are kept in float64,
+    and the results are in the dtype of the images (e.g. float32).
+    """
+    def __init__(self):
+        self.count = 0
+        self.dtype = None  # dtype of the results
+        self._means = None
+        self._m2s = None  # sums of squared differences from the means
+
+    def add(self, images):
+        """
+        Fold in the images of one iteration.
+        :param images: a dictionary {image name: 1D array of voxel values}
+        """
+        self.add_batch({name: np.asarray(img)[np.newaxis] for name, img in images.items()})
+
+    def add_batch(self, images):
+        """
+        Fold in the images of a batch of iterations.
+        :param images: a dictionary {image name: (iterations x voxels) array}
+        """
+        batch_count = len(next(iter(images.values())))
+        if batch_count == 0:
+            return
+        batch_means = OrderedDict((name, np.mean(img, axis=0, dtype=np.float64))
+                                  for name, img in images.items())
+        batch_m2s = {name: np.sum((img - batch_means[name]) ** 2, axis=0)
+                     for name, img in images.items()}
+        dtype = np.result_type(*[np.asarray(img).dtype for img in images.values()] +
+                               [np.float32])  # floats, as np.mean returns
+        self._combine(batch_count, batch_means, batch_m2s, dtype)
+
+    def merge(self, other):
+        """
+        Fold in everything that has been added to another RunningMean object.
+        """
+        if other.count > 0:
+            self._combine(other.count, other._means, other._m2s, other.dtype)
+
+    def _combine(self, count, means, m2s, dtype):
+        if self.count == 0:
+            self._means = OrderedDict((name, img.copy()) for name, img in means.items())
+            self._m2s = {name: m2.copy() for name, m2 in m2s.items()}
+            self.count = count
+            self.dtype = dtype
+            return
+        total = self.count + count
+        for name in self._means:
+            delta = means[name] - self._means[name]
+            self._means[name] = self._means[name] + delta * (count / total)
+            self._m2s[name] = self._m2s[name] + m2s[name] + \
+                delta ** 2 * (self.count * count / total)
+        self.count = total
+
+    def mean(self):
+        """
+        :return: a dictionary {image name: mean image}
+        """
+        if self.count == 0:
+            raise ValueError('Nothing has been added')
+        return OrderedDict((name, img.astype(self.dtype)) for name, img in self._means.items())
+
+    def variance(self):
+        """
+        :return: a dictionary {image name: sample variance image}
+        """
+        if self.count < 2:
+            raise ValueError('At least 2 iterations are needed to estimate variance')
+        return OrderedDict((name, (m2 / (self.count - 1)).astype(self.dtype, copy=False))
+                           for name, m2 in self._m2s.items())
+
+    def std_error(self):
+        """
+        :return: a dictionary {image name: standard error of the mean image}
+        """
+        return OrderedDict((name, np.sqrt(m2 / (self.count - 1) / self.count)
+                            .astype(self.dtype, copy=False))
+                           for name, m2 in self._m2s.items())
+
+
+class WinningCounter(object):
+    """
+    Count, at each voxel, the images that pass the threshold criteria of
+    MetaAnalysisPlus.winnings, one image at a time, so that the images don't need
+    to be kept in memory. The counts are a small unsigned integer array (uint16
+    unless more images are counted).
+    """
+    def __init__(self, lower_thr=None, upper_thr=None, max_count=2 ** 16 - 1):
+        """
+        See MetaAnalysisPlus.winnings for the thresholds.
+        :param max_count: (int) the max number of images that will be counted
+        """
+        if lower_thr is None and upper_thr is None:
+            raise ValueError('Must specify at least one threshold')
+        if lower_thr == upper_thr:
+            raise ValueError('Lower and upper thresholds must be different')
+        self.lower_thr = lower_thr
+        self.upper_thr = upper_thr
+        self.dtype = np.promote_types(np.uint16, np.min_scalar_type(max_count))
+        self.counts = None
+        self.connector = ''
+        if upper_thr is None:
+            self.comp_name = '>' + str(lower_thr)
+        elif lower_thr is None:
+            self.comp_name = '<' + str(upper_thr)
+        elif lower_thr < upper_thr:
+            self.comp_name = str(lower_thr) + '-' + str(upper_thr)
+            self.connector = '_'
+        else:
+            self.comp_name = '>' + str(lower_thr) + 'or' + '<' + str(upper_thr)
+
+    def passes(self, img):
+        """
+        :return: a boolean array of whether each voxel of an image passes the criteria
+        """
+        img = np.asarray(img)
+        if self.upper_thr is None:
+            return img > self.lower_thr
+        if self.lower_thr is None:
+            return img < self.upper_thr
+        if self.lower_thr < self.upper_thr:
+            return (img > self.lower_thr) & (img < self.upper_thr)
+        return (self.lower_thr < img) | (img < self.upper_thr)
+
+    def add(self, img):
+        """
+        Count the voxels of an image that pass the criteria.
+        """
+        passed = self.passes(img)
+        if self.counts is None:
+            self.counts = np.zeros(passed.shape, dtype=self.dtype)
+        self.counts += passed
+
+
 class MetaAnalysisPlus(ns.meta.MetaAnalysis):
     """
     An extension of the Neurosynth MetaAnalysis class.
     """
+    std_errors = None  # standard errors of mean images, if averaged across iterations
+    nifti_compress_level = 1  # gzip level of image files, or 0 for uncompressed .nii
+    nifti_threads = None  # max number of threads writing image files (default: CPUs)
 
     def __init__(self, info, dataset, images=None, *args, **kwargs):
         """
@@ -18,6 +220,8 @@ class MetaAnalysisPlus(ns.meta.MetaAnalysis):
         :param images: optionally initialize this object with existing images.
                        If specified, meta-analysis won't run, but an instance of this
                        class will be constructed with the existing images and info
+        Otherwise, the other parameters are those of the Neurosynth MetaAnalysis (ids,
+        ids2, q, prior and min_studies), and the images are computed when first used.
         """
         if isinstance(info, MetaAnalysisPlus.Info):
             self.info = info
@@ -25,11 +229,60 @@ class MetaAnalysisPlus(ns.meta.MetaAnalysis):
             self.info = MetaAnalysisPlus.Info(info)
 
         if images is None:
-            super(MetaAnalysisPlus, self).__init__(dataset, *args, **kwargs)
+            self._analyze(dataset, *args, **kwargs)
         else:
             self.dataset = dataset
             self.images = images
 
+    def _analyze(self, dataset, ids, ids2=None, q=0.01, prior=0.5, min_studies=1):
+        """
+        Same as the Neurosynth MetaAnalysis, except that only the activation counts are
+        computed here, and images is a LazyImages mapping of the same images
+        """
+        self.dataset = dataset
+        image_table = dataset.image_table
+        self.selected_ids = list(set(image_table.ids) & set(ids))
+        self.selected_id_indices = np.isin(image_table.ids, ids)
+        # studies that are not selected, or only those in ids2 if it's given
+        unselected_id_indices = ~self.selected_id_indices if ids2 is None \
+            else np.isin(image_table.ids, ids2)
+        n_active = None
+        if ids2 is not None:  # the two sets may overlap
+            n_active = image_table.data.dot(self.selected_id_indices | unselected_id_indices)
+        self.images = LazyImages(image_table.data.dot(self.selected_id_indices),
+                                 image_table.data.dot(unselected_id_indices),
+                                 len(self.selected_ids), np.sum(unselected_id_indices),
+                                 n_active, prior=prior, q=q, min_studies=min_studies)
+
+    def sweep(self, priors=(), fdrs=()):
+        """
+        Compute the prior-adjusted images with other priors, and the FDR-corrected
+        images with other FDR thresholds, from the activation counts of this
+        meta-analysis, without running it again (see LazyImages.sweep). Add them to
+        the other images with images.update(meta.sweep(...)).
+        :param priors: a list of priors
+        :param fdrs: a list of FDR thresholds
+        :return: an OrderedDict {image name: image}
+        """
+        if not isinstance(self.images, LazyImages):
+            raise ValueError('The activation counts of this meta-analysis are not '
+                             'available (e.g. it is an average across iterations)')
+        return self.images.sweep(priors, fdrs)
+
+    def max_deviation(self, image_names=None):
+        """
+        Validation mode for reduced precision (e.g. a dataset with image_dtype
+        float32): compute the images again in float64 from the activation counts of
+        this meta-analysis, and report how far the images are from them (see
+        LazyImages.max_deviation).
+        :param image_names: the names of the images to compare (default: all)
+        :return: an OrderedDict {image name: max absolute deviation from float64}
+        """
+        if not isinstance(self.images, LazyImages):
+            raise ValueError('The activation counts of this meta-analysis are not '
+                             'available (e.g. it is an average across iterations)')
+        return self.images.max_deviation(image_names)
+
     # Information #
 
     def __str__(self):
@@ -70,12 +323,12 @@ class MetaAnalysisPlus(ns.meta.MetaAnalysis):
 
     # Methods for File Output #
 
-    def _get_images_with_info(self, image_names=None):
+    def _get_image_header(self, image_names=None):
         """
-        Get a pandas data frame of images prefixed with their information
         :param image_names: the names of images to be included in the result.
                             If None, all images will be returned.
-        :return: a pandas data frame of images
+        :return: a list of the ordered image names, and a list of the rows (index
+                 and values) that describe them
         """
         images = set(self.images.keys())
         if image_names is not None:
@@ -91,11 +344,20 @@ class MetaAnalysisPlus(ns.meta.MetaAnalysis):
             else:
                 descriptions.append('')
         if has_description:
-            img_df = pd.DataFrame([descriptions, images],
-                                  index=['image (->)', u'voxel (below)'])
-        else:
-            img_df = pd.DataFrame([images], index=['voxel'])
-        info_df = self.info.as_pandas_df().append(img_df)
+            return images, [('image (->)', descriptions), (u'voxel (below)', images)]
+        return images, [('voxel', images)]
+
+    def _get_images_with_info(self, image_names=None):
+        """
+        Get a pandas data frame of images prefixed with their information
+        :param image_names: the names of images to be included in the result.
+                            If None, all images will be returned.
+        :return: a pandas data frame of images
+        """
+        images, header = self._get_image_header(image_names)
+        img_df = pd.DataFrame([values for index, values in header],
+                              index=[index for index, values in header])
+        info_df = pd.concat([self.info.as_pandas_df(), img_df], sort=False)
         image_df = pd.DataFrame([self.images[img].tolist() for img in images]).T
         return pd.concat([info_df, image_df])
 
@@ -109,31 +371,80 @@ class MetaAnalysisPlus(ns.meta.MetaAnalysis):
         os.mkdir(outdir)
         return outdir
 
-    def save_csv(self, filename, delimiter=',', image_names=None):
+    def save_csv(self, filename, delimiter=',', image_names=None, float_format=None,
+                 chunk_size=2 ** 16):
         """
-        Save the info and images to a csv file.
+        Save the info and images to a csv file. The file is the same as writing
+        _get_images_with_info() with pandas, but the voxel values are formatted
+        straight from the image arrays, a chunk of voxels at a time. As in pandas,
+        integer images are written as floats (e.g. 1.0) if there are float images.
         :param filename: (string) full path and name of the output csv
         :param image_names: images to be included in the csv
+        :param float_format: (string) format of the voxel values of float images,
+                             e.g. '%.6g' (default: the shortest representation that
+                             reads back to the same value, as pandas writes them)
+        :param chunk_size: (int) number of voxels formatted at a time
         """
-        df = self._get_images_with_info(image_names)
-        df.to_csv(filename, sep=delimiter, header=False)
+        images, header = self._get_image_header(image_names)
+        n_columns = max(len(images), 1)
+        with open(filename, 'w', newline='', encoding='utf-8') as outfile:
+            # same dialect as pandas.DataFrame.to_csv
+            writer = csv.writer(outfile, delimiter=delimiter, lineterminator=os.linesep)
+            for key, value in self.info.items():
+                if isinstance(value, float) and np.isnan(value):
+                    value = ''
+                writer.writerow([key, value] + [''] * (n_columns - 1))
+            for index, values in header:
+                writer.writerow([index] + list(values))
+
+            arrays = [np.asarray(self.images[img]) for img in images]
+            as_float = any(array.dtype.kind == 'f' for array in arrays)
+            n_voxels = len(arrays[0]) if len(arrays) > 0 else 0
+            for start in range(0, n_voxels, chunk_size):
+                stop = min(start + chunk_size, n_voxels)
+                columns = [np.arange(start, stop).astype(str)] + \
+                          [_format_values(array[start:stop], float_format, as_float)
+                           for array in arrays]
+                outfile.write(''.join(delimiter.join(row) + os.linesep
+                                      for row in zip(*columns)))
 
-    def save_images(self, prefix=None, postfix='', image_names=None, outpath='.'):
+    def save_images(self, prefix=None, postfix='', image_names=None, outpath='.',
+                    compress_level=None, threads=None):
+        """
+        Save the images to NIfTI files, which are written by a pool of threads.
+        :param compress_level: gzip compression level (1-9), or 0 to save uncompressed
+                               .nii files (default: nifti_compress_level)
+        :param threads: max number of threads (default: nifti_threads)
+        """
+        if compress_level is None:
+            compress_level = self.nifti_compress_level
         images = self.images.keys()
         if image_names is not None:
             images = list(set(image_names) & images)  # find intersection
-        for img_name in images:
-            # file name
-            filename = prefix if prefix is not None else self.info.name
-            if len(filename) > 0 and filename[len(filename) - 1] != '_':
-                filename += '_'
-            if len(postfix) > 0 and postfix[0] != '_':
-                postfix = '_' + postfix
-            filename += img_name + postfix + '.nii.gz'
-            # save image
-            ns.imageutils.save_img(self.images[img_name],
-                                   filename=os.path.join(outpath, filename),
-                                   masker=self.dataset.masker)
+        if len(postfix) > 0 and postfix[0] != '_':
+            postfix = '_' + postfix
+        extension = '.nii.gz' if compress_level else '.nii'
+
+        masker = self.dataset.masker
+        mask_indices = np.flatnonzero(masker.get_mask(in_global_mask=False))
+        shape = masker.volume.shape
+        header = masker.get_header()
+        n_threads = min(get_num_workers(threads if threads is not None
+                                        else self.nifti_threads), max(len(images), 1))
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            futures = []
+            for img_name in images:
+                # file name
+                filename = prefix if prefix is not None else self.info.name
+                if len(filename) > 0 and filename[len(filename) - 1] != '_':
+                    filename += '_'
+                filename += img_name + postfix + extension
+                # save image
+                futures.append(executor.submit(
+                    save_nifti, self.images[img_name], os.path.join(outpath, filename),
+                    mask_indices, shape, header.copy(), compress_level))
+            for future in futures:
+                future.result()  # raise any error
 
     # Methods of operations done on lists of MetaAnalysisPlus objects #
 
@@ -142,19 +453,26 @@ class MetaAnalysisPlus(ns.meta.MetaAnalysis):
         """
         Calculate the mean of each image in the given list.
         Each object in the list should have the same info and image names.
-        :param meta_list: a list of MetaAnalysisPlus objects
-        :return: a MetaAnalysisPlus object that has the mean images
+        The images are averaged one object at a time, so meta_list can also be a
+        generator that creates the objects on the fly.
+        :param meta_list: a list (or any iterable) of MetaAnalysisPlus objects
+        :return: a MetaAnalysisPlus object that has the mean images, and the standard
+                 errors of the means in its std_errors attribute
         """
-        if len(meta_list) == 0:
+        running_mean = RunningMean()
+        first_meta = None
+        for meta in meta_list:
+            if first_meta is None:
+                first_meta = meta
+            running_mean.add(meta.images)
+        if first_meta is None:
             raise ValueError('Empty list')
-        if len(meta_list) == 1:
-            return meta_list[0]
+        if running_mean.count == 1:
+            return first_meta
 
-        # calculate means
-        mean_imgs = {}
-        for img in meta_list[0].images:
-            mean_imgs[img] = np.mean([meta.images[img] for meta in meta_list], axis=0)
-        return cls(meta_list[0].info, meta_list[0].dataset, images=mean_imgs)
+        mean_meta = cls(first_meta.info, first_meta.dataset, images=running_mean.mean())
+        mean_meta.std_errors = running_mean.std_error()
+        return mean_meta
 
     @classmethod
     def winnings(cls, meta_list, image_name, lower_thr=None, upper_thr=None,
@@ -178,39 +496,29 @@ class MetaAnalysisPlus(ns.meta.MetaAnalysis):
 
         :return: a MetaAnalysisPlus object that has the winnings image
         """
-        if lower_thr is None and upper_thr is None:
-            raise ValueError('Must specify at least one threshold')
-        if lower_thr == upper_thr:
-            raise ValueError('Lower and upper thresholds must be different')
-
-        src_imgs = np.array([meta.images[image_name] for meta in meta_list])
+        counter = WinningCounter(lower_thr, upper_thr, len(meta_list))
+        for meta in meta_list:
+            counter.add(meta.images[image_name])
+        return cls.winnings_from_counter(counter, meta_list[0].dataset, image_name,
+                                         expression, extra_info)
 
-        # calculate winnings
-        connector = ''
-        if upper_thr is None:
-            winnings = np.sum(src_imgs > lower_thr, axis=0)
-            comp_name = '>' + str(lower_thr)
-        elif lower_thr is None:
-            winnings = np.sum(src_imgs < upper_thr, axis=0)
-            comp_name = '<' + str(upper_thr)
-        else:
-            if lower_thr < upper_thr:
-                winnings = np.sum((src_imgs > lower_thr) &
-                                  (src_imgs < upper_thr), axis=0)
-                comp_name = str(lower_thr) + '-' + str(upper_thr)
-                connector = '_'
-            else:
-                winnings = np.sum((lower_thr < src_imgs) |
-                                  (src_imgs < upper_thr), axis=0)
-                comp_name = '>' + str(lower_thr) + 'or' + '<' + str(upper_thr)
-        winnings = winnings.astype(np.int32)  # convert to signed int (NIFTI_TYPE_INT32)
+    @classmethod
+    def winnings_from_counter(cls, counter, dataset, image_name, expression=None,
+                              extra_info=()):
+        """
+        Same as winnings, but the images have already been counted by a
+        WinningCounter (e.g. as each of them was computed).
+        :return: a MetaAnalysisPlus object that has the winnings image
+        """
+        # convert to signed int (NIFTI_TYPE_INT32)
+        winnings = counter.counts.astype(np.int32)
 
         # info & file name
-        info = [('based on', image_name), ('criterion', comp_name)]
+        info = [('based on', image_name), ('criterion', counter.comp_name)]
         info += extra_info
         if expression:
             info = cls.Info(info)
             info.set_name(AnalysisInfo.shorten_expr(expression) + '_' +
-                          image_name + connector + comp_name)
+                          image_name + counter.connector + counter.comp_name)
 
-        return cls(info, meta_list[0].dataset, images={'winnings': winnings})
+        return cls(info, dataset, images={'winnings': winnings})
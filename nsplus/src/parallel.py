@@ -0,0 +1,174 @@
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+import numpy as np
+import os
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+
+def get_num_workers(n_jobs):
+    """
+    :param n_jobs: (int) number of worker processes; -1 (or None) means one per CPU,
+                   and other negative numbers mean all CPUs but (-n_jobs - 1) of them
+    :return: the actual number of worker processes
+    """
+    num_cpus = os.cpu_count() or 1
+    if n_jobs is None:
+        return num_cpus
+    if n_jobs == 0:
+        raise ValueError('n_jobs cannot be 0')
+    if n_jobs < 0:
+        return max(num_cpus + 1 + n_jobs, 1)
+    return n_jobs
+
+
+class SharedCSRMatrix(object):
+    """
+    A scipy CSR matrix (e.g. an image table) placed in shared memory, so that
+    worker processes can attach to it instead of receiving a pickled copy.
+    On python < 3.8, the matrix is copied to each worker once instead.
+    """
+    def __init__(self, matrix):
+        matrix = sparse.csr_matrix(matrix)
+        self.shape = matrix.shape
+        self._blocks = []
+        self._arrays = {}
+        for name in ('data', 'indices', 'indptr'):
+            array = getattr(matrix, name)
+            if shared_memory is None or array.nbytes == 0:
+                self._arrays[name] = array
+                continue
+            block = shared_memory.SharedMemory(create=True, size=array.nbytes)
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+            self._blocks.append(block)
+            self._arrays[name] = (block.name, array.shape, array.dtype.str)
+
+    def handle(self):
+        """
+        :return: a small picklable object that can be passed to attach()
+        """
+        return self.shape, self._arrays
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def attach(handle):
+        """
+        :param handle: returned by SharedCSRMatrix.handle()
+        :return: a CSR matrix using the shared buffers, and the list of attached
+                 shared memory blocks (which have to be kept open while the
+                 matrix is in use, and closed afterwards)
+        """
+        shape, arrays = handle
+        blocks = []
+        csr_arrays = []
+        for name in ('data', 'indices', 'indptr'):
+            array = arrays[name]
+            if isinstance(array, tuple):
+                block_name, array_shape, dtype = array
+                block = shared_memory.SharedMemory(name=block_name)
+                blocks.append(block)
+                array = np.ndarray(array_shape, np.dtype(dtype), buffer=block.buf)
+            csr_arrays.append(array)
+        return sparse.csr_matrix(tuple(csr_arrays), shape=shape, copy=False), blocks
+
+
+_worker_state = {}
+
+
+def _init_worker(handle):
+    _worker_state['handle'] = handle
+
+
+def _call_with_matrix(args):
+    func, func_args = args
+    matrix, blocks = SharedCSRMatrix.attach(_worker_state['handle'])
+    result = func(matrix, *func_args)
+    del matrix  # release the shared buffers, so that the blocks can be closed
+    for block in blocks:
+        block.close()
+    return result
+
+
+class MatrixPool(object):
+    """
+    A pool of worker processes that share one matrix (e.g. an image table), so that
+    functions can be mapped over it many times without starting new processes or
+    copying the matrix again. The processes and the shared copy of the matrix are
+    only created when they are first needed.
+    """
+    def __init__(self, matrix, n_jobs=1):
+        """
+        :param matrix: a scipy sparse matrix
+        :param n_jobs: number of worker processes (see get_num_workers)
+        """
+        self.matrix = matrix
+        self.num_workers = get_num_workers(n_jobs)
+        self._shared_matrix = None
+        self._executor = None
+
+    def map(self, func, arg_list):
+        """
+        Call func(matrix, *args) for each args in arg_list, in the worker processes
+        if there are more than one of them and more than one call.
+        :param func: a picklable (module-level) function
+        :param arg_list: a list of argument tuples
+        :return: a generator of the results, in the same order as arg_list
+        """
+        if self.num_workers <= 1 or len(arg_list) <= 1:
+            for args in arg_list:
+                yield func(self.matrix, *args)
+            return
+
+        if self._executor is None:
+            self._shared_matrix = SharedCSRMatrix(self.matrix)
+            self._executor = ProcessPoolExecutor(max_workers=self.num_workers,
+                                                 initializer=_init_worker,
+                                                 initargs=(self._shared_matrix.handle(),))
+        for result in self._executor.map(_call_with_matrix,
+                                         [(func, args) for args in arg_list]):
+            yield result
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._shared_matrix is not None:
+            self._shared_matrix.close()
+            self._shared_matrix = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def map_with_matrix(func, matrix, arg_list, n_jobs=1):
+    """
+    Call func(matrix, *args) for each args in arg_list, using a pool of worker
+    processes if n_jobs != 1. The matrix is shared with the workers when they
+    start, rather than sent along with every call. Use a MatrixPool instead to
+    map several times over the same matrix.
+    :param func: a picklable (module-level) function
+    :param matrix: a scipy sparse matrix
+    :param arg_list: a list of argument tuples
+    :param n_jobs: number of worker processes (see get_num_workers)
+    :return: a generator of the results, in the same order as arg_list
+    """
+    num_workers = min(get_num_workers(n_jobs), len(arg_list))
+    with MatrixPool(matrix, max(num_workers, 1)) as pool:
+        for result in pool.map(func, arg_list):
+            yield result
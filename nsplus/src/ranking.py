@@ -1,7 +1,7 @@
 import numpy as np
 import pandas as pd
-from scipy.stats import rankdata
-from .singleterm import analyze_all_terms
+from .singleterm import all_terms_images
+from .metaplus import MetaAnalysisPlus
 from .analysisinfo import AnalysisInfo
 
 
@@ -24,19 +24,72 @@ def sort_and_save(metas, means, img_names, rank_by='pFgA_given_pF=0.50', ascendi
     return df
 
 
-def _rank_helper(imgs, voxel, ascending, ties):
-    if ascending:
-        return rankdata(imgs[:, voxel], method=ties)
-    # descending
-    if ties == 'max':
-        ties = 'min'
-    if ties == 'min':
-        ties = 'max'
-    return imgs.shape[0] + 1 - rankdata(imgs[:, voxel], method=ties)
+def rank_along_terms(imgs, ascending=False, ties='average'):
+    """
+    Rank the terms at every voxel, i.e. scipy.stats.rankdata along the first axis.
+    In descending order, the largest value gets rank 1 and ties are resolved in the
+    same way as ranking the negated values in ascending order.
+    Unlike the per-voxel rankdata calls that this replaced: NaNs are ranked last
+    in both orders (they used to be ranked first in descending order), and with
+    'ordinal', tied terms are ranked in their order in imgs in both orders (in
+    descending order, the last of them used to get the smallest rank).
+    :param imgs: a (terms x voxels) array
+    :param ties: 'average', 'min', 'max', 'dense' or 'ordinal'
+    :return: a (terms x voxels) array of ranks
+    """
+    if ties not in ('average', 'min', 'max', 'dense', 'ordinal'):
+        raise ValueError('Unknown tie resolution method "%s"' % ties)
+    # sort each voxel in a contiguous row, which is much faster than along columns
+    values = np.ascontiguousarray(np.asarray(imgs).T)
+    if not ascending:
+        values = -values
+    n_terms = values.shape[1]
+    order = np.argsort(values, axis=1, kind='mergesort' if ties == 'ordinal' else 'quicksort')
+    positions = np.arange(1, n_terms + 1, dtype=np.float64)
+    if ties == 'ordinal':
+        sorted_ranks = np.broadcast_to(positions, values.shape)
+    else:
+        sorted_values = np.take_along_axis(values, order, axis=1)
+        # whether each sorted value starts (or ends) a group of tied values
+        starts = np.ones(values.shape, dtype=bool)
+        starts[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+        if ties == 'dense':
+            sorted_ranks = np.cumsum(starts, axis=1, dtype=np.float64)
+        else:
+            if ties in ('min', 'average'):
+                mins = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+            if ties in ('max', 'average'):
+                ends = np.ones(values.shape, dtype=bool)
+                ends[:, :-1] = starts[:, 1:]
+                maxs = np.minimum.accumulate(np.where(ends, positions, n_terms)[:, ::-1],
+                                             axis=1)[:, ::-1]
+            sorted_ranks = mins if ties == 'min' else maxs if ties == 'max' \
+                else (mins + maxs) / 2
+    ranks = np.empty(values.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, sorted_ranks, axis=1)
+    return ranks.T
+
+
+def mean_ranks(imgs, ascending=False, ties='average', max_memory=2 ** 28):
+    """
+    Rank the terms at every voxel (see rank_along_terms), and average the ranks
+    of each term across voxels. Voxels are ranked in chunks to limit memory use.
+    :param imgs: a (terms x voxels) array
+    :param max_memory: (int) approximate number of bytes to use at once
+    :return: a 1D array of the mean rank of each term
+    """
+    n_terms, n_voxels = imgs.shape
+    chunk_size = max(1, max_memory // (n_terms * 48))  # about 6 arrays of 8 bytes
+    rank_sums = np.zeros(n_terms)
+    for start in range(0, n_voxels, chunk_size):
+        rank_sums += np.sum(rank_along_terms(imgs[:, start:start + chunk_size],
+                                             ascending, ties), axis=1)
+    return rank_sums / n_voxels
 
 
 def rank_terms(dataset, rank_by='pFgA_given_pF=0.50', extra_expr=(), csv_name=None,
-               ascending=False, rank_first=False, ties='average', extra_info=()):
+               ascending=False, rank_first=False, ties='average', extra_info=(),
+               max_rank_memory=2 ** 28):
     """
     Rank all of the terms in Neurosynth by the voxel values in specified image (rank_by).
 
@@ -57,24 +110,35 @@ def rank_terms(dataset, rank_by='pFgA_given_pF=0.50', extra_expr=(), csv_name=No
                  when rank_first=True. The options are 'average', 'min', 'max', 'dense'
                  and 'ordinal'. See scipy.stats.rankdata for details
     :param extra_info: (list of tuples) extra information to put at the top of csv
+    :param max_rank_memory: (int) approximate number of bytes to use at once when
+                            ranking terms at each voxel (rank_first=True)
     :return: an NsInfo object and a pandas data frame of the rank
     """
     img_info = AnalysisInfo.get_num_from_name(rank_by)
-    metas = analyze_all_terms(dataset, extra_expr, **img_info)
-    img_names = list(metas[0].images.keys())
-    img_means = [np.mean([meta.images[img] for img in img_names], axis=1) for meta in metas]
+    metas = []
+    img_means = []
+    imgs = []
+    for exprs, study_sets, images in all_terms_images(dataset, extra_expr, **img_info):
+        img_names = list(images.keys())
+        img_means.append(np.array([np.mean(img, axis=1, dtype=np.float64)
+                                   for img in images.values()]).T)
+        if rank_first:
+            imgs.append(images[rank_by])
+        # only the info is needed for the rank table
+        metas += [MetaAnalysisPlus([('expression', expr), ('number of studies', len(studies))],
+                                   dataset, images={})
+                  for expr, studies in zip(exprs, study_sets)]
+    img_means = np.vstack(img_means)
     if rank_first:
-        imgs = np.array([np.array(meta.images[rank_by]) for meta in metas])
-        rank_means = np.array([np.mean([_rank_helper(imgs, voxel, ascending, ties)
-                                        for voxel in range(len(imgs[0]))],
-                                       axis=0)]).T
+        imgs = np.vstack(imgs)
+        rank_means = mean_ranks(imgs, ascending, ties, max_rank_memory).reshape(-1, 1)
         img_means = np.hstack((rank_means, img_means))
         img_names = [rank_by + '_rank'] + img_names
         rank_by += '_rank'
     ascending = True if rank_first else ascending
 
-    info = extra_info + [('ranked by', rank_by),
-                         ('data type', 'average rank' if rank_first else 'average value')]
+    info = list(extra_info) + [('ranked by', rank_by),
+                               ('data type', 'average rank' if rank_first else 'average value')]
     if len(extra_expr) > 0:
         info.append(('extra terms', ', '.join(extra_expr)))
     if rank_first:
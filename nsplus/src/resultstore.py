@@ -0,0 +1,165 @@
+from .metaplus import MetaAnalysisPlus
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+import os
+import posixpath
+try:
+    import h5py
+except ImportError:  # optional, only needed to save results in HDF5 files
+    h5py = None
+
+FORMAT_NAME = 'nsplus-results'
+FORMAT_VERSION = 1
+
+
+def make_result_file(path, name):
+    """
+    Same as MetaAnalysisPlus.make_result_dir, but for an HDF5 file
+    :return: the name of a new .h5 file in path
+    """
+    filename = os.path.join(path, name + '.h5')
+    if os.path.exists(filename):
+        # add a current time if the same file already exists
+        current_time = str(datetime.now()).split('.')[0]
+        filename = os.path.join(path, name + ' ' + current_time + '.h5')
+    return filename
+
+
+class ResultStore(object):
+    """
+    Meta-analysis results in one HDF5 file. Each MetaAnalysisPlus object is a group
+    with its info as attributes, and each of its images (and standard errors, if
+    any) is a chunked, compressed dataset of voxel values, so that one image or a
+    range of voxels can be read without loading the rest. Results are identified by
+    keys such as "pairwise_comparisons/f1_vs_f2", where the last part is the info
+    name and the rest are the groups that contain the result.
+    """
+    compression = 'gzip'
+    compress_level = 4
+    chunk_size = 2 ** 15  # voxels per chunk
+
+    def __init__(self, filename, mode='r'):
+        """
+        :param filename: (string) the HDF5 file
+        :param mode: 'r' to read, 'a' to read and add results (the file is created if
+                     needed), or 'w' to create a new file
+        """
+        if h5py is None:
+            raise ImportError('h5py is required to save results in HDF5 files')
+        self.filename = filename
+        self._file = h5py.File(filename, mode)
+        attrs = self._file.attrs
+        if mode != 'r' and len(attrs) == 0 and len(self._file) == 0:  # new file
+            attrs['format'] = FORMAT_NAME
+            attrs['format_version'] = FORMAT_VERSION
+        elif attrs.get('format') != FORMAT_NAME or \
+                attrs.get('format_version') != FORMAT_VERSION:
+            message = '%s is not a supported result file (format %s, version %s)' \
+                      % (filename, attrs.get('format'), attrs.get('format_version'))
+            self._file.close()
+            raise ValueError(message)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __contains__(self, key):
+        return key in self._file and 'images' in self._file[key]
+
+    def keys(self):
+        """
+        :return: a sorted list of the keys of all results
+        """
+        keys = []
+        self._file.visititems(lambda name, item: keys.append(name)
+                              if isinstance(item, h5py.Group) and 'images' in item else None)
+        return sorted(keys)
+
+    # Writing #
+
+    def save(self, meta, group='', image_names=None):
+        """
+        Save a MetaAnalysisPlus object, replacing any result with the same key.
+        :param group: (string) the group to save the result in, e.g. 'pairwise_comparisons'
+        :param image_names: the names of images to be saved. If None, all images
+                            will be saved.
+        :return: the key of the result
+        """
+        key = posixpath.join(group, meta.info.name.replace('/', '_'))
+        if key in self._file:
+            del self._file[key]
+        result = self._file.create_group(key, track_order=True)
+        for name, value in meta.info.items():
+            if isinstance(value, np.generic):
+                value = value.item()
+            result.attrs[name] = value if isinstance(value, (str, int, float)) \
+                else str(value)
+        self._save_images(result.create_group('images', track_order=True),
+                          meta.images, image_names)
+        if meta.std_errors is not None:
+            self._save_images(result.create_group('std_errors', track_order=True),
+                              meta.std_errors, image_names)
+        return key
+
+    def _save_images(self, group, images, image_names):
+        for name in images:
+            if image_names is not None and name not in image_names:
+                continue
+            data = np.asarray(images[name])
+            group.create_dataset(name, data=data,
+                                 chunks=(max(1, min(self.chunk_size, len(data))),),
+                                 compression=self.compression,
+                                 compression_opts=self.compress_level, shuffle=True)
+
+    # Reading #
+
+    def image_names(self, key):
+        return list(self._file[key]['images'].keys())
+
+    def read_info(self, key):
+        """
+        :return: the info of a result as a MetaAnalysisPlus.Info object
+        """
+        info = MetaAnalysisPlus.Info(
+            (name, value.item() if isinstance(value, np.generic) else value)
+            for name, value in self._file[key].attrs.items())
+        info.set_name(posixpath.basename(key))
+        return info
+
+    def read_image(self, key, image_name, start=None, stop=None, std_error=False):
+        """
+        Read an image of a result, or a range of its voxels. Only the chunks that
+        contain these voxels are read from the file.
+        :param start: (int) the first voxel (default: 0)
+        :param stop: (int) the voxel after the last one (default: all voxels)
+        :param std_error: (boolean) read the standard error of the image instead
+        :return: a 1D array of voxel values
+        """
+        images = self._file[key]['std_errors' if std_error else 'images']
+        return images[image_name][start:stop]
+
+    def load(self, key, dataset=None, image_names=None):
+        """
+        :param dataset: the dataset of the result, which is needed to save its
+                        images to NIfTI files
+        :param image_names: the names of images to be loaded. If None, all images
+                            will be loaded.
+        :return: a MetaAnalysisPlus object
+        """
+        result = self._file[key]
+        meta = MetaAnalysisPlus(self.read_info(key), dataset,
+                                images=self._load_images(result['images'], image_names))
+        if 'std_errors' in result:
+            meta.std_errors = self._load_images(result['std_errors'], image_names)
+        return meta
+
+    @staticmethod
+    def _load_images(group, image_names):
+        return OrderedDict((name, group[name][()]) for name in group
+                           if image_names is None or name in image_names)
@@ -1,15 +1,20 @@
 from .metaplus import MetaAnalysisPlus
+from .batchmeta import selection_matrix, count_active_voxels, meta_images, LazyImages
+import numpy as np
 import os
-# import concurrent.futures  # requires futures for python 2.x
 
 
 def analyze_expression(dataset, expression='', study_ids=(), prior=0.5, fdr=0.01,
-                       extra_info=(), image_names=None, save_files=True, outpath='.'):
+                       extra_info=(), image_names=None, save_files=True, outpath='.',
+                       extra_priors=(), extra_fdrs=()):
     """
     Analyze a single expression; optionally output the nifti images and a csv file
     containing image info and voxel values.
     At least one of expression or study_ids has to be specified. If both are specified,
     they will be combined and analyzed together.
+    If the dataset has a result_cache, the activation counts are loaded from it when
+    the same studies have been analyzed before. Either way, the images are computed
+    from the counts when they are first used (see LazyImages).
 
     :param dataset: a Neurosynth Dataset or DatasetPlus instance to get studies from
     :param expression: a string expression to be analyzed
@@ -22,6 +27,10 @@ def analyze_expression(dataset, expression='', study_ids=(), prior=0.5, fdr=0.01
                         If None, all images will be included.
     :param save_files: (boolean) whether to save the results as csv and nifti files
     :param outpath: (string) directory to save the images/csv
+    :param extra_priors: (list of floats) other priors to compute the prior-adjusted
+                         images with (see MetaAnalysisPlus.sweep)
+    :param extra_fdrs: (list of floats) other FDR thresholds to compute the
+                       FDR-corrected images with
     :return: an MetaAnalysisPlus object
     """
     if len(expression) == 0 and len(study_ids) == 0:
@@ -46,7 +55,18 @@ def analyze_expression(dataset, expression='', study_ids=(), prior=0.5, fdr=0.01
             ('number of studies', len(study_set)),
             ('study IDs', '; '.join(str(s) for s in study_set))] \
            + list(extra_info)
-    meta = MetaAnalysisPlus(info, dataset=dataset, ids=study_set, prior=prior, q=fdr)
+    cache = getattr(dataset, 'result_cache', None)
+    key = cache.make_result_key(dataset, 'expression counts', [sorted(study_set)]) \
+        if cache is not None else None
+    counts = cache.get(key) if key is not None else None
+    if counts is None:
+        meta = MetaAnalysisPlus(info, dataset=dataset, ids=study_set, prior=prior, q=fdr)
+        if key is not None:
+            cache.put(key, meta.images.counts())
+    else:
+        meta = MetaAnalysisPlus(info, dataset=dataset,
+                                images=LazyImages.from_counts(counts, prior, fdr))
+    meta.images.update(meta.sweep(extra_priors, extra_fdrs))
 
     # output
     if save_files:
@@ -57,27 +77,67 @@ def analyze_expression(dataset, expression='', study_ids=(), prior=0.5, fdr=0.01
     return meta
 
 
-def analyze_all_terms(dataset, extra_expr=(), prior=0.5, fdr=0.01):
+def all_terms_images(dataset, extra_expr=(), prior=0.5, fdr=0.01, batch_size=None):
+    """
+    Compute the meta-analysis images of each term/expression in the dataset or the
+    extra expression list, in batches. For each batch, the voxel counts of all terms
+    come from one product of the image table and a (studies x terms) membership
+    matrix, and the images are derived from the counts at once. The results are the
+    same as those of analyze_expression.
+
+    :param batch_size: (int) number of terms per batch. If None, it is chosen so that
+                       each (terms x voxels) array has about 10 million values
+    :return: a generator of (expressions, study ID lists, images) for each batch,
+             where images is a LazyImages mapping {image name: (expressions x voxels)
+             array}, so only the images that are used are computed
+    """
+    all_exprs = [term for term in dataset.feature_names if not term[0].isdigit()]
+    all_exprs = sorted(set(all_exprs) | set(extra_expr))
+
+    image_table = dataset.image_table
+    n_voxels, n_studies = image_table.data.shape
+    if batch_size is None:
+        batch_size = max(1, 10 ** 7 // max(n_voxels, 1))
+    col_index = {study: i for i, study in enumerate(image_table.ids)}
+    n_active = np.asarray(image_table.data.sum(axis=1),
+                          dtype=image_table.data.dtype).reshape(1, -1)
+
+    for start in range(0, len(all_exprs), batch_size):
+        exprs = all_exprs[start:start + batch_size]
+        study_sets = []
+        for expr in exprs:
+            try:
+                study_set = dataset.get_studies(expression=expr)
+            except AttributeError:  # in case expression somehow doesn't work
+                study_set = dataset.get_studies(features=expr)
+            if len(study_set) == 0:
+                raise ValueError('No study in the database is associated with "'
+                                 + expr + '"')
+            study_sets.append(study_set)
+        index_lists = [sorted(col_index[study] for study in set(study_set)
+                              if study in col_index)
+                       for study_set in study_sets]
+        n_sel = np.array([len(indices) for indices in index_lists])
+        n_sel_active = count_active_voxels(image_table.data,
+                                           selection_matrix(index_lists, n_studies))
+        images = meta_images(n_sel_active, n_active - n_sel_active, n_sel,
+                             n_studies - n_sel, n_active=n_active, prior=prior, q=fdr)
+        yield exprs, study_sets, images
+
+
+def analyze_all_terms(dataset, extra_expr=(), prior=0.5, fdr=0.01, batch_size=None):
     # TODO with extra lists of study IDs?
     """
     Do a meta-analysis for each term/expression in the dataset or the extra
-    expression list
+    expression list (see all_terms_images)
     :return: a list of MetaAnalysisPlus objects
     """
-    all_exprs = [term for term in dataset.feature_names if not term[0].isdigit()]
-    if len(extra_expr) > 0:
-        all_exprs += extra_expr
-    all_exprs = set(all_exprs)
-
-    # if multiprocess:  # multiprocessing is slower?
-    #     with concurrent.futures.ProcessPoolExecutor() as executor:
-    #         args = [dict(dataset=dataset, expression=expr, prior=prior, fdr=fdr,
-    #                      save_csv=False, save_images=False) for expr in all_exprs]
-    #         metas = executor.map(_analyze_expression, args)
-    #     return list(metas)
     metas = []
-    for i, expr in enumerate(all_exprs):
-        print('Analyzing "%s" (%d/%d)' % (expr, i + 1, len(all_exprs)))
-        metas.append(analyze_expression(dataset, expression=expr, prior=prior, fdr=fdr,
-                                        save_files=False))
+    for exprs, study_sets, images in all_terms_images(dataset, extra_expr, prior, fdr,
+                                                      batch_size):
+        for i, (expr, study_set) in enumerate(zip(exprs, study_sets)):
+            info = [('expression', expr),
+                    ('number of studies', len(study_set)),
+                    ('study IDs', '; '.join(str(s) for s in study_set))]
+            metas.append(MetaAnalysisPlus(info, dataset, images=images.row(i)))
     return metas
@@ -0,0 +1,302 @@
+from bisect import bisect_left, insort
+from scipy import sparse
+import numpy as np
+import re
+
+
+class ExpressionError(ValueError):
+    """
+    Raised when an expression uses syntax the compiled evaluator doesn't support
+    """
+    pass
+
+
+_TOKEN = re.compile(r'\s*(?:(&~)|(&)|(\|)|(\()|(\))|([a-zA-Z0-9_\-\*]+))')
+_OPERATORS = {'&~': 'andnot', '&': 'and', '|': 'or'}
+
+
+def tokenize(expression):
+    """
+    :return: a list of tokens, where consecutive words are joined by a single
+             space into one feature name (same as in the Neurosynth lexer)
+    """
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = _TOKEN.match(expression, pos)
+        if match is None:
+            raise ExpressionError('Unsupported character "%s" in expression'
+                                  % expression[pos:].lstrip()[0])
+        pos = match.end()
+        token = match.group(match.lastindex)
+        if match.lastindex == 6 and len(tokens) > 0 and tokens[-1][0] == 'feature':
+            tokens[-1] = ('feature', tokens[-1][1] + ' ' + token)
+        elif match.lastindex == 6:
+            tokens.append(('feature', token))
+        else:
+            tokens.append((_OPERATORS.get(token, token), token))
+    return tokens
+
+
+def parse_expression(expression):
+    """
+    Parse an expression into a tree of nested tuples, e.g.
+    'a &~ (b | c)' -> ('andnot', ('feature', 'a'), ('or', ('feature', 'b'), ('feature', 'c'))).
+    As in Neurosynth, all operators have the same precedence and group from the
+    right, i.e. 'a & b | c' means 'a & (b | c)'.
+    Frequency comparisons ('<' and '>') are not supported.
+    """
+    tokens = tokenize(expression)
+    tree, pos = _parse_list(tokens, 0)
+    if pos != len(tokens):
+        raise ExpressionError('Unexpected "%s" in expression' % tokens[pos][1])
+    return tree
+
+
+def _parse_list(tokens, pos):
+    if pos == len(tokens):
+        raise ExpressionError('Incomplete expression')
+    kind, value = tokens[pos]
+    if kind == 'feature':
+        left, pos = (kind, value), pos + 1
+    elif kind == '(':
+        left, pos = _parse_list(tokens, pos + 1)
+        if pos == len(tokens) or tokens[pos][0] != ')':
+            raise ExpressionError('Unmatched parenthesis in expression')
+        pos += 1
+    else:
+        raise ExpressionError('Unexpected "%s" in expression' % value)
+    if pos < len(tokens) and tokens[pos][0] in ('and', 'or', 'andnot'):
+        right, end = _parse_list(tokens, pos + 1)
+        return (tokens[pos][0], left, right), end
+    return left, pos
+
+
+def append_rows(buffer, size, rows):
+    """
+    Append rows after the first `size` rows of a buffer array. When the buffer is
+    full (or read-only), it is replaced by one with 1.5 times the capacity, so that
+    appending is amortized O(len(rows)) instead of copying the existing rows.
+    :return: the buffer, which may be new
+    """
+    if size + len(rows) > len(buffer) or not buffer.flags.writeable:
+        capacity = max(int(len(buffer) * 1.5), size + len(rows), 16)
+        new_buffer = np.empty((capacity,) + buffer.shape[1:], dtype=buffer.dtype)
+        new_buffer[:size] = buffer[:size]
+        buffer = new_buffer
+    buffer[size:size + len(rows)] = rows
+    return buffer
+
+
+class GrowableCSC(object):
+    """
+    A CSC matrix that columns can be appended to without copying the existing ones
+    each time: the arrays of the matrix are views of buffers with spare capacity.
+    """
+    def __init__(self, matrix):
+        self.matrix = sparse.csc_matrix(matrix)
+        self._data = self.matrix.data
+        self._indices = self.matrix.indices
+        self._indptr = self.matrix.indptr
+
+    def append(self, columns):
+        """
+        :param columns: a sparse matrix with the same number of rows
+        :return: the matrix with the columns appended (a new matrix object sharing
+                 the arrays of the previous one)
+        """
+        columns = sparse.csc_matrix(columns)
+        n_rows, n_cols = self.matrix.shape
+        if columns.shape[0] != n_rows:
+            raise ValueError('Columns must have %d rows' % n_rows)
+        nnz = self.matrix.nnz
+        self._data = append_rows(self._data, nnz, columns.data.astype(self._data.dtype))
+        self._indices = append_rows(self._indices, nnz, columns.indices)
+        self._indptr = append_rows(self._indptr, n_cols + 1, columns.indptr[1:] + nnz)
+        nnz += columns.nnz
+        n_cols += columns.shape[1]
+        self.matrix = sparse.csc_matrix((self._data[:nnz], self._indices[:nnz],
+                                         self._indptr[:n_cols + 1]),
+                                        shape=(n_rows, n_cols), copy=False)
+        return self.matrix
+
+
+class StudyIndex(object):
+    """
+    A packed boolean index of the feature table for fast study queries. For each
+    frequency threshold used, the feature table is thresholded once into one bitset
+    (of all studies) per feature, so that expressions are evaluated with bitwise
+    operations. Feature names are kept sorted to resolve wildcards.
+    """
+    def __init__(self, study_ids, feature_names, weights):
+        """
+        :param study_ids: IDs of the studies, i.e. rows of the feature table
+        :param feature_names: names of the features, i.e. columns of the feature table
+        :param weights: a (studies x features) scipy.sparse.csc_matrix of feature
+                        frequencies
+        """
+        self.study_ids = np.asarray(study_ids)
+        self.weights = sparse.csc_matrix(weights)
+        self._columns = {name: i for i, name in enumerate(feature_names)}
+        self._sorted_names = sorted(self._columns)
+        self._bits = {}  # frequency threshold - (features x bytes) packed bitsets
+        self._wildcards = {}  # feature name pattern - matching columns
+        self._summed_bits = {}  # (columns, threshold) - bitset of multiple features
+        self._rows = None  # study ID - row
+
+    @classmethod
+    def from_feature_table(cls, feature_table):
+        """
+        Build the index from a Neurosynth FeatureTable, one column at a time to
+        avoid making a dense copy of the whole table. The sparse weights of a
+        feature table loaded from a columnar database are used as they are.
+        """
+        if getattr(feature_table, 'weights', None) is not None:
+            return cls(feature_table.ids, feature_table.names, feature_table.weights)
+        data = feature_table.data
+        indices = []
+        values = []
+        for i in range(data.shape[1]):
+            column = np.asarray(data.iloc[:, i], dtype=np.float64)
+            column[np.isnan(column)] = 0
+            nonzero = np.flatnonzero(column)
+            indices.append(nonzero)
+            values.append(column[nonzero])
+        indptr = np.concatenate([[0], np.cumsum([len(idx) for idx in indices])])
+        weights = sparse.csc_matrix((np.concatenate(values) if values else [],
+                                     np.concatenate(indices) if indices else [],
+                                     indptr), shape=data.shape)
+        return cls(data.index.values, list(data.columns), weights)
+
+    @property
+    def feature_names(self):
+        """
+        Names of the features, in the order of the columns
+        """
+        return sorted(self._columns, key=self._columns.get)
+
+    def get_rows(self, study_ids):
+        """
+        :return: a sorted array of the rows of the given study IDs, leaving out the
+                 IDs that are not in the index
+        """
+        if self._rows is None:
+            self._rows = {study_id: i for i, study_id in enumerate(self.study_ids.tolist())}
+        rows = set(self._rows[i] for i in study_ids if i in self._rows)
+        return np.array(sorted(rows), dtype=np.int64)
+
+    def add_features(self, feature_names, weights):
+        """
+        Append features without rebuilding the index: only the bitsets of the new
+        features are computed.
+        :param feature_names: names of the new features
+        :param weights: the (studies x features) weights of all features, i.e. the
+                        current weights with the columns of the new features appended
+        """
+        n_features = len(self._columns)
+        if weights.shape[1] != n_features + len(feature_names):
+            raise ValueError('Weights must have %d columns'
+                             % (n_features + len(feature_names)))
+        for name in feature_names:
+            if name in self._columns:
+                raise ValueError('Feature "%s" already exists' % name)
+        self.weights = sparse.csc_matrix(weights)
+        for threshold, bits in self._bits.items():
+            new_bits = self._pack_columns(n_features, self.weights.shape[1], threshold)
+            self._bits[threshold] = append_rows(bits, n_features, new_bits)
+        for i, name in enumerate(feature_names):
+            self._columns[name] = n_features + i
+            insort(self._sorted_names, name)
+        self._wildcards = {}  # new features may match
+
+    # Bitsets #
+
+    def _pack_columns(self, start, stop, threshold, chunk_size=256):
+        """
+        :return: a (features x bytes) array of the packed bitsets of some columns
+        """
+        bits = np.empty((stop - start, (len(self.study_ids) + 7) // 8), dtype=np.uint8)
+        for i in range(start, stop, chunk_size):
+            chunk = self.weights[:, i:min(i + chunk_size, stop)].toarray() >= threshold
+            bits[i - start:i - start + chunk.shape[1]] = np.packbits(chunk, axis=0).T
+        return bits
+
+    def _threshold_bits(self, threshold):
+        n_features = self.weights.shape[1]
+        if threshold not in self._bits:
+            self._bits[threshold] = self._pack_columns(0, n_features, threshold)
+        return self._bits[threshold][:n_features]  # the buffer may have spare rows
+
+    def _find_columns(self, pattern):
+        """
+        :return: columns of the features matching a name that may have wildcards
+        """
+        if '*' not in pattern:
+            return [self._columns[pattern]] if pattern in self._columns else []
+        if pattern not in self._wildcards:
+            prefix = pattern.split('*', 1)[0]
+            regex = re.compile('.*'.join(re.escape(s) for s in pattern.split('*')) + '$')
+            columns = []
+            for name in self._sorted_names[bisect_left(self._sorted_names, prefix):]:
+                if not name.startswith(prefix):
+                    break
+                if regex.match(name):
+                    columns.append(self._columns[name])
+            self._wildcards[pattern] = columns
+        return self._wildcards[pattern]
+
+    def feature_bits(self, features, threshold=0.001):
+        """
+        Same criterion as the Neurosynth FeatureTable.get_ids with func=np.sum: a
+        study is selected if the summed frequency of all matching features is at
+        least the threshold. No study is selected if no feature matches.
+        :param features: a feature name or a list of names, which may have wildcards
+        :return: a packed bitset of the selected studies
+        """
+        if isinstance(features, str):
+            features = [features]
+        columns = sorted(set(col for name in features for col in self._find_columns(name)))
+        if len(columns) == 0:
+            return np.zeros((len(self.study_ids) + 7) // 8, dtype=np.uint8)
+        if len(columns) == 1:
+            return self._threshold_bits(threshold)[columns[0]]
+        key = (tuple(columns), threshold)
+        if key not in self._summed_bits:
+            summed = np.asarray(self.weights[:, columns].sum(axis=1)).ravel()
+            self._summed_bits[key] = np.packbits(summed >= threshold)
+        return self._summed_bits[key]
+
+    def expression_bits(self, expression, threshold=0.001):
+        """
+        :param expression: an expression string, or a tree from parse_expression
+        :return: a packed bitset of the studies selected by the expression
+        """
+        tree = parse_expression(expression) if isinstance(expression, str) else expression
+        if tree[0] == 'feature':
+            return self.feature_bits(tree[1], threshold)
+        left = self.expression_bits(tree[1], threshold)
+        right = self.expression_bits(tree[2], threshold)
+        if tree[0] == 'and':
+            return left & right
+        elif tree[0] == 'or':
+            return left | right
+        return left & ~right
+
+    def to_ids(self, bits):
+        """
+        :return: a list of the IDs of the studies in a packed bitset
+        """
+        selected = np.flatnonzero(np.unpackbits(bits)[:len(self.study_ids)])
+        return self.study_ids[selected].tolist()
+
+    # Queries #
+
+    def get_studies(self, features=None, expression=None, threshold=0.001):
+        """
+        :return: a list of IDs of studies selected by either the features or the
+                 expression
+        """
+        if expression is not None:
+            return self.to_ids(self.expression_bits(expression, threshold))
+        return self.to_ids(self.feature_bits(features, threshold))
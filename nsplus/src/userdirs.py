@@ -0,0 +1,54 @@
+import os
+import sys
+
+APP_NAME = 'NSplus'
+
+
+def _make_dir(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def user_data_dir(*subdirs):
+    """
+    The directory of the current user's NS+ data (e.g. custom terms), which doesn't
+    depend on the output directory. It's $NSPLUS_DATA_DIR if that is set, or
+    otherwise %APPDATA%\\NSplus on Windows, ~/Library/Application Support/NSplus on
+    macOS, and $XDG_DATA_HOME/nsplus (~/.local/share/nsplus) elsewhere.
+    :param subdirs: names of subdirectories
+    :return: the path of the directory, which is created if it doesn't exist
+    """
+    path = os.environ.get('NSPLUS_DATA_DIR')
+    if not path:
+        home = os.path.expanduser('~')
+        if sys.platform.startswith('win'):
+            path = os.path.join(os.environ.get('APPDATA') or home, APP_NAME)
+        elif sys.platform == 'darwin':
+            path = os.path.join(home, 'Library', 'Application Support', APP_NAME)
+        else:
+            path = os.path.join(os.environ.get('XDG_DATA_HOME') or
+                                os.path.join(home, '.local', 'share'), APP_NAME.lower())
+    return _make_dir(os.path.join(path, *subdirs))
+
+
+def user_cache_dir(*subdirs):
+    """
+    The directory of the current user's NS+ caches, which can be deleted at any
+    time. It's $NSPLUS_CACHE_DIR if that is set, or otherwise
+    %LOCALAPPDATA%\\NSplus\\Cache on Windows, ~/Library/Caches/NSplus on macOS, and
+    $XDG_CACHE_HOME/nsplus (~/.cache/nsplus) elsewhere.
+    :param subdirs: names of subdirectories
+    :return: the path of the directory, which is created if it doesn't exist
+    """
+    path = os.environ.get('NSPLUS_CACHE_DIR')
+    if not path:
+        home = os.path.expanduser('~')
+        if sys.platform.startswith('win'):
+            path = os.path.join(os.environ.get('LOCALAPPDATA') or home, APP_NAME, 'Cache')
+        elif sys.platform == 'darwin':
+            path = os.path.join(home, 'Library', 'Caches', APP_NAME)
+        else:
+            path = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                                os.path.join(home, '.cache'), APP_NAME.lower())
+    return _make_dir(os.path.join(path, *subdirs))
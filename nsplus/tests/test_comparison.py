@@ -0,0 +1,111 @@
+import pytest
+import random
+import neurosynth as ns
+from numpy.testing import assert_allclose, assert_array_equal
+from .util import *
+from nsplus.src.comparison import _resample_meta_images, even_study_set_size, \
+    iteration_seeds, compare_expressions, compare_multiple
+from nsplus.src.parallel import MatrixPool
+from scipy import sparse
+
+
+def test_resample_meta_images():
+    dataset = get_dummy_dataset()
+    study_sets = [['study1', 'study2', 'study3'], ['study3', 'study5']]
+
+    # reference: one Neurosynth meta-analysis per iteration
+    metas = [[], []]
+    for seed in iteration_seeds(0, 3):
+        new_sets = even_study_set_size(study_sets, random.Random(seed))
+        for i in range(2):
+            images = ns.meta.MetaAnalysis(dataset, ids=new_sets[i], ids2=new_sets[1 - i]).images
+            metas[i].append(MetaAnalysisPlus([], dataset, images=images))
+    expected = [MetaAnalysisPlus.mean(meta_list) for meta_list in metas]
+
+    result = _resample_meta_images(dataset, study_sets, 3, reduce_larger_set=True,
+                                   two_way=True, prior=0.5, fdr=0.01, batch_size=2,
+                                   seed=0)
+    for running_mean, expected_meta, meta_list in zip(result, expected, metas):
+        assert running_mean.count == 3
+        imgs, std_errors = running_mean.mean(), running_mean.std_error()
+        assert list(imgs.keys()) == list(expected_meta.images.keys())
+        for img in imgs:
+            assert_allclose(imgs[img], expected_meta.images[img], rtol=1e-10, atol=1e-12)
+            stacked = np.array([meta.images[img] for meta in meta_list])
+            assert_allclose(std_errors[img], np.std(stacked, axis=0, ddof=1) / np.sqrt(3),
+                            rtol=1e-8, atol=1e-12)
+            assert_allclose(expected_meta.std_errors[img], std_errors[img],
+                            rtol=1e-8, atol=1e-12)
+
+
+def test_resample_meta_images_parallel():
+    dataset = get_dummy_dataset()
+    study_sets = [['study1', 'study2', 'study3', 'study4'], ['study5', 'study2']]
+    results = [_resample_meta_images(dataset, study_sets, 5, reduce_larger_set=True,
+                                     two_way=False, prior=0.5, fdr=0.01, batch_size=2,
+                                     seed=42, n_jobs=n_jobs)[0]
+               for n_jobs in (1, 2)]
+    for img in results[0].mean():
+        assert_array_equal(results[0].mean()[img], results[1].mean()[img])
+        assert_array_equal(results[0].std_error()[img], results[1].std_error()[img])
+
+
+def test_compare_multiple(tmpdir):
+    dataset = get_dummy_dataset()
+    exprs = ['f1', 'f 2', 'f3']
+    win_metas = compare_multiple(dataset, exprs, 'pAgF', lower_thr=0.1, save_files=False,
+                                 outpath=str(tmpdir), num_iterations=2, seed=1)
+    assert set(win_metas.keys()) == set(exprs)
+
+    # each ordered pair separately
+    pairs = [('f1', 'f 2'), ('f1', 'f3'), ('f 2', 'f3')]
+    pair_metas = {expr: {} for expr in exprs}
+    for (expr, contra_expr), seed in zip(pairs, iteration_seeds(1, 3)):
+        for e1, e2 in ((expr, contra_expr), (contra_expr, expr)):
+            pair_metas[e1][e2] = compare_expressions(dataset, e1, e2, two_way=False,
+                                                     num_iterations=2, save_files=False,
+                                                     seed=seed)
+    for expr in exprs:
+        metas = [pair_metas[expr][contra] for contra in exprs if contra != expr]
+        expected = MetaAnalysisPlus.winnings(metas, 'pAgF', lower_thr=0.1)
+        assert_array_equal(win_metas[expr].images['winnings'], expected.images['winnings'])
+        assert win_metas[expr].info['contrary expression 1'] == \
+            metas[0].info['contrary expression']
+
+    # the pairs share one pool of worker processes
+    parallel = compare_multiple(dataset, exprs, 'pAgF', lower_thr=0.1, save_files=False,
+                                outpath=str(tmpdir), num_iterations=2, seed=1,
+                                batch_size=1, n_jobs=2)
+    for expr in exprs:
+        assert_array_equal(parallel[expr].images['winnings'],
+                           win_metas[expr].images['winnings'])
+
+    with pytest.raises(ValueError):
+        compare_multiple(dataset, ['f1'], 'pAgF', save_files=False, outpath=str(tmpdir))
+
+
+def test_matrix_pool():
+    matrix = sparse.random(20, 10, density=0.3, format='csr', random_state=0)
+    with MatrixPool(matrix, n_jobs=2) as pool:
+        for _ in range(2):  # the pool is reused
+            result = list(pool.map(_column_sums, [([0, 1],), ([2, 5, 9],), ([],)]))
+            for sums, columns in zip(result, ([0, 1], [2, 5, 9], [])):
+                assert_allclose(sums, matrix[:, columns].sum(axis=1).A1)
+
+
+def _column_sums(matrix, columns):
+    return matrix[:, columns].sum(axis=1).A1
+
+
+def test_compare_expressions_extra_priors_and_fdrs():
+    dataset = get_dummy_dataset()
+    metas = compare_expressions(dataset, 'f1', 'f3', num_iterations=3, seed=0,
+                                save_files=False, extra_priors=[0.3], extra_fdrs=[0.05])
+    expected = compare_expressions(dataset, 'f1', 'f3', num_iterations=3, seed=0,
+                                   save_files=False, prior=0.3, fdr=0.05)
+    for meta, expected_meta in zip(metas, expected):
+        for name in ('pA_given_pF=0.30', 'pFgA_given_pF=0.30',
+                     'uniformity-test_z_FDR_0.05', 'association-test_z_FDR_0.05'):
+            assert_array_equal(meta.images[name], expected_meta.images[name])
+            assert_array_equal(meta.std_errors[name], expected_meta.std_errors[name])
+        assert 'pFgA_given_pF=0.50' in meta.images
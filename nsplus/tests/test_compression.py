@@ -0,0 +1,25 @@
+import pytest
+import numpy as np
+from nsplus.src.compression import open_file, detect_codec
+
+
+@pytest.mark.parametrize('codec', [None, 'gzip', 'zlib', 'lzma'])
+def test_round_trip(tmpdir, codec):
+    data = np.random.RandomState(0).randint(0, 4, 100000).astype(np.uint8).tobytes()
+    lines = b'first line\nsecond line\n'
+    filename = str(tmpdir.join('data'))
+    with open_file(filename, 'wb', codec, threads=3, block_size=1000) as outfile:
+        outfile.write(lines)
+        for start in range(0, len(data), 30000):  # writes across many blocks
+            outfile.write(data[start:start + 30000])
+    assert detect_codec(filename) == codec
+    with open_file(filename, 'rb', threads=3, block_size=1000) as infile:
+        assert infile.readline() == b'first line\n'
+        assert infile.readline() == b'second line\n'
+        assert infile.read(10) == data[:10]
+        assert infile.read() == data[10:]
+
+
+def test_unknown_codec(tmpdir):
+    with pytest.raises(ValueError):
+        open_file(str(tmpdir.join('data')), 'wb', 'bz2')
@@ -1,6 +1,12 @@
 import pytest
 from .util import *
 from nsplus import DatasetPlus
+import neurosynth as ns
+import nibabel as nb
+import threading
+from nsplus.src.diskcache import DiskCache, ResultCache
+from nsplus.src.studyindex import GrowableCSC
+from scipy import sparse
 
 
 def test_default_database():
@@ -40,3 +46,300 @@ def test_add_custom_term_by_expression():
     assert dataset.add_custom_term_by_expression('aw', 'such awesomeness & moreawesomeness') == [12077008]
     assert len(dataset.add_custom_term_by_expression('aww', 'such awesomeness | moreawesomeness')) == 4
     assert set(dataset.get_studies(features='aww')) == {9593960, 9620698, 11114477, 12077008}
+
+
+def test_add_custom_terms(tmpdir):
+    dataset = get_dummy_dataset()
+    all_ids = set(dataset.get_studies(expression='f*', frequency_threshold=0))
+    assert dataset.add_custom_term_by_ids('f6', ['study4', 'no such study']) == {'study4'}
+    assert dataset.get_studies(features='f6') == ['study4']
+    assert dataset.feature_table.weights.shape[1] == len(dataset.feature_names)
+    added, errors = dataset.add_custom_terms([('f7', ['study1', 'study2']),
+                                              ('f8', 'f7 | f6'),
+                                              ('f6', ['study1']),
+                                              ('f9', ['no such study']),
+                                              ('f10', 'f7 &')])
+    assert added == {'f7': {'study1', 'study2'}, 'f8': {'study1', 'study2', 'study4'}}
+    assert list(errors) == ['f6', 'f9', 'f10']
+    assert set(dataset.get_studies(expression='f6 | f7')) == {'study1', 'study2', 'study4'}
+    assert set(dataset.get_studies(expression='f*', frequency_threshold=0)) == all_ids
+    # same as Neurosynth's feature table
+    assert set(ns.Dataset.get_studies(dataset, features=['f7', 'f8'])) == \
+        {'study1', 'study2', 'study4'}
+
+    filename = str(tmpdir.join('terms.txt'))
+    with open(filename, 'w') as outfile:
+        outfile.write('# custom terms\n'
+                      'g1\tf1 &~ f7\n'
+                      '\n'
+                      'g2\t123, 456\n'
+                      'g3 f1\n')
+    added, errors = dataset.import_custom_terms(filename)
+    assert added == {'g1': set(dataset.get_studies(expression='f1 &~ f7'))}
+    assert list(errors) == ['line 5', 'g2']
+
+    # saved and loaded with the custom terms as features
+    path = str(tmpdir.join('database'))
+    dataset.save_database(path)
+    loaded = DatasetPlus.load(path)
+    assert set(loaded.get_studies(features='f8')) == {'study1', 'study2', 'study4'}
+
+
+def test_save_custom_terms(tmpdir):
+    dataset = get_dummy_dataset()
+    dataset.add_custom_term_by_ids('f6', ['study4', 'study2'], frequency=0.5)
+    dataset.add_custom_term_by_expression('f7', 'f6 | f1')
+    filename = str(tmpdir.join('custom_terms.json'))
+    dataset.save_custom_terms(filename)
+    with open(filename) as infile:
+        assert len(infile.readlines()) == 4  # header, one line per term, end
+
+    loaded = get_dummy_dataset()
+    added, errors = loaded.load_custom_terms(filename)
+    assert list(added) == ['f6', 'f7'] and len(errors) == 0
+    assert loaded.custom_terms == dataset.custom_terms
+    assert loaded.get_studies(features='f6', frequency_threshold=0.3) == \
+        dataset.get_studies(features='f6', frequency_threshold=0.3)
+    assert set(loaded.get_studies(expression='f7 &~ f6')) == {'study3', 'study5'}
+    # terms that already exist are skipped
+    added, errors = loaded.load_custom_terms(filename)
+    assert len(added) == 0 and list(errors) == ['f6', 'f7']
+
+    # terms saved with another database
+    dataset.database_version = '0.6'
+    dataset.save_custom_terms(filename)
+    other = get_dummy_dataset()
+    other.database_version = '0.7'
+    with pytest.raises(ValueError):
+        other.load_custom_terms(filename)
+    assert len(other.custom_terms) == 0
+    with pytest.warns(UserWarning):
+        added, errors = get_dummy_dataset().load_custom_terms(filename)  # unknown version
+    assert list(added) == ['f6', 'f7']
+
+    with open(filename, 'w') as outfile:
+        outfile.write('{"format": "something else"}')
+    with pytest.raises(ValueError):
+        loaded.load_custom_terms(filename)
+
+
+def test_growable_csc():
+    matrix = sparse.random(50, 20, density=0.1, format='csc', random_state=0)
+    growable = GrowableCSC(matrix)
+    expected = matrix
+    buffer = None
+    reallocations = 0
+    for i in range(30):
+        column = sparse.random(50, 1, density=0.2, format='csc', random_state=i)
+        expected = sparse.hstack([expected, column], format='csc')
+        result = growable.append(column)
+        assert (result != expected).nnz == 0
+        if result.data.base is not buffer:
+            buffer = result.data.base
+            reallocations += 1
+    assert reallocations < 10  # not copied at every append
+
+
+def test_query_cache():
+    dataset = get_dummy_dataset()
+    dataset.add_custom_term_by_ids('such awesomeness', ['study1', 'study2', 'study4'])
+    studies = dataset.get_studies(expression='such awesomeness')
+    assert set(studies) == {'study1', 'study2', 'study4'}
+    assert dataset.get_studies(expression=' such  awesomeness ') == studies
+    assert set(dataset.get_studies(features='f 2')) == {'study1', 'study3'}
+    assert dataset.query_cache_info()['hits'] == 1
+    assert dataset.query_cache_info()['misses'] == 2
+    assert dataset.query_cache_info()['currsize'] == 2
+    # spacing around operators doesn't matter
+    for expressions in (['f1 & f3', 'f1&f3', ' f1 &f3'], ['f1 &~ f3', 'f1&~f3', 'f1 &~f3'],
+                        ['(f1 | f3)&~ f 2', '( f1|f3 ) &~f 2']):
+        hits = dataset.query_cache_info()['hits']
+        studies = [dataset.get_studies(expression=expr) for expr in expressions]
+        assert all(s == studies[0] for s in studies)
+        assert dataset.query_cache_info()['hits'] == hits + len(expressions) - 1
+    assert DatasetPlus.normalize_expression('f1 & ~f3') == 'f1 & ~f3'  # not '&~'
+
+    # adding a term changes results of wildcard queries
+    assert len(dataset.get_studies(expression='*awesomeness')) == 3
+    dataset.add_custom_term_by_ids('moreawesomeness', ['study5'])
+    assert dataset.query_cache_info()['currsize'] == 0
+    assert len(dataset.get_studies(expression='*awesomeness')) == 4
+
+    # size limit
+    dataset.query_cache_size = 2
+    for term in ('such awesomeness', 'moreawesomeness', '*awesomeness'):
+        dataset.get_studies(expression=term)
+    assert dataset.query_cache_info()['currsize'] == 2
+
+
+def test_study_index():
+    dataset = get_dummy_dataset()
+    # f1: study1 is below threshold; f5: study4 has a negative frequency
+    assert set(dataset.get_studies(features='f1')) == {'study2', 'study3', 'study5'}
+    assert set(dataset.get_studies(expression='f1')) == {'study2', 'study3', 'study5'}
+    assert set(dataset.get_studies(expression='f 4')) == {'study1', 'study2'}
+    assert set(dataset.get_studies(expression='f1 & f3 | f5')) == {'study2', 'study3', 'study5'}
+    assert set(dataset.get_studies(expression='(f1 & f3) | f5')) == \
+        {'study1', 'study2', 'study3', 'study5'}
+    assert set(dataset.get_studies(expression='f* &~ (f 2 | f 4)')) == {'study5'}
+    # wildcards sum frequencies of all matched features
+    assert set(dataset.get_studies(features='f*')) == {'study1', 'study2', 'study3', 'study5'}
+    assert set(dataset.get_studies(features=['f1', 'f5'], frequency_threshold=0.5)) == \
+        {'study1', 'study3', 'study5'}
+    assert set(dataset.get_studies(features='f1', frequency_threshold=0.0)) == \
+        {'study1', 'study2', 'study3', 'study4', 'study5'}
+    assert dataset.get_studies(expression='f1 & nonexistent') == []
+    # adding features updates the index
+    dataset.add_custom_term_by_ids('f6', ['study4'])
+    assert set(dataset.get_studies(expression='f 4 | f6')) == {'study1', 'study2', 'study4'}
+
+
+def test_mask(tmpdir):
+    dataset = get_dummy_dataset()
+    full_table = dataset.image_table
+    volume = dataset.masker.volume
+    brain = dataset.masker.full.reshape(volume.shape)  # the data of volume
+    roi = np.zeros(volume.shape)
+    roi[30:60, 40:70, 30:50] = 1
+    roi_file = str(tmpdir.join('roi.nii.gz'))
+    nb.Nifti1Image(roi * (brain > 0), volume.affine).to_filename(roi_file)
+
+    # the ROI table is a subset of the whole-brain table
+    dataset.mask(roi_file)
+    assert dataset.full_image_table is full_table
+    assert dataset.image_table.data.shape[0] == int(np.sum(roi * (brain > 0)))
+    expected = ns.base.dataset.ImageTable(dataset)
+    assert (dataset.image_table.data != expected.data).nnz == 0
+    assert list(dataset.image_table.ids) == list(expected.ids)
+
+    # ROI that extends beyond the brain: rebuilt from peaks, or loaded from the cache
+    nb.Nifti1Image(roi, volume.affine).to_filename(roi_file)
+    dataset.image_cache = DiskCache(str(tmpdir.join('cache')))
+    dataset.mask(roi_file)
+    rebuilt = dataset.image_table.data
+    assert rebuilt.shape[0] == int(np.sum(roi))
+    assert len(dataset.image_cache.entries()) == 1
+    dataset.create_image_table = None  # must not be called
+    dataset.mask(roi_file)
+    assert (dataset.image_table.data != rebuilt).nnz == 0
+    assert dataset.image_table.masker is dataset.masker
+
+    dataset.mask()
+    assert dataset.image_table is full_table
+
+
+def test_columnar_database(tmpdir):
+    dataset = get_dummy_dataset()
+    path = str(tmpdir.join('database'))
+    dataset.save_database(path)
+    loaded = DatasetPlus.load(path)
+    assert 'activations' not in loaded.__dict__  # read when first used
+    assert (loaded.image_table.data != dataset.image_table.data).nnz == 0
+    assert list(loaded.image_table.ids) == list(dataset.image_table.ids)
+    assert loaded.feature_names == dataset.feature_names
+    assert set(loaded.get_studies(expression='f* &~ f1')) == \
+        set(dataset.get_studies(expression='f* &~ f1'))
+    assert np.array_equal(loaded.feature_table.data.to_dense().values,
+                          dataset.feature_table.data.to_dense().values)
+    assert loaded.activations.equals(dataset.activations)
+    loaded.add_custom_term_by_ids('f6', ['study4'])
+    assert loaded.get_studies(features='f6') == ['study4']
+    with pytest.raises(IOError):
+        dataset.save_database(path)
+
+
+def test_load_default_database(tmpdir, monkeypatch):
+    from nsplus.src import database, datasetplus
+    dataset = get_dummy_dataset()
+    tmpdir.mkdir('data')
+    dataset.save(str(tmpdir.join('data', 'database_v0.7.pkl.gz')), compress=True)
+    monkeypatch.setattr(datasetplus.pkgr, 'resource_filename',
+                        lambda package, name: str(tmpdir.join(name)))
+    monkeypatch.setenv('NSPLUS_DATA_DIR', str(tmpdir.join('user')))
+    # converted once, even when loaded by several threads at the same time
+    converted = []
+    convert = database.convert_database
+    monkeypatch.setattr(database, 'convert_database',
+                        lambda *args: converted.append(convert(*args)))
+    datasets = []
+    threads = [threading.Thread(
+        target=lambda: datasets.append(DatasetPlus.load_default_database()))
+        for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(converted) == 1 and len(datasets) == 3
+    assert database.is_database_dir(str(tmpdir.join('user', 'database_v0.7')))
+    assert tmpdir.join('user').listdir() == [tmpdir.join('user', 'database_v0.7')]
+    loaded = DatasetPlus.load_default_database()
+    assert len(converted) == 1
+    assert 'activations' not in loaded.__dict__  # columnar
+    assert loaded.database_version == '0.7'
+    assert (loaded.image_table.data != dataset.image_table.data).nnz == 0
+    # the pickle is loaded if the copy can't be made
+    tmpdir.join('user', 'database_v0.7').remove()
+    tmpdir.join('user', 'database_v0.7').write('')
+    with pytest.warns(UserWarning):
+        loaded = DatasetPlus.load_default_database()
+    assert loaded.feature_names == dataset.feature_names
+
+
+def test_staged_loading(tmpdir):
+    dataset = get_dummy_dataset()
+    path = str(tmpdir.join('database'))
+    dataset.save_database(path)
+    loaded = DatasetPlus.load(path)
+    # features are usable before the image table is loaded
+    assert loaded.get_studies(expression='f1 | f3') == dataset.get_studies(expression='f1 | f3')
+    assert loaded.__dict__.get('full_image_table') is None
+    # threads that need the image table wait for one load
+    tables = []
+    threads = [threading.Thread(target=lambda: tables.append(loaded.image_table))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(table is tables[0] for table in tables)
+    assert loaded.full_image_table is tables[0]
+    assert (tables[0].data != dataset.image_table.data).nnz == 0
+    loaded.finish_loading()
+    assert loaded.__dict__.get('activations') is not None
+    # each dataset loads its data with its own lock
+    assert loaded._loading_lock is not DatasetPlus.load(path)._loading_lock
+
+
+@pytest.mark.parametrize('compress,codec', [(False, None), (True, 'gzip'),
+                                            (True, 'zlib'), (True, 'lzma')])
+def test_save_and_load(tmpdir, compress, codec):
+    dataset = get_dummy_dataset()
+    dataset.image_cache = DiskCache(str(tmpdir.join('cache')))
+    dataset.result_cache = ResultCache(str(tmpdir.join('results')))
+    filename = str(tmpdir.join('dataset.pkl'))
+    dataset.save(filename, compress=compress, codec=codec)
+    assert np.array_equal(dataset.feature_table.data.to_dense().values,  # unchanged
+                          get_dummy_dataset().feature_table.data.to_dense().values)
+    loaded = DatasetPlus.load(filename)
+    assert (loaded.image_table.data != dataset.image_table.data).nnz == 0
+    assert loaded.feature_names == dataset.feature_names
+    # not saved with the dataset
+    assert loaded.image_cache is None and loaded.result_cache is None
+    with open(filename, 'rb') as infile:  # e.g. from pkg_resources.resource_stream
+        from_stream = DatasetPlus.load(infile, compressed=compress)
+        assert not infile.closed
+    assert (from_stream.image_table.data != dataset.image_table.data).nnz == 0
+    assert from_stream.feature_names == dataset.feature_names
+    assert np.array_equal(loaded.feature_table.data.to_dense().values,
+                          dataset.feature_table.data.to_dense().values)
+    assert loaded.get_studies(expression='f1 | f3') == dataset.get_studies(expression='f1 | f3')
+
+    # a columnar database is saved without building the pandas feature table
+    database_path = str(tmpdir.join('database'))
+    dataset.save_database(database_path)
+    columnar = DatasetPlus.load(database_path)
+    columnar.save(filename, compress=compress, codec=codec)
+    assert columnar.feature_table.weights is not None
+    loaded = DatasetPlus.load(filename)
+    assert loaded.feature_table.weights is not None
+    assert loaded.get_studies(expression='f1 | f3') == dataset.get_studies(expression='f1 | f3')
@@ -0,0 +1,84 @@
+import pytest
+import numpy as np
+import os
+from nsplus.src.diskcache import DiskCache, ResultCache
+
+
+def test_put_and_get(tmpdir):
+    cache = DiskCache(str(tmpdir.join('cache')))
+    key = DiskCache.make_key('mask', '0.7', 6)
+    assert key != DiskCache.make_key('mask', '0.7', 8)
+    assert cache.get(key) is None
+    cache.put(key, {'a': np.arange(10), 'ids': np.array(['study1', 2], dtype=object)})
+    assert key in cache
+    arrays = cache.get(key)
+    assert isinstance(arrays['a'], np.memmap)
+    assert list(arrays['a']) == list(range(10))
+    arrays['a'][:3] = -1  # copy on write
+    assert list(cache.get(key)['a']) == list(range(10))
+    assert list(arrays['ids']) == ['study1', 2]
+    assert cache.info()['hits'] == 2 and cache.info()['misses'] == 1
+    assert cache.info()['entries'] == 1
+
+
+def test_lru_eviction(tmpdir):
+    cache = DiskCache(str(tmpdir), max_size=3 * 8000 + 1000)
+    for i in range(3):
+        cache.put(str(i), {'a': np.zeros(1000)})
+        os.utime(str(tmpdir.join(str(i))), (i, i))  # make access times distinct
+    cache.get('0')  # '1' is now the least recently used
+    cache.put('3', {'a': np.zeros(1000)})
+    assert [key for key, size, time in cache.entries()] == ['2', '0', '3']
+    assert cache.size() <= cache.max_size
+    # an entry larger than the cache is kept until the next one is added
+    cache.put('4', {'a': np.zeros(10000)})
+    assert [key for key, size, time in cache.entries()] == ['4']
+    cache.clear()
+    assert cache.entries() == []
+
+
+def test_result_cache(tmpdir):
+    from numpy.testing import assert_array_equal
+    from nsplus.src.singleterm import analyze_expression
+    from nsplus.src.comparison import compare_expressions
+    from .util import get_dummy_dataset
+    dataset = get_dummy_dataset()
+    dataset.result_cache = ResultCache(str(tmpdir.join('cache')))
+
+    meta = analyze_expression(dataset, 'f1', save_files=False)
+    assert len(meta.images._images) == 0  # only the counts are cached
+    cached = analyze_expression(dataset, 'f1', extra_info=[('mask', 'x')], save_files=False)
+    assert dataset.result_cache.info()['hits'] == 1
+    assert cached.info['mask'] == 'x'
+    assert list(cached.images.keys()) == list(meta.images.keys())
+    for name, img in meta.images.items():
+        assert_array_equal(cached.images[name], img)
+    # the counts are kept on cache hits too
+    for name, img in meta.sweep([0.2], [0.1]).items():
+        assert_array_equal(cached.sweep([0.2], [0.1])[name], img)
+    assert list(cached.max_deviation().values()) == [0] * len(cached.images)
+    # the counts don't depend on the prior or FDR threshold
+    other = analyze_expression(dataset, 'f1', prior=0.3, fdr=0.05, save_files=False)
+    assert dataset.result_cache.info()['hits'] == 2
+    assert_array_equal(other.images['pFgA_given_pF=0.30'],
+                       analyze_expression(get_dummy_dataset(), 'f1', prior=0.3,
+                                          save_files=False).images['pFgA_given_pF=0.30'])
+
+    # comparisons are only cached if they are reproducible
+    metas = compare_expressions(dataset, 'f1', 'f3', num_iterations=3, seed=0,
+                                save_files=False)
+    cached_metas = compare_expressions(dataset, 'f1', 'f3', num_iterations=3, seed=0,
+                                       save_files=False)
+    assert dataset.result_cache.info()['hits'] == 3
+    for meta, cached in zip(metas, cached_metas):
+        assert cached.info['expression'] == meta.info['expression']
+        for name, img in meta.images.items():
+            assert_array_equal(cached.images[name], img)
+            assert_array_equal(cached.std_errors[name], meta.std_errors[name])
+    cached_metas[0].images['pAgF'][:3] = np.nan  # cached images can be changed
+    assert_array_equal(compare_expressions(dataset, 'f1', 'f3', num_iterations=3, seed=0,
+                                           save_files=False)[0].images['pAgF'],
+                       metas[0].images['pAgF'])
+    compare_expressions(dataset, 'f1', 'f3', num_iterations=3, save_files=False)
+    compare_expressions(dataset, 'f1', 'f3', num_iterations=3, save_files=False)
+    assert dataset.result_cache.info()['hits'] == 4
@@ -0,0 +1,33 @@
+import pytest
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ('neurosynth', 'pandas', 'scipy', 'numpy', 'nibabel', 'sklearn')
+
+
+def imported_modules(statement):
+    """
+    Run an import statement in a new interpreter.
+    :return: the set of heavy modules it loaded
+    """
+    code = 'import sys\n' \
+           '%s\n' \
+           'print(" ".join(m for m in sys.modules if m.split(".")[0] in %r))' \
+           % (statement, HEAVY_MODULES)
+    env = dict(os.environ)
+    root = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.abspath(root)] +
+                                        [p for p in [env.get('PYTHONPATH')] if p])
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    return set(m.split('.')[0] for m in output.decode().split())
+
+
+def test_lazy_imports():
+    assert imported_modules('import nsplus, nsplus.src') == set()
+    assert 'neurosynth' in imported_modules('import nsplus; nsplus.DatasetPlus')
+
+
+def test_gui_imports():
+    pytest.importorskip('tkinter')
+    assert imported_modules('import nsplus.gui.main') == set()
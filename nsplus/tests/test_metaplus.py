@@ -2,6 +2,7 @@ import pytest
 from numpy.testing import assert_array_almost_equal
 from .util import *
 from nsplus import MetaAnalysisPlus
+from nsplus.src.metaplus import RunningMean
 
 
 def test_init():
@@ -50,3 +51,185 @@ def test_winnings():
         meta_list, image_name='pFgA', lower_thr=-1.2, upper_thr=-30)
     assert_array_almost_equal(result.images['winnings'], [4, 3, 3, 4, 5])
     assert result.info['criterion'] == '>-1.2or<-30'
+
+
+def test_winning_counter():
+    from numpy.testing import assert_array_equal
+    from nsplus.src.metaplus import WinningCounter
+    meta_list = get_dummy_meta(5)
+    for lower_thr, upper_thr in ((1, None), (None, -0.3), (-10, 0.5), (-1.2, -30)):
+        counter = WinningCounter(lower_thr, upper_thr, max_count=4)
+        for meta in meta_list:
+            counter.add(meta.images['pFgA'])
+        assert counter.counts.dtype == np.uint16
+        expected = MetaAnalysisPlus.winnings(meta_list, 'pFgA', lower_thr, upper_thr,
+                                             expression='f1')
+        result = MetaAnalysisPlus.winnings_from_counter(counter, meta_list[0].dataset,
+                                                        'pFgA', expression='f1')
+        assert_array_equal(result.images['winnings'], expected.images['winnings'])
+        assert result.images['winnings'].dtype == np.int32
+        assert result.info.name == expected.info.name
+    assert WinningCounter(1, max_count=2 ** 20).dtype == np.uint32
+    with pytest.raises(ValueError):
+        WinningCounter()
+    with pytest.raises(ValueError):
+        WinningCounter(1, 1)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'prior': 0.3, 'q': 0.05, 'min_studies': 0},
+                                    {'ids2': ['study2', 'study4', 'study5'], 'min_studies': 2}])
+def test_lazy_images(kwargs):
+    import neurosynth as ns
+    dataset = get_dummy_dataset()
+    ids = ['study1', 'study2', 'study3']
+    expected = ns.meta.MetaAnalysis(dataset, ids, **kwargs).images
+    meta = MetaAnalysisPlus([], dataset, None, ids, **kwargs)
+    assert list(meta.images.keys()) == list(expected.keys())
+    assert np.allclose(meta.images['pFgA'], expected['pFgA'], rtol=1e-10, equal_nan=True)
+    assert len(meta.images._images) == 1  # only the image that has been used
+    for name, img in expected.items():
+        assert np.allclose(meta.images[name], img, rtol=1e-10, atol=1e-12, equal_nan=True)
+    assert meta.images._values == {}  # intermediate values are freed
+    # images can be changed like in a dictionary
+    meta.images['pA'] = np.zeros(3)
+    del meta.images['pAgF']
+    assert list(meta.images.keys())[:2] == ['pA', 'pFgA']
+    assert list(meta.images['pA']) == [0, 0, 0]
+
+
+def test_sweep():
+    import neurosynth as ns
+    from numpy.testing import assert_array_equal
+    dataset = get_dummy_dataset()
+    ids = ['study1', 'study2', 'study3']
+    meta = MetaAnalysisPlus([], dataset, None, ids)
+    priors, fdrs = [0.3, 0.8], [0.05, 0.5, 1e-10]
+    images = meta.sweep(priors, fdrs)
+    assert list(images.keys()) == [
+        'pA_given_pF=0.30', 'pFgA_given_pF=0.30', 'pA_given_pF=0.80', 'pFgA_given_pF=0.80',
+        'uniformity-test_z_FDR_0.05', 'association-test_z_FDR_0.05',
+        'uniformity-test_z_FDR_0.5', 'association-test_z_FDR_0.5',
+        'uniformity-test_z_FDR_1e-10', 'association-test_z_FDR_1e-10']
+    for prior in priors:
+        for q in fdrs:
+            expected = MetaAnalysisPlus([], dataset, None, ids, prior=prior, q=q).images
+            for name in ('pA_given_pF=%0.2f' % prior, 'pFgA_given_pF=%0.2f' % prior,
+                         'uniformity-test_z_FDR_%s' % q, 'association-test_z_FDR_%s' % q):
+                assert_array_equal(images[name], expected[name])
+    meta.images.update(images)
+    assert 'pFgA_given_pF=0.80' in meta.images
+
+    with pytest.raises(ValueError):
+        MetaAnalysisPlus([], dataset, images=dict(meta.images)).sweep(priors)
+
+
+def test_fdr_threshold():
+    import neurosynth as ns
+    from numpy.testing import assert_array_equal
+    from nsplus.src.batchmeta import fdr_thresholds, fdr_threshold
+    rng = np.random.RandomState(0)
+    p = rng.rand(7, 1000) ** rng.randint(1, 8, (7, 1))
+    p[2, :5] = np.nan
+    p[3] = 1  # nothing passes
+    z = rng.randn(7, 1000)
+    qs = [0.01, 0.05, 0.5]
+    expected_thresholds = [[ns.analysis.stats.fdr(p_map, q) for p_map in p] for q in qs]
+    assert fdr_thresholds(p, qs).tolist() == expected_thresholds
+    assert fdr_thresholds(p[:, :0], qs).tolist() == [[-1] * 7] * 3
+    # in chunks of 1, 2 and all maps
+    for max_memory in (1, 2 * 1000 * 24, 2 ** 28):
+        thresholded = fdr_threshold(z, p, qs, max_memory)
+        for i, q in enumerate(qs):
+            for j in range(len(p)):
+                expected = ns.base.imageutils.threshold_img(
+                    z[j], expected_thresholds[i][j], p[j].copy(), mask_out='above')
+                assert_array_equal(thresholded[i, j], expected)
+
+
+def test_reduced_precision():
+    from nsplus.src.batchmeta import max_deviation
+    dataset = get_dummy_dataset()
+    ids = ['study1', 'study2', 'study3']
+    expected = MetaAnalysisPlus([], dataset, None, ids).images
+    dataset.image_dtype = np.float32
+    assert dataset.image_table.data.dtype == np.float32
+    meta = MetaAnalysisPlus([], dataset, None, ids)
+    assert list(meta.images.keys()) == list(expected.keys())
+    for name, img in meta.images.items():
+        assert img.dtype == np.float32
+        assert np.allclose(img, expected[name], rtol=1e-5, atol=1e-6, equal_nan=True)
+    assert all(img.dtype == np.float32 for img in meta.sweep([0.3], [0.05]).values())
+    # validation
+    deviations = meta.max_deviation()
+    assert list(deviations.keys()) == list(expected.keys())
+    assert deviations == max_deviation(meta.images, expected)
+    assert 0 < max(deviations.values()) < 1e-5
+    assert max_deviation({'a': [1, np.nan, np.inf]}, {'a': [1.5, np.nan, np.inf]}) == {'a': 0.5}
+    assert max_deviation({'a': [1, np.nan]}, {'a': [1, 2]}) == {'a': np.inf}
+    # averages are summed in float64, but kept in float32
+    running_mean = RunningMean()
+    running_mean.add_batch({'img': np.full((3, 10), 0.1, dtype=np.float32)})
+    assert running_mean.mean()['img'].dtype == np.float32
+    assert running_mean.std_error()['img'].dtype == np.float32
+
+
+def test_running_mean():
+    images = np.random.RandomState(0).normal(size=(7, 10))
+    running_mean = RunningMean()
+    running_mean.add({'img': images[0]})
+    running_mean.add_batch({'img': images[1:4]})
+    running_mean.add_batch({'img': images[4:]})
+    assert running_mean.count == 7
+    assert_array_almost_equal(running_mean.mean()['img'], np.mean(images, axis=0))
+    assert_array_almost_equal(running_mean.variance()['img'], np.var(images, axis=0, ddof=1))
+    assert_array_almost_equal(running_mean.std_error()['img'],
+                              np.std(images, axis=0, ddof=1) / np.sqrt(7))
+
+
+@pytest.mark.parametrize('compress_level', [0, 1, 9])
+def test_save_images(tmpdir, compress_level):
+    import nibabel as nb
+    import neurosynth as ns
+    from nsplus.src.singleterm import analyze_expression
+    meta = analyze_expression(get_dummy_dataset(), 'f1', save_files=False)
+    winnings = MetaAnalysisPlus.winnings([meta, meta], 'pFgA', lower_thr=0)
+    for prefix, result in (('meta', meta), ('win', winnings)):
+        result.save_images(prefix, outpath=str(tmpdir), compress_level=compress_level,
+                           threads=3)
+        extension = '.nii.gz' if compress_level else '.nii'
+        for name, image in result.images.items():
+            filename = str(tmpdir.join(prefix + '_' + name + extension))
+            expected_filename = str(tmpdir.join('expected.nii.gz'))
+            ns.imageutils.save_img(image, expected_filename, result.dataset.masker)
+            saved, expected = nb.load(filename), nb.load(expected_filename)
+            assert saved.get_data_dtype() == expected.get_data_dtype()
+            # neurosynth writes integer images with a scale factor, so values may differ slightly
+            assert np.allclose(saved.get_fdata(), expected.get_fdata(), equal_nan=True)
+            assert np.allclose(saved.affine, expected.affine)
+
+
+def test_save_csv(tmpdir):
+    from nsplus.src.singleterm import analyze_expression
+    meta = analyze_expression(get_dummy_dataset(), 'f1', save_files=False)
+    meta.images['pAgF'][:3] = np.nan
+    winnings = MetaAnalysisPlus.winnings([meta, meta], 'pFgA', lower_thr=0)
+    # integer and float images (the integers are written as floats, as in pandas)
+    mixed = MetaAnalysisPlus(meta.info, meta.dataset,
+                             images={'pAgF': meta.images['pAgF'],
+                                     'winnings': winnings.images['winnings']})
+    for result in (meta, winnings, mixed):
+        for image_names in (None, ['pAgF', 'pA', 'winnings', 'no_such_image']):
+            expected_filename = str(tmpdir.join('expected.csv'))
+            result._get_images_with_info(image_names).to_csv(expected_filename, header=False)
+            filename = str(tmpdir.join('result.csv'))
+            result.save_csv(filename, image_names=image_names, chunk_size=1000)
+            with open(filename, 'rb') as saved, open(expected_filename, 'rb') as expected:
+                assert saved.read() == expected.read()
+    # custom float format
+    filename = str(tmpdir.join('result.csv'))
+    meta.save_csv(filename, delimiter='\t', image_names=['pAgF'], float_format='%.3f')
+    with open(filename) as infile:
+        lines = infile.read().splitlines()
+    values = [line.split('\t')[1] for line in lines[-len(meta.images['pAgF']):]]
+    assert values[:3] == ['', '', '']
+    assert values[3] == '%.3f' % meta.images['pAgF'][3]
@@ -2,10 +2,12 @@ import pytest
 import pandas as pd
 from pandas.testing import assert_series_equal
 from .util import *
-from nsplus.src.ranking import sort_and_save
+from scipy.stats import rankdata
+from nsplus.src.ranking import sort_and_save, rank_terms, rank_along_terms, mean_ranks
+from nsplus.src.singleterm import analyze_expression
 
 
-def test_sort_and_save():
+def test_sort_and_save(tmpdir):
     metas = get_dummy_meta(10, num_info=3)
     means = [[(i + j) * (-1) ** j
               for j in range(3)] for i in range(len(metas))]
@@ -13,10 +15,62 @@ def test_sort_and_save():
     extra_info = pd.DataFrame([('ranked by', 'img2'), ('data type', 'test')])
     result = sort_and_save(metas, means, imgs,
                            rank_by='img2',
-                           csv_name='test_sort.csv',
+                           csv_name=str(tmpdir.join('test_sort.csv')),
                            extra_info_df=extra_info)
     assert result.shape == (11, 6)
     s = pd.Series(['f1', 'f 2', 'f3', 'f 4', 'f5'] * 2, name='term')
     assert_series_equal(result['term'], s)
     s = pd.Series([i for i in range(1, 11)], name='rank')
     assert_series_equal(result['rank'], s)
+
+
+def test_rank_terms():
+    dataset = get_dummy_dataset()
+    info, rank = rank_terms(dataset, rank_by='pFgA', extra_expr=['f3 &~ f1'])
+    assert list(rank['term'])[:2] == ['f3', 'f1']
+
+    # same as ranking separate meta-analyses
+    metas = [analyze_expression(dataset, term, save_files=False)
+             for term in ['f 2', 'f 4', 'f1', 'f3', 'f3 &~ f1', 'f5']]
+    img_names = list(metas[0].images.keys())
+    means = [[np.mean(meta.images[img]) for img in img_names] for meta in metas]
+    expected = sort_and_save(metas, means, img_names, rank_by='pFgA')
+    assert list(rank['term']) == list(expected['term'])
+    assert np.allclose(rank.iloc[:, 3:].values.astype(float),
+                       expected.iloc[:, 3:].values.astype(float), equal_nan=True)
+
+
+@pytest.mark.parametrize('ties', ['average', 'min', 'max', 'dense', 'ordinal'])
+def test_rank_along_terms(ties):
+    imgs = np.random.RandomState(0).randint(0, 5, (30, 40)).astype(float)
+    imgs[3, :5] = np.nan
+    for ascending in (True, False):
+        ranks = rank_along_terms(imgs, ascending, ties)
+        for voxel in range(imgs.shape[1]):
+            values = imgs[:, voxel] if ascending else -imgs[:, voxel]
+            # rankdata returns all NaNs for a column with a NaN (scipy >= 1.10), so
+            # rank the other values, and NaNs are ranked last
+            valid = ~np.isnan(values)
+            expected = np.empty(len(values))
+            expected[valid] = rankdata(values[valid], method=ties)
+            last = expected[valid].max() if ties == 'dense' else np.sum(valid)
+            expected[~valid] = last + np.arange(1, np.sum(~valid) + 1)
+            assert np.array_equal(ranks[:, voxel], expected)
+        assert np.allclose(mean_ranks(imgs, ascending, ties, max_memory=30 * 48 * 7),
+                           np.mean(ranks, axis=1))
+    # the largest value is ranked first in descending order
+    ranks = rank_along_terms(np.array([[1.], [3.], [3.], [2.]]), ascending=False, ties=ties)
+    expected = {'average': [4, 1.5, 1.5, 3], 'min': [4, 1, 1, 3], 'max': [4, 2, 2, 3],
+                'dense': [3, 1, 1, 2], 'ordinal': [4, 1, 2, 3]}
+    assert list(ranks[:, 0]) == expected[ties]
+    # NaNs are ranked last in both orders
+    for ascending in (True, False):
+        ranks = rank_along_terms(np.array([[1.], [np.nan], [3.]]), ascending, ties)
+        assert list(ranks[:, 0]) == ([1, 3, 2] if ascending else [2, 3, 1])
+
+
+def test_rank_along_terms_ordinal_ties():
+    # the first of the tied terms gets the smaller rank in both orders
+    imgs = np.array([[2.], [5.], [2.], [5.]])
+    assert list(rank_along_terms(imgs, True, 'ordinal')[:, 0]) == [1, 3, 2, 4]
+    assert list(rank_along_terms(imgs, False, 'ordinal')[:, 0]) == [3, 1, 4, 2]
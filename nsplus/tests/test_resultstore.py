@@ -0,0 +1,69 @@
+import pytest
+from numpy.testing import assert_array_equal
+from .util import *
+from nsplus.src.comparison import compare_expressions, compare_multiple
+
+h5py = pytest.importorskip('h5py')
+from nsplus.src.resultstore import ResultStore, make_result_file
+
+
+def test_save_and_load(tmpdir):
+    dataset = get_dummy_dataset()
+    meta = get_dummy_meta(dataset=dataset, num_info=2)
+    meta.std_errors = {name: img / 10 for name, img in meta.images.items()}
+    meta.info['number of iterations'] = np.int64(3)
+    first_image = list(meta.images.keys())[0]
+    filename = make_result_file(str(tmpdir), 'results')
+    with ResultStore(filename, 'w') as store:
+        assert store.save(meta) == meta.info.name
+        assert store.save(meta, group='a/b', image_names=[first_image]) == 'a/b/' + meta.info.name
+    assert make_result_file(str(tmpdir), 'results') != filename
+
+    with ResultStore(filename) as store:
+        assert store.keys() == ['a/b/' + meta.info.name, meta.info.name]
+        loaded = store.load(meta.info.name, dataset)
+        assert list(loaded.info.items()) == list(meta.info.items())
+        assert loaded.info.name == meta.info.name
+        assert list(loaded.images.keys()) == list(meta.images.keys())
+        for name, img in meta.images.items():
+            assert_array_equal(loaded.images[name], img)
+            assert_array_equal(loaded.std_errors[name], meta.std_errors[name])
+        assert store.image_names('a/b/' + meta.info.name) == [first_image]
+        # random access
+        name = list(meta.images.keys())[1]
+        assert_array_equal(store.read_image(meta.info.name, name, 1, 3), meta.images[name][1:3])
+        assert_array_equal(store.read_image(meta.info.name, name, std_error=True),
+                           meta.std_errors[name])
+
+    with open(str(tmpdir.join('other.h5')), 'wb') as outfile:
+        outfile.write(b'not a result file')
+    with pytest.raises(IOError):
+        ResultStore(str(tmpdir.join('other.h5')))
+
+
+def test_comparison_results(tmpdir):
+    dataset = get_dummy_dataset()
+    metas = compare_expressions(dataset, 'f1', 'f3', num_iterations=2, seed=0,
+                                outpath=str(tmpdir), output_format='hdf5')
+    with ResultStore(str(tmpdir.join('f1_vs_f3.h5'))) as store:
+        assert store.keys() == sorted(meta.info.name for meta in metas)
+        for meta in metas:
+            loaded = store.load(meta.info.name, dataset)
+            assert loaded.info['expression'] == meta.info['expression']
+            for name, img in meta.images.items():
+                assert_array_equal(loaded.images[name], img)
+                assert_array_equal(loaded.std_errors[name], meta.std_errors[name])
+
+    win_metas = compare_multiple(dataset, ['f1', 'f 2', 'f3'], 'pAgF', lower_thr=0.1,
+                                 outpath=str(tmpdir), num_iterations=2, seed=1,
+                                 output_format='hdf5')
+    assert not os.path.isdir(str(tmpdir.join('f1_f_f3')))
+    with ResultStore(str(tmpdir.join('f1_f_f3.h5'))) as store:
+        keys = store.keys()
+        assert len([key for key in keys if key.startswith('pairwise_comparisons/')]) == 6
+        assert 'f1_f_f3_winning_counts' in keys
+        for meta in win_metas.values():
+            assert_array_equal(store.read_image(meta.info.name, 'winnings'),
+                               meta.images['winnings'])
+    with pytest.raises(ValueError):
+        compare_expressions(dataset, 'f1', 'f3', outpath=str(tmpdir), output_format='csv')
@@ -0,0 +1,40 @@
+from unittest import mock
+from nsplus.gui import settings
+
+
+def test_add_custom_term_by_ids(monkeypatch):
+    app = mock.MagicMock()
+    monkeypatch.setattr(settings, 'Global', lambda: app)
+    app.dataset.add_custom_term_by_ids.return_value = [1, 2]
+    page = mock.MagicMock()
+    page.entry_term.get.return_value = ' new term '
+    page.new_term_var.get.return_value = False  # study IDs rather than an expression
+    page.ac_entry_custom.get.return_value = '1, 2'
+    settings.SettingsPage.add_custom_term(page)
+    app.dataset.add_custom_term_by_ids.assert_called_once_with('new term', [1, 2])
+    app.show_error.assert_not_called()
+
+
+def test_add_custom_term_save_error(monkeypatch):
+    app = mock.MagicMock()
+    monkeypatch.setattr(settings, 'Global', lambda: app)
+    app.dataset.add_custom_term_by_ids.return_value = [1]
+    app.save_custom_terms.return_value = False  # e.g. read-only directory
+    page = mock.MagicMock()
+    page.entry_term.get.return_value = 'new term'
+    page.new_term_var.get.return_value = False
+    page.ac_entry_custom.get.return_value = '1'
+    settings.SettingsPage.add_custom_term(page)
+    app.save_custom_terms.assert_called_once_with()
+    app.update_status.assert_not_called()  # the error status is kept
+
+
+def test_save_custom_terms_error(tmpdir):
+    from nsplus.gui.globals import Global
+    app = mock.MagicMock()
+    app.get_custom_terms_filename.return_value = str(tmpdir.join('custom_terms.json'))
+    app.dataset.save_custom_terms.side_effect = IOError('read-only')
+    assert not Global.save_custom_terms(app)
+    assert app.update_status.call_args[1]['is_error']
+    app.dataset.save_custom_terms.side_effect = None
+    assert Global.save_custom_terms(app)
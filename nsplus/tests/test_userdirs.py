@@ -0,0 +1,20 @@
+import os
+from nsplus.src.userdirs import user_data_dir, user_cache_dir
+
+
+def test_user_dirs(monkeypatch, tmpdir):
+    monkeypatch.setenv('NSPLUS_DATA_DIR', str(tmpdir.join('data')))
+    monkeypatch.setenv('NSPLUS_CACHE_DIR', str(tmpdir.join('cache')))
+    assert user_data_dir() == str(tmpdir.join('data'))
+    path = user_cache_dir('results')
+    assert path == str(tmpdir.join('cache', 'results'))
+    assert os.path.isdir(path)
+    assert user_cache_dir('results') == path  # already exists
+
+
+def test_user_dirs_default(monkeypatch, tmpdir):
+    monkeypatch.delenv('NSPLUS_DATA_DIR', raising=False)
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.delenv('XDG_DATA_HOME', raising=False)
+    path = user_data_dir()
+    assert path.startswith(str(tmpdir)) and os.path.isdir(path)
@@ -37,10 +37,13 @@ setup(
         'neurosynth@git+https://github.com/neurosynth/neurosynth.git@948ce7edce15d7df693446e76834e0c23bfe8f11#egg=neurosynth',
         'pandas>=0.23.0',
         'scipy>=1.1.0',
-        'numpy>=1.14.0',
+        'numpy>=1.17.0',
         'matplotlib',
         'scikit-learn'
     ],
+    extras_require={
+        'hdf5': ['h5py']  # saving results in HDF5 files
+    },
     entry_points={
         'console_scripts': [
              'nsplus=nsplus.gui:main_gui',